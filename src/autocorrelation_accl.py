@@ -2,16 +2,22 @@
 from __future__ import absolute_import
 from __future__ import print_function
 # sure imports
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import scipy
-import pyopencl as cl
 
-from src.helper import printProgressBar, top_x_array, Plotter, detrending_filter, autocorr_loop
+from src.helper import printProgressBar, top_x_array, top_k_peaks, Plotter, detrending_filter, autocorr_loop
+from src.backends import get_backend, tiled_quality_curves, tiled_template_search, tiled_template_search_at, tiled_positions
+from src.prefix_quality import prefix_ssd_quality_curve
+from src.sad_search import sad_top_k
+from src.similarity_result import SimilarityResult
+from src.fft_correlation import normalized_cross_correlation, sum_of_squared_differences
 # open-cl stuff:
 
 
 class Autocorrelation_Accelerator:
-    def __init__(self, data=None, no_similar_rounds=None, top_x=10, do_plots=False, use_detrended=False, hidden_aes_operations=33, trace_container=None):
+    def __init__(self, data=None, no_similar_rounds=None, top_x=10, do_plots=False, use_detrended=False, hidden_aes_operations=33, trace_container=None, session=None, engine="per_width", backend=None, template_engine="direct", tile_samples=None, start_stride=None, refine_candidates=None, reduce_on_device=False, top_x_suppression=0, pipelined=False, scheduler=None, keep_curves="none", curve_dtype=np.float32, spill_dir=None):
         self.data = data
         self.no_similar_rounds = no_similar_rounds
         self.top_x = top_x
@@ -19,155 +25,171 @@ class Autocorrelation_Accelerator:
         self.use_detrended = use_detrended
         self.hidden_aes_operations = hidden_aes_operations
         self.trace_container = trace_container
+        # ComputeSession with context, queue, built programs and the device-resident trace
+        self.session = session
+        # Algorithm 1 engine: "per_width" builds and launches one kernel per width,
+        # "multi_width" evaluates batches of widths in one launch with a single program,
+        # "prefix_sum" computes the round-correlation in O(N*R) per width from window sums
+        self.engine = engine
+        # where the kernels run: "opencl", "numba" (parallel CPU kernels, same results as OpenCL), "numpy" (float64 reference),
+        # "auto" or a ComputeBackend instance. None uses CO_FINDER_BACKEND or "auto", see src/backends.py
+        self.backend = backend
+        # template search in correlate(): "direct" (O(N*L) kernel) or "fft" (O(N log L) overlap-save on the CPU)
+        self.template_engine = template_engine
+        # longest piece of the trace that is processed at once (traces larger than the device memory are streamed through
+        # the kernels in overlapping tiles), None derives it from the device limits or CO_FINDER_HOST_MEMORY_BUDGET
+        self.tile_samples = tile_samples
+        # coarse-to-fine Algorithm 1 (direct engines only): evaluate every start_stride-th start position (e.g. one clock period),
+        # then every position within start_stride of the best refine_candidates (default top_x) coarse positions.
+        # All other positions of the curve keep the invalid value (0 or -FLT_MAX), so use_detrended is not supported.
+        self.start_stride = start_stride
+        self.refine_candidates = refine_candidates
+        # detrend and pick the top_x of every width where the curve was computed (only top_x pairs are transferred).
+        # Falls back to the host for plots,
+        # the ssd metric, start_stride and tiled traces.
+        self.reduce_on_device = reduce_on_device
+        # minimum distance-1 between two entries of a top_x list (greedy peak suppression), 0 keeps neighbouring samples
+        self.top_x_suppression = top_x_suppression
+        # overlap the kernels of the next width with the host post-processing of the current one
+        # (non-blocking copies, kernels of upcoming widths are built ahead of time)
+        self.pipelined = pipelined
+        # WidthScheduler (src/scheduler.py) that distributes the widths of the quality curves over all devices and
+        # CPU worker processes, None computes them with the backend of this accelerator
+        self.scheduler = scheduler
+        # what the SimilarityResult of autocorrelation_accelerated_updated / autosad_accelerated_updated keeps of the full curves:
+        # "none" (only the top_x summaries, a curve is recomputed when it is requested), "memmap" (spilled to a memory mapped
+        # file in curve_dtype, in spill_dir) or "memory" (all curves in RAM, the last one also in trace_container.quality_plot)
+        self.keep_curves = keep_curves
+        self.curve_dtype = curve_dtype
+        self.spill_dir = spill_dir
+
+    def get_backend(self):
+        # resolved once, the backend instance replaces the name
+        self.backend = get_backend(self.backend, session=self.session)
+        return self.backend
+
+    def get_tile_samples(self):
+        if self.tile_samples is None:
+            self.tile_samples = self.get_backend().max_tile_samples()
+        return self.tile_samples
+
+    def _template_search(self, metric, trace, template_candidate, idx_list):
+        # only the requested positions are computed: one strided launch if idx_list is evenly spaced, an index list otherwise
+        backend = self.get_backend()
+        idx_list = np.asarray(idx_list, dtype=np.int64)
+        steps = np.diff(idx_list)
+        if len(steps) == 0 or (steps[0] > 0 and np.all(steps == steps[0])):
+            stride = int(steps[0]) if len(steps) > 0 else 1
+            function = backend.template_sad if metric == "sad" else backend.template_correlation
+            return tiled_template_search(function, trace, template_candidate, int(idx_list[0]), len(idx_list), self.get_tile_samples(), stride)
+        function = backend.template_sad_at if metric == "sad" else backend.template_correlation_at
+        return tiled_template_search_at(function, trace, template_candidate, idx_list, self.get_tile_samples())
 
     def calc_sad(self, template_candidate, trace, idx_list=[]):
-        # insert code here :)
-        ctx = cl.create_some_context()
-        queue = cl.CommandQueue(ctx)
-        mf = cl.mem_flags
-
-        # setup memory:
-        trace_host = trace.astype(np.float32)
-        trace_dev = cl.Buffer(ctx, mf.READ_ONLY |
-                              mf.COPY_HOST_PTR, hostbuf=trace_host)
-        template_candidate_host = template_candidate.astype(np.float32)
-        template_candidate_dev = cl.Buffer(
-            ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=template_candidate_host)
-        correlation_dev = cl.Buffer(ctx, mf.WRITE_ONLY, trace_host.nbytes)
-        template_length_dev = cl.Buffer(
-            ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=np.int32(len(template_candidate)))
-
-        programstring = """
-        #if __OPENCL_VERSION__ < 120
-            #if cl_khr_fp64
-                #pragma OPENCL EXTENSION cl_khr_fp64 : enable
-            #elif cl_amd_fp64
-                #pragma OPENCL EXTENSION cl_amd_fp64 : enable
-            #else
-                #error Missing double precision extension
-            #endif
-        #endif
-        float sad_calculation(__global const float* X, __global const float* avg_segment_adj, int n){ 
-            float sad = 0;
-            for (int i = 0; i < n; ++i){ 
-                sad += fabs((float)(avg_segment_adj[i]-X[i]));
-            }
-            return sad; 
-        } 
-
-        __kernel void correlate(__global const float *data, __global float *correlation,  __global float *template_candidate, __global int *template_length){
-            int i = get_global_id(0);
-            int idx_max = get_global_size(0);
-            int i_template_length = *template_length;
-
-            // Abort if we would otherwise run out of valid idx
-            if(i+i_template_length >= idx_max){
-                correlation[i] = -1;
-                return;
-            }
-            correlation[i] = sad_calculation(&data[i], template_candidate, i_template_length);
-        }
-        """
-        prg = cl.Program(ctx, programstring).build()
+        if len(idx_list) == 0:
+            idx_list = np.array(range(len(trace)))
+        else:
+            idx_list = np.array(idx_list)
+        idx_list = idx_list[np.where(
+            idx_list < len(trace)-len(template_candidate))]
+        if len(idx_list) == 0:
+            return np.array([], dtype=np.float32)
 
-        prg.correlate(queue, trace_host.shape, None, trace_dev,
-                      correlation_dev, template_candidate_dev, template_length_dev)
+        return self._template_search("sad", trace, template_candidate, idx_list)
 
-        correlation_host = np.empty_like(trace_host)
-        cl.enqueue_copy(queue, correlation_host, correlation_dev)
+    def calc_sad_matrix(self, template_candidate, trace, starts, offsets):
+        """
+            SAD of the template at every start+offset as a (len(starts), len(offsets)) matrix, computed in one batched
+            backend call (e.g. the alignment of many COs against a baseline). Positions where the template does not fit
+            into the trace get inf.
+        """
+        positions = np.asarray(starts, dtype=np.int64)[
+            :, None] + np.asarray(offsets, dtype=np.int64)[None, :]
+        valid = (positions >= 0) & (positions < len(
+            trace)-len(template_candidate))
+        sad = np.full(positions.shape, np.inf, dtype=np.float32)
+        if np.any(valid):
+            sad[valid] = self._template_search(
+                "sad", trace, template_candidate, positions[valid])
+        return sad
+
+    def calc_ssd(self, template_candidate, trace, idx_list=[]):
+        # sum of squared differences in O(N log L), same index handling as calc_sad
+        if len(idx_list) == 0:
+            idx_list = np.array(range(len(trace)))
+        else:
+            idx_list = np.array(idx_list)
+        idx_list = idx_list[np.where(
+            idx_list < len(trace)-len(template_candidate))]
+        if len(idx_list) == 0:
+            return np.array([], dtype=np.float32)
 
-        #Plotter(range(len(correlation_host)),correlation_host,"Sample","Correlation","Correlation of right width (autocorr)","correlation_host")
-        #Plotter(range(len(correlation_host_detrended)),correlation_host_detrended,"Sample","Correlation detrended","Correlation detrended of right width (autocorr)","correlation_host")
+        first_idx = int(np.min(idx_list))
+        count = int(np.max(idx_list)) - first_idx + 1
+        ssd = sum_of_squared_differences(
+            trace, template_candidate, first_idx, count)
+        return ssd[idx_list-first_idx]
 
-        # print(correlation_host)
-        # print(len(correlation_host))
-        #print("max = " + str(max(correlation_host)))
+    def calc_sad_top_k(self, template_candidate, trace, k, idx_list=[], suppression_radius=0, suppression_after=None):
+        """
+            Start positions (from idx_list) and SADs of the k best matches, best first, without computing the full SAD of
+            every position: positions are screened with a lower bound and abandoned once they can not make it into the
+            top k anymore (see src/sad_search.py). Same matches as top_k_peaks on -calc_sad(...), including the tie order
+            (equal SADs go to the larger index), suppression_radius counts entries of idx_list. suppression_after (default
+            suppression_radius) are the entries after a match that are suppressed.
+        """
         if len(idx_list) == 0:
             idx_list = np.array(range(len(trace)))
         else:
             idx_list = np.array(idx_list)
-        return correlation_host[idx_list[np.where(idx_list < len(correlation_host)-len(template_candidate))]]
+        idx_list = idx_list[np.where(
+            idx_list < len(trace)-len(template_candidate))]
+        picks, sads = sad_top_k(
+            trace, template_candidate, k, idx_list, suppression_radius, suppression_after)
+        return idx_list[picks], sads
+
+    def calc_distance(self, template_candidate, trace, idx_list=[], distance_metric="sad"):
+        """
+            Distance of the template to the trace at idx_list, "sad" (exact sum of absolute differences) or "ssd" (sum of squared differences via FFT).
+        """
+        if distance_metric == "sad":
+            return self.calc_sad(template_candidate, trace, idx_list)
+        elif distance_metric == "ssd":
+            return self.calc_ssd(template_candidate, trace, idx_list)
+        raise ValueError("unknown distance metric: " + str(distance_metric))
 
     def correlate(self, trace, template_candidate, idx_list, opencl=True, print_times=True):
         from time import process_time
 
         t1_start = process_time()
-        if not opencl:
+        if self.template_engine == "fft":
+            idx_list = np.asarray(idx_list, dtype=int)
+            if len(idx_list) == 0:
+                correlation = np.array([], dtype=np.float32)
+            else:
+                first_idx = int(np.min(idx_list))
+                count = int(np.max(idx_list)) - first_idx + 1
+                correlation = np.abs(normalized_cross_correlation(
+                    trace, template_candidate, first_idx, count))[idx_list-first_idx]
+        elif not opencl:
             correlation = np.array([np.abs(scipy.stats.pearsonr(
                 template_candidate, trace[idx:idx+len(template_candidate)])[0]) for idx in idx_list])
         else:
-            # insert code here :)
-            ctx = cl.create_some_context()
-            queue = cl.CommandQueue(ctx)
-            mf = cl.mem_flags
-
-            # setup memory:
-            trace_host = trace.astype(np.float32)
-            trace_dev = cl.Buffer(ctx, mf.READ_ONLY |
-                                  mf.COPY_HOST_PTR, hostbuf=trace_host)
-            template_candidate_host = template_candidate.astype(np.float32)
-            template_candidate_dev = cl.Buffer(
-                ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=template_candidate_host)
-            correlation_dev = cl.Buffer(ctx, mf.WRITE_ONLY, trace_host.nbytes)
-            template_length_dev = cl.Buffer(
-                ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=np.int32(len(template_candidate)))
-
-            programstring = """
-            #if __OPENCL_VERSION__ < 120
-                #if cl_khr_fp64
-                    #pragma OPENCL EXTENSION cl_khr_fp64 : enable
-                #elif cl_amd_fp64
-                    #pragma OPENCL EXTENSION cl_amd_fp64 : enable
-                #else
-                    #error Missing double precision extension
-                #endif
-            #endif
-            float correlationCoefficient(__global const float* X, __global const float* avg_segment_adj, int n){ 
-                float sum_X = 0, sum_Y = 0, sum_XY = 0; 
-                float squareSum_X = 0, squareSum_Y = 0; 
-            
-                for (int i = 0; i < n; ++i){ 
-                    sum_X = sum_X + X[i]; 
-                    sum_Y = sum_Y + avg_segment_adj[i]; 
-                    sum_XY = sum_XY + X[i] * avg_segment_adj[i];
-                    squareSum_X = squareSum_X + X[i] * X[i]; 
-                    squareSum_Y = squareSum_Y + avg_segment_adj[i] * avg_segment_adj[i]; 
-                }  
-                float corr = (float)(n * sum_XY - sum_X * sum_Y)  / sqrt((float)((n * squareSum_X - sum_X * sum_X) * (n * squareSum_Y - sum_Y * sum_Y))); 
-                return corr; 
-            } 
-
-            __kernel void correlate(__global const float *data, __global float *correlation,  __global float *template_candidate, __global int *template_length){
-                int i = get_global_id(0);
-                int idx_max = get_global_size(0);
-                int i_template_length = *template_length;
-
-                // Abort if we would otherwise run out of valid idx
-                if(i+i_template_length >= idx_max){
-                    correlation[i] = 0;
-                    return;
-                }
-                correlation[i] = correlationCoefficient(&data[i], template_candidate, i_template_length);
-            }
-            """
-            prg = cl.Program(ctx, programstring).build()
-
-            prg.correlate(queue, trace_host.shape, None, trace_dev,
-                          correlation_dev, template_candidate_dev, template_length_dev)
-
-            correlation_host = np.empty_like(trace_host)
-            cl.enqueue_copy(queue, correlation_host, correlation_dev)
-
-            #Plotter(range(len(correlation_host)),correlation_host,"Sample","Correlation","Correlation of right width (autocorr)","correlation_host")
-            #Plotter(range(len(correlation_host_detrended)),correlation_host_detrended,"Sample","Correlation detrended","Correlation detrended of right width (autocorr)","correlation_host")
-
-            # print(correlation_host)
-            # print(len(correlation_host))
-            #print("max = " + str(max(correlation_host)))
-            correlation = np.abs(correlation_host)[idx_list]
+            idx_list = np.asarray(idx_list, dtype=int)
+            if len(idx_list) == 0:
+                correlation = np.array([], dtype=np.float32)
+            else:
+                correlation = np.abs(self._template_search(
+                    "pearson", trace, template_candidate, idx_list))
         t1_stop = process_time()
         if print_times:
-            if opencl:
+            if self.template_engine == "fft":
+                print("FFT: correlate used " +
+                      str((t1_stop-t1_start)) + " seconds")
+            elif opencl and self.get_backend().name != "opencl":
+                print(self.get_backend().name + ": correlate used " +
+                      str((t1_stop-t1_start)) + " seconds")
+            elif opencl:
                 print("GPU: correlate used " +
                       str((t1_stop-t1_start)) + " seconds")
             else:
@@ -175,114 +197,175 @@ class Autocorrelation_Accelerator:
                       str((t1_stop-t1_start)) + " seconds")
         return correlation
 
-    def autocorrelation_accelerated_updated(self, w_list):
-        # go through all possible widhts to determine the best one! (w = perfect segment width)
-        correlation_for_each_width = []
-
-        ctx = cl.create_some_context()
-        queue = cl.CommandQueue(ctx)
-        mf = cl.mem_flags
-
-        #data_dev = cl_array.to_device(queue, self.data)
-        data_host = self.data.astype(np.float32)
-        correlation_dev = cl.Buffer(ctx, mf.WRITE_ONLY, data_host.nbytes)
-        data_dev = cl.Buffer(ctx, mf.READ_ONLY |
-                             mf.COPY_HOST_PTR, hostbuf=data_host)
+    def quality_curves(self, w_list, metric="pearson"):
+        """
+            Yields (w, similarity of every start position) for the widths in w_list (Algorithm 1).
+            Stops at the first width whose rounds do not fit into the trace anymore.
 
-        no_similar_rounds_dev = cl.Buffer(
-            ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=np.int32(self.no_similar_rounds))
+            :param metric: "pearson" for the round-correlation, "sad" for the negative round-SAD or "ssd" for the negative round-SSD
+        """
+        usable_w_list = self._usable_widths(w_list)
+        if metric == "ssd":
+            # sum of squares only needs window sums, O(N*R) on the CPU for every engine
+            for w in usable_w_list:
+                yield w, prefix_ssd_quality_curve(self.data, w, self.no_similar_rounds)
+        elif self.engine not in ("per_width", "multi_width", "prefix_sum"):
+            raise ValueError("unknown engine: " + str(self.engine))
+        elif self.engine == "prefix_sum" and metric != "pearson":
+            raise ValueError(
+                "the prefix_sum engine only supports the pearson round-similarity")
+        elif self.start_stride is not None and self.start_stride > 1 and self.engine != "prefix_sum":
+            if self.use_detrended:
+                raise ValueError(
+                    "use_detrended needs the full quality curve, it can not be combined with start_stride")
+            for w in usable_w_list:
+                yield w, self._quality_curve_coarse_to_fine(w, metric)
+        elif self.scheduler is not None:
+            for w, correlation_host in self.scheduler.quality_curves(self.data, usable_w_list, self.no_similar_rounds, metric, self.engine):
+                yield w, correlation_host
+        else:
+            for w, correlation_host in tiled_quality_curves(self.get_backend(), self.data, usable_w_list, self.no_similar_rounds, metric, self.engine, self.get_tile_samples()):
+                yield w, correlation_host
 
-        widths_correlation = []
+    def _usable_widths(self, w_list):
+        # all widths up to the first one whose rounds do not fit into the trace anymore
+        usable_w_list = []
         for w in w_list:
-            programstring = "#define WIDTH "+str(w)+"""
-            #if __OPENCL_VERSION__ < 120
-                #if cl_khr_fp64
-                    #pragma OPENCL EXTENSION cl_khr_fp64 : enable
-                #elif cl_amd_fp64
-                    #pragma OPENCL EXTENSION cl_amd_fp64 : enable
-                #else
-                    #error Missing double precision extension
-                #endif
-            #endif
-
-            float correlationCoefficient_stable(__global const float* X, __private const float* avg_segment_adj, int n){ 
-                float sum_X = 0, sum_Y = 0, sum_XY = 0; 
-                float squareSum_X = 0, squareSum_Y = 0; 
-            
-                for (int i = 0; i < n; ++i){ 
-                    sum_X = sum_X + X[i]; 
-                    sum_Y = sum_Y + avg_segment_adj[i]; 
-                    sum_XY = sum_XY + X[i] * avg_segment_adj[i];
-                    squareSum_X = squareSum_X + X[i] * X[i]; 
-                    squareSum_Y = squareSum_Y + avg_segment_adj[i] * avg_segment_adj[i]; 
-                }  
-                float corr = (float)(n * sum_XY - sum_X * sum_Y)  / sqrt((float)((n * squareSum_X - sum_X * sum_X) * (n * squareSum_Y - sum_Y * sum_Y))+0.00001); 
-                return corr; 
-            } 
-
-            __kernel void correlate(__global const float *data, __global float *correlation, __global int *no_similar_rounds){
-                int i = get_global_id(0);
-                int idx_max = get_global_size(0);
-                float avg_segment[WIDTH]= { 0 };
-
-                int w = WIDTH;
-                int max_rounds = *no_similar_rounds;
-                // Abort if we would otherwise run out of valid idx
-                if(i+max_rounds*w >= idx_max){
-                    correlation[i] = 0;
-                    return;
-                }
-                // Create mean segment:
-                for(int round = 0; round < max_rounds; ++round){
-                    for(int avg_idx=0; avg_idx<w; ++avg_idx){
-                        avg_segment[avg_idx] += data[i+avg_idx+(round*w)]/max_rounds;
-                    }
-                }
-                //find avg correlation:
-                float avg_correlation = 0;
-                for(int round = 0; round < max_rounds; ++round){
-                    float round_correlation = correlationCoefficient_stable(&data[i+round*w],avg_segment,w);
-                    avg_correlation += round_correlation/max_rounds;
-                }
-                correlation[i] = avg_correlation;
-            }
-            """
-            prg = cl.Program(ctx, programstring).build()
-
-            len_all_rounds = w*self.no_similar_rounds
-            if(len_all_rounds > len(data_host)):
+            if w*self.no_similar_rounds > len(self.data):
                 break
+            usable_w_list.append(int(w))
+        return usable_w_list
+
+    def _use_reduction(self, metric):
+        tile_samples = self.get_tile_samples()
+        return self.reduce_on_device and not self.do_plots and metric != "ssd" and self.start_stride is None and self.scheduler is None and \
+            (tile_samples is None or len(self.data) <= tile_samples)
+
+    def _reduced_top_x(self, w_list, metric, **postprocessing):
+        # yields (w, top_x list) with the post-processing (options may be functions of w) done by the backend
+        return self.get_backend().quality_top_k_widths(self.data, self._usable_widths(w_list), self.no_similar_rounds, self.top_x, metric,
+                                                       self.engine, suppression_radius=self.top_x_suppression, **postprocessing)
+
+    def _quality_curve_at(self, w, positions, metric):
+        backend = self.get_backend()
+        return tiled_positions(lambda tile, tile_positions: backend.quality_curve_at(tile, w, self.no_similar_rounds, tile_positions, metric),
+                               self.data, positions, self.no_similar_rounds*w, self.get_tile_samples())
+
+    def _quality_curve_coarse_to_fine(self, w, metric):
+        # neighbouring start positions within one clock period have strongly correlated scores: find the best
+        # candidates on the stride grid, then evaluate the full resolution only around them
+        n = len(self.data)
+        stride = int(self.start_stride)
+        n_valid = max(0, n-self.no_similar_rounds*w)
+        invalid = np.finfo(np.float32).min if metric == "sad" else 0
+        quality = np.full(n, invalid, dtype=np.float32)
+
+        coarse_positions = np.arange(0, n_valid, stride)
+        quality[coarse_positions] = self._quality_curve_at(
+            w, coarse_positions, metric)
+        refine_candidates = self.top_x if self.refine_candidates is None else self.refine_candidates
+        candidates = coarse_positions[np.argsort(
+            quality[coarse_positions])[::-1][:refine_candidates]]
+        fine_positions = np.unique((candidates[:, None] + np.arange(-stride+1, stride)[None, :]).ravel())
+        fine_positions = fine_positions[(fine_positions >= 0) & (
+            fine_positions < n_valid) & (fine_positions % stride != 0)]
+        quality[fine_positions] = self._quality_curve_at(
+            w, fine_positions, metric)
+        return quality
+
+    def _postprocess_autocorr(self, w, correlation_host):
+        # host work of one width: (w, curve, detrended curve or None, curve that is used, its top_x list)
+        correlation_host_detrended = None
+        final_correlation = correlation_host
+        if self.use_detrended:
+            correlation_host_detrended = detrending_filter(
+                correlation_host, w*self.no_similar_rounds)
+            final_correlation = np.concatenate((correlation_host_detrended, np.zeros(
+                len(correlation_host)-len(correlation_host_detrended))))
+        top_x_correlation = top_k_peaks(
+            np.array(final_correlation), self.top_x, self.top_x_suppression)
+        return w, correlation_host, correlation_host_detrended, final_correlation, top_x_correlation
+
+    def _postprocess_autosad(self, w, correlation_host):
+        correlation_host_detrended = detrending_filter(
+            correlation_host[:len(correlation_host)-w*self.no_similar_rounds], w)
+        if self.use_detrended:
+            final_correlation = np.concatenate((correlation_host_detrended, np.zeros(
+                len(correlation_host)-len(correlation_host_detrended))))
+        else:
+            final_correlation = correlation_host/correlation_host.max(axis=0)
+        top_x_correlation = top_k_peaks(
+            np.array(final_correlation), self.top_x, self.top_x_suppression)
+        return w, correlation_host, correlation_host_detrended, final_correlation, top_x_correlation
+
+    def _postprocessed_curves(self, w_list, metric, postprocess):
+        # yields postprocess(w, curve) for every width. In pipelined mode the device computes width k+1 while a
+        # worker thread post-processes width k, the caller (plots) runs in parallel to both.
+        if not self.pipelined:
+            for w, correlation_host in self.quality_curves(w_list, metric):
+                yield postprocess(w, correlation_host)
+            return
+
+        def wait_and_postprocess(w, correlation_host, event):
+            if event is not None:
+                event.wait()
+            return postprocess(w, correlation_host)
+
+        with ThreadPoolExecutor(max_workers=1) as worker:
+            pending = []
+            for w, correlation_host, event in self._quality_curve_events(w_list, metric):
+                pending.append(worker.submit(
+                    wait_and_postprocess, w, correlation_host, event))
+                while len(pending) > 1:
+                    yield pending.pop(0).result()
+            for future in pending:
+                yield future.result()
+
+    def _quality_curve_events(self, w_list, metric):
+        # (w, curve, event that completes the curve) with asynchronous copies where the backend supports it
+        if metric == "ssd" or self.start_stride is not None or self.scheduler is not None or self.engine not in ("per_width", "multi_width") or \
+                (self.get_tile_samples() is not None and len(self.data) > self.get_tile_samples()):
+            for w, correlation_host in self.quality_curves(w_list, metric):
+                yield w, correlation_host, None
+            return
+        for w, correlation_host, event in self.get_backend().quality_curves_async(self.data, self._usable_widths(w_list), self.no_similar_rounds, metric, self.engine):
+            yield w, correlation_host, event
+
+    def _similarity_result(self, metric, postprocess):
+        # the curve of one width is computed and post-processed again when it is requested
+        def recompute(w):
+            for _, correlation_host in self.quality_curves([w], metric):
+                return postprocess(w, correlation_host)[3]
+        return SimilarityResult(self.keep_curves, recompute, self.curve_dtype, self.spill_dir)
 
-            # all start positions need to be considered!
-            prg.correlate(queue, data_host.shape, None, data_dev,
-                          correlation_dev, no_similar_rounds_dev)
-
-            correlation_host = np.empty_like(data_host)
-            cl.enqueue_copy(queue, correlation_host, correlation_dev)
-            if self.use_detrended:
-                correlation_host_detrended = detrending_filter(
-                    correlation_host, w*self.no_similar_rounds)
-            if self.do_plots:
-                if not self.use_detrended:
-                    Plotter(range(len(correlation_host)), np.array(correlation_host, dtype=float), "Sample", "Similarity",
-                            "Similarity of width" + str(w) + " (autocorr)", "Similarity (Step 1) for width: " + str(w), decimation_factor=30)
-                else:
-                    Plotter(range(len(correlation_host_detrended)), np.array(correlation_host_detrended, dtype=float), "Sample", "Similarity detrended",
-                            "Correlation detrended of width " + str(w) + " (autocorr)", "correlation_host_detrended  " + str(w), decimation_factor=30)
-
-            self.trace_container.quality_plot = correlation_host
-
-            if self.use_detrended:
-                add_len = len(correlation_host) - \
-                    len(correlation_host_detrended)
-                correlation_host = np.concatenate(
-                    (correlation_host_detrended, np.zeros(add_len)))
+    def autocorrelation_accelerated_updated(self, w_list):
+        # go through all possible widhts to determine the best one! (w = perfect segment width)
+        correlation_for_each_width = self._similarity_result(
+            "pearson", self._postprocess_autocorr)
 
-            correlation_for_each_width.append(correlation_host)
-            top_x_correlation = top_x_array(
-                np.array(correlation_host), self.top_x, scale=1)
-            widths_correlation.append(top_x_correlation)
-            printProgressBar(len(widths_correlation), len(w_list))
+        widths_correlation = []
+        if self._use_reduction("pearson"):
+            for w, top_x_correlation in self._reduced_top_x(w_list, "pearson", detrend_window=(lambda w: w*self.no_similar_rounds) if self.use_detrended else None):
+                correlation_for_each_width.add(w, top_x_correlation)
+                widths_correlation.append(top_x_correlation)
+                printProgressBar(len(widths_correlation), len(w_list))
+        else:
+            for w, correlation_host, correlation_host_detrended, final_correlation, top_x_correlation in self._postprocessed_curves(w_list, "pearson", self._postprocess_autocorr):
+                if self.do_plots:
+                    if not self.use_detrended:
+                        Plotter(range(len(correlation_host)), np.array(correlation_host, dtype=float), "Sample", "Similarity",
+                                "Similarity of width" + str(w) + " (autocorr)", "Similarity (Step 1) for width: " + str(w), decimation_factor=30)
+                    else:
+                        Plotter(range(len(correlation_host_detrended)), np.array(correlation_host_detrended, dtype=float), "Sample", "Similarity detrended",
+                                "Correlation detrended of width " + str(w) + " (autocorr)", "correlation_host_detrended  " + str(w), decimation_factor=30)
+
+                if self.keep_curves == "memory":
+                    self.trace_container.quality_plot = correlation_host
+
+                correlation_for_each_width.add(
+                    w, top_x_correlation, final_correlation)
+                widths_correlation.append(top_x_correlation)
+                printProgressBar(len(widths_correlation), len(w_list))
 
         print("\n")
         print("-------AUTOCORR-------RESULTS-------------------------------")
@@ -333,108 +416,37 @@ class Autocorrelation_Accelerator:
         best_widths = top_x_array(widths_correlation[:, 0, 0], 20)
         return best_widths, widths_correlation
 
-    def autosad_accelerated_updated(self, w_list):
+    def autosad_accelerated_updated(self, w_list, distance_metric="sad"):
         # go through all possible widhts to determine the best one! (w = perfect segment width)
-        correlation_for_each_width = []
-
-        ctx = cl.create_some_context()
-        queue = cl.CommandQueue(ctx)
-        mf = cl.mem_flags
-
-        #data_dev = cl_array.to_device(queue, self.data)
-        data_host = self.data.astype(np.float32)
-        correlation_dev = cl.Buffer(ctx, mf.WRITE_ONLY, data_host.nbytes)
-        data_dev = cl.Buffer(ctx, mf.READ_ONLY |
-                             mf.COPY_HOST_PTR, hostbuf=data_host)
-
-        no_similar_rounds_dev = cl.Buffer(
-            ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=np.int32(self.no_similar_rounds))
+        # distance_metric: "sad" or "ssd" for the distance of every round to the mean segment
+        correlation_for_each_width = self._similarity_result(
+            distance_metric, self._postprocess_autosad)
 
         widths_correlation = []
-        for w in w_list:
-            programstring = "#define WIDTH "+str(w)+"""
-            #if __OPENCL_VERSION__ < 120
-                #if cl_khr_fp64
-                    #pragma OPENCL EXTENSION cl_khr_fp64 : enable
-                #elif cl_amd_fp64
-                    #pragma OPENCL EXTENSION cl_amd_fp64 : enable
-                #else
-                    #error Missing double precision extension
-                #endif
-            #endif
-
-            float negative_sad_calculation(__global const float* X, __private const float* avg_segment_adj, int n){ 
-                float sad = 0;
-                for (int i = 0; i < n; ++i){ 
-                    sad -= fabs((float)(avg_segment_adj[i]-X[i]));
-                }
-                return sad; 
-            } 
-
-        
-            __kernel void correlate(__global const float *data, __global float *correlation, __global int *no_similar_rounds){
-                int i = get_global_id(0);
-                int idx_max = get_global_size(0);
-                float avg_segment[WIDTH]= { 0 };
-
-                int w = WIDTH;
-                int max_rounds = *no_similar_rounds;
-                // Abort if we would otherwise run out of valid idx
-                if(i+max_rounds*w >= idx_max){
-                    correlation[i] = -FLT_MAX;
-                    return;
-                }
-                // Create mean segment:
-                for(int round = 0; round < max_rounds; ++round){
-                    for(int avg_idx=0; avg_idx<w; ++avg_idx){
-                        avg_segment[avg_idx] += data[i+avg_idx+(round*w)]/max_rounds;
-                    }
-                }
-                //find avg correlation:
-                float avg_correlation = 0;
-                for(int round = 0; round < max_rounds; ++round){
-                    float round_correlation = negative_sad_calculation(&data[i+round*w],avg_segment,w);
-                    avg_correlation += round_correlation/max_rounds;
-                }
-                correlation[i] = avg_correlation;
-            }
-            """
-            prg = cl.Program(ctx, programstring).build()
-
-            len_all_rounds = w*self.no_similar_rounds
-            if(len_all_rounds > len(data_host)):
-                break
-
-            # all start positions need to be considered!
-            prg.correlate(queue, data_host.shape, None, data_dev,
-                          correlation_dev, no_similar_rounds_dev)
-
-            correlation_host = np.empty_like(data_host)
-            cl.enqueue_copy(queue, correlation_host, correlation_dev)
-            correlation_host_detrended = detrending_filter(
-                correlation_host[:len(correlation_host)-w*self.no_similar_rounds], w)
-
-            if self.do_plots:
-                Plotter(range(len(correlation_host[:int(len(correlation_host)-w*self.no_similar_rounds)])), np.array(correlation_host[:int(len(correlation_host)-w *
-                        self.no_similar_rounds)], dtype=float), "Sample", "Correlation", "Correlation of right width (autocorr)", "correlation_host", decimation_factor=10)
-                Plotter(range(len(correlation_host_detrended)), np.array(correlation_host_detrended, dtype=float), "Sample",
-                        "Correlation detrended", "Correlation detrended of right width (autocorr)", "correlation_host_detrended", decimation_factor=10)
-
+        if self._use_reduction(distance_metric):
             if self.use_detrended:
-                add_len = len(correlation_host) - \
-                    len(correlation_host_detrended)
-                correlation_host = np.concatenate(
-                    (correlation_host_detrended, np.zeros(add_len)))
+                postprocessing = {"detrend_window": lambda w: w,
+                                  "detrend_length": lambda w: len(self.data)-w*self.no_similar_rounds}
             else:
-                correlation_host = correlation_host / \
-                    correlation_host.max(axis=0)
-
-            correlation_for_each_width.append(correlation_host)
-            top_x_correlation = top_x_array(
-                np.array(correlation_host), self.top_x, scale=1)
-            print("top x correlation: " + str(top_x_correlation))
-            widths_correlation.append(top_x_correlation)
-            printProgressBar(len(widths_correlation), len(w_list))
+                postprocessing = {"normalize_by_max": True}
+            for w, top_x_correlation in self._reduced_top_x(w_list, distance_metric, **postprocessing):
+                correlation_for_each_width.add(w, top_x_correlation)
+                print("top x correlation: " + str(top_x_correlation))
+                widths_correlation.append(top_x_correlation)
+                printProgressBar(len(widths_correlation), len(w_list))
+        else:
+            for w, correlation_host, correlation_host_detrended, final_correlation, top_x_correlation in self._postprocessed_curves(w_list, distance_metric, self._postprocess_autosad):
+                if self.do_plots:
+                    Plotter(range(len(correlation_host[:int(len(correlation_host)-w*self.no_similar_rounds)])), np.array(correlation_host[:int(len(correlation_host)-w *
+                            self.no_similar_rounds)], dtype=float), "Sample", "Correlation", "Correlation of right width (autocorr)", "correlation_host", decimation_factor=10)
+                    Plotter(range(len(correlation_host_detrended)), np.array(correlation_host_detrended, dtype=float), "Sample",
+                            "Correlation detrended", "Correlation detrended of right width (autocorr)", "correlation_host_detrended", decimation_factor=10)
+
+                correlation_for_each_width.add(
+                    w, top_x_correlation, final_correlation)
+                print("top x correlation: " + str(top_x_correlation))
+                widths_correlation.append(top_x_correlation)
+                printProgressBar(len(widths_correlation), len(w_list))
 
         print("\n")
         print("-------AUTOSAD-------RESULTS-------------------------------")
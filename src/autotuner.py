@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+# Autotuner for the strided template kernels. Every (device, kernel, template length class) gets the fastest of the
+# TUNED_TEMPLATE_KERNEL variants and work group sizes. The winners are stored in a JSON tuning cache next to the
+# program cache, the OpenCL backend uses them in later runs (see OpenCLBackend._template_kernel).
+import json
+import os
+import tempfile
+from time import perf_counter
+
+import numpy as np
+
+from src.opencl_kernels import TEMPLATE_SAD_KERNEL, TEMPLATE_CORRELATION_KERNEL, TUNED_TEMPLATE_KERNEL
+
+try:
+    import pyopencl as cl
+except ImportError:
+    cl = None
+
+# set to 1 to tune missing entries on first use instead of falling back to the default kernels
+AUTOTUNE_ENV_VAR = "CO_FINDER_AUTOTUNE"
+
+# kernel name -> (default kernel source, build options of TUNED_TEMPLATE_KERNEL)
+KERNELS = {"template_sad": (TEMPLATE_SAD_KERNEL, ["-DMETRIC_SAD"]),
+           "template_correlation": (TEMPLATE_CORRELATION_KERNEL, [])}
+
+# variant name -> build options
+VARIANTS = {"global": [],
+            "constant": ["-DTEMPLATE_CONSTANT"],
+            "local_template": ["-DTEMPLATE_LOCAL"],
+            "local_window": ["-DDATA_LOCAL"],
+            "local_template_window": ["-DTEMPLATE_LOCAL", "-DDATA_LOCAL"],
+            "vectorized": ["-DVECTORIZED"],
+            "constant_vectorized": ["-DTEMPLATE_CONSTANT", "-DVECTORIZED"],
+            "local_template_window_vectorized": ["-DTEMPLATE_LOCAL", "-DDATA_LOCAL", "-DVECTORIZED"]}
+
+# None lets the driver pick
+LOCAL_SIZES = (None, 32, 64, 128, 256)
+
+
+def length_class(template_length):
+    """
+        Template lengths are tuned per power of two: the class of a length is the next power of two >= length.
+    """
+    return 1 << max(0, int(template_length-1).bit_length())
+
+
+def device_key(device):
+    return " | ".join([device.name.strip(), device.vendor.strip(), device.driver_version.strip(), device.platform.name.strip()])
+
+
+class TuningCache:
+    """
+        Persistent tuning database: device -> "kernel:length class" -> winning variant, work group size and timings.
+
+        :param filename: JSON file, defaults to <default_cache_dir()>/tuning.json
+    """
+
+    def __init__(self, filename=None):
+        if filename is None:
+            from src.compute_session import default_cache_dir
+            filename = os.path.join(default_cache_dir(), "tuning.json")
+        self.filename = filename
+        self.entries = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename, "r") as tuning_file:
+                    self.entries = json.load(tuning_file)
+            except (OSError, ValueError):
+                # broken file, it gets replaced by the next store
+                self.entries = {}
+
+    def get(self, device, kernel_name, template_length):
+        return self.entries.get(device_key(device), {}).get(kernel_name + ":" + str(length_class(template_length)))
+
+    def put(self, device, kernel_name, template_length, result):
+        self.entries.setdefault(device_key(device), {})[
+            kernel_name + ":" + str(length_class(template_length))] = result
+        self._store()
+
+    def _store(self):
+        try:
+            directory = os.path.dirname(self.filename) or "."
+            os.makedirs(directory, exist_ok=True)
+            # write to a temporary file first so concurrent processes never read half written files
+            file_descriptor, tmp_name = tempfile.mkstemp(dir=directory)
+            with os.fdopen(file_descriptor, "w") as tuning_file:
+                json.dump(self.entries, tuning_file, indent=1, sort_keys=True)
+            os.replace(tmp_name, self.filename)
+        except OSError as e:
+            print("WARNING: could not store tuning results: " + str(e))
+
+    def clear(self):
+        self.entries = {}
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def print_results(self):
+        """
+            One line per tuned (device, kernel, length class), to compare machines.
+        """
+        print("Tuning cache (" + str(self.filename) + "):")
+        for device_name in sorted(self.entries):
+            print(device_name)
+            for key in sorted(self.entries[device_name], key=lambda key: (key.split(":")[0], int(key.split(":")[1]))):
+                result = self.entries[device_name][key]
+                print("\t" + key.ljust(28) + result["variant"].ljust(34) + ("local_size " + str(result["local_size"])).ljust(17) +
+                      str(round(result["time_sec"]*1000, 3)) + " ms (default " + str(round(result["default_time_sec"]*1000, 3)) +
+                      " ms, speedup " + str(round(result["default_time_sec"]/max(result["time_sec"], 1e-12), 2)) + "x)")
+
+
+def config_fits(device, config, template_length, stride):
+    """
+        Whether a variant / work group size combination ({"variant", "local_size"}) can run for this template length
+        and stride on the device (memory limits only).
+    """
+    options = VARIANTS[config["variant"]]
+    local_size = config["local_size"]
+    if local_size is None:
+        return "-DTEMPLATE_LOCAL" not in options and "-DDATA_LOCAL" not in options
+    if "-DTEMPLATE_CONSTANT" in options and template_length*4 > device.max_constant_buffer_size:
+        return False
+    return _scratch_floats(options, local_size, template_length, stride)*4 <= device.local_mem_size
+
+
+def _scratch_floats(options, local_size, template_length, stride):
+    floats = 0
+    if "-DTEMPLATE_LOCAL" in options:
+        floats += template_length
+    if "-DDATA_LOCAL" in options:
+        floats += (local_size-1)*stride+template_length
+    return floats
+
+
+def launch_tuned_template_kernel(session, kernel_name, config, trace_dev, n, template_dev, template_length, correlation_dev, first_idx, count, stride,
+                                 sample_options=()):
+    """
+        Enqueues the TUNED_TEMPLATE_KERNEL variant of config ({"variant", "local_size"}) for count positions
+        first_idx+j*stride and returns the event. sample_options are the build options of integer traces.
+    """
+    options = KERNELS[kernel_name][1] + VARIANTS[config["variant"]]
+    kernel = session.get_kernel(
+        TUNED_TEMPLATE_KERNEL, "correlate_tuned", options + list(sample_options))
+    local_size = config["local_size"]
+    # rounded up to whole work groups
+    global_size = count if local_size is None else (
+        (count+local_size-1)//local_size)*local_size
+    scratch = cl.LocalMemory(
+        4*max(1, _scratch_floats(options, local_size or 1, template_length, stride)))
+    return kernel(session.queue, (global_size,), None if local_size is None else (local_size,), trace_dev, correlation_dev, template_dev, scratch,
+                  np.int32(template_length), np.int32(n), np.int32(first_idx), np.int32(stride), np.int32(count))
+
+
+def tune_template_kernel(session, kernel_name, template_length, n=1 << 18, stride=1, repeats=3, tolerance=1e-3, cache=None, print_info=False):
+    """
+        Benchmarks all variants and work group sizes of one template kernel for one template length on random data
+        and stores the fastest one whose results agree with the default kernel (within tolerance relative to the
+        largest value) in the tuning cache.
+
+        :param kernel_name: "template_sad" or "template_correlation"
+        :return: the stored result dict
+    """
+    if cache is None:
+        cache = TuningCache()
+    rng = np.random.default_rng(0)
+    trace = rng.normal(size=n+template_length).astype(np.float32)
+    template_host = rng.normal(size=template_length).astype(np.float32)
+    count = (n-1)//stride+1
+    device = session.device
+    trace_dev = cl.Buffer(session.context, cl.mem_flags.READ_ONLY |
+                          cl.mem_flags.COPY_HOST_PTR, hostbuf=trace)
+    template_dev = cl.Buffer(session.context, cl.mem_flags.READ_ONLY |
+                             cl.mem_flags.COPY_HOST_PTR, hostbuf=template_host)
+    correlation_dev = cl.Buffer(
+        session.context, cl.mem_flags.READ_WRITE, count*4)
+    result_host = np.empty(count, dtype=np.float32)
+
+    def measure(launch):
+        best = None
+        for repeat in range(repeats+1):
+            t_start = perf_counter()
+            launch().wait()
+            elapsed = perf_counter()-t_start
+            # the first run includes the upload of the arguments
+            if repeat > 0:
+                best = elapsed if best is None else min(best, elapsed)
+        cl.enqueue_copy(session.queue, result_host, correlation_dev)
+        return best, result_host.copy()
+
+    default_kernel = session.get_kernel(KERNELS[kernel_name][0], "correlate")
+    default_time, reference = measure(lambda: default_kernel(session.queue, (count,), None, trace_dev, correlation_dev, template_dev,
+                                                             np.int32(template_length), np.int32(len(trace)), np.int32(0), np.int32(stride)))
+    scale = max(1e-12, float(np.max(np.abs(reference))))
+
+    timings = {}
+    best = None
+    for variant in VARIANTS:
+        kernel = session.get_kernel(
+            TUNED_TEMPLATE_KERNEL, "correlate_tuned", KERNELS[kernel_name][1]+VARIANTS[variant])
+        for local_size in LOCAL_SIZES:
+            config = {"variant": variant, "local_size": local_size}
+            if not config_fits(device, config, template_length, stride) or \
+                    (local_size is not None and local_size > kernel.get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, device)):
+                continue
+            try:
+                elapsed, result = measure(lambda: launch_tuned_template_kernel(session, kernel_name, config, trace_dev, len(trace), template_dev,
+                                                                               template_length, correlation_dev, 0, count, stride))
+            except cl.Error as e:
+                if print_info:
+                    print("\t" + variant + " / " + str(local_size) +
+                          " failed: " + str(e))
+                continue
+            if np.max(np.abs(result.astype(np.float64)-reference))/scale > tolerance:
+                if print_info:
+                    print("\t" + variant + " / " + str(local_size) +
+                          " does not match the default kernel, skipped")
+                continue
+            timings[variant + "/" + str(local_size)] = elapsed
+            if best is None or elapsed < best[0]:
+                best = (elapsed, config)
+    for buffer in (trace_dev, template_dev, correlation_dev):
+        buffer.release()
+
+    result = dict(best[1])
+    result.update({"time_sec": best[0], "default_time_sec": default_time,
+                  "template_length": int(template_length), "timings": timings})
+    cache.put(device, kernel_name, template_length, result)
+    if print_info:
+        print(kernel_name + " (template length " + str(template_length) + ", class " + str(length_class(template_length)) + "): " +
+              result["variant"] + " / local_size " + str(result["local_size"]) + ", " + str(round(best[0]*1000, 3)) +
+              " ms instead of " + str(round(default_time*1000, 3)) + " ms")
+    return result
+
+
+def autotune(session=None, template_lengths=(64, 256, 1024, 4096, 16384), kernel_names=("template_sad", "template_correlation"), n=1 << 18,
+             repeats=3, cache=None, print_info=True):
+    """
+        Tunes every kernel for one template length of each length class in template_lengths on the device of session
+        (default: the process wide session) and prints the tuning cache.
+
+        :return: the TuningCache
+    """
+    if session is None:
+        from src.compute_session import get_default_session
+        session = get_default_session()
+    if cache is None:
+        cache = TuningCache()
+    for kernel_name in kernel_names:
+        for template_length in template_lengths:
+            tune_template_kernel(session, kernel_name, template_length,
+                                 n=n, repeats=repeats, cache=cache, print_info=print_info)
+    if print_info:
+        cache.print_results()
+    return cache
@@ -0,0 +1,853 @@
+#!/usr/bin/python3
+# Compute backends for the similarity kernels. Every backend implements the same three primitives
+# (Algorithm 1 quality curves, template correlation, template SAD), the Autocorrelation_Accelerator only talks to this interface.
+#
+# The backend is picked from an explicit name, from the environment variable CO_FINDER_BACKEND or ("auto")
+# by a short micro-benchmark of all available backends.
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import numpy as np
+
+from src import numba_kernels
+from src.opencl_kernels import TEMPLATE_SAD_KERNEL, TEMPLATE_CORRELATION_KERNEL, AUTOCORR_KERNEL, AUTOSAD_KERNEL, MULTI_WIDTH_KERNEL, PREFIX_QUALITY_KERNEL, POSTPROCESS_KERNEL
+from src.prefix_quality import prefix_quality_curve
+from src.helper import detrending_filter, top_k_peaks
+from src.quantized_trace import sample_options
+
+try:
+    import pyopencl as cl
+except ImportError:
+    cl = None
+
+BACKEND_ENV_VAR = "CO_FINDER_BACKEND"
+# host memory (bytes) the CPU backends may use for one tile, unlimited if not set
+HOST_MEMORY_BUDGET_ENV_VAR = "CO_FINDER_HOST_MEMORY_BUDGET"
+
+# name -> backend class
+BACKENDS = {}
+# device / host memory for the curves of one multi-width launch (if no host memory budget is set)
+MULTI_WIDTH_BUDGET = 1 << 26
+
+
+def host_memory_budget(default=None):
+    # bytes of host memory given by CO_FINDER_HOST_MEMORY_BUDGET, default if it is not set
+    budget = os.environ.get(HOST_MEMORY_BUDGET_ENV_VAR)
+    return int(budget) if budget else default
+
+
+def _per_width(value, w):
+    # post-processing option that is either fixed or a function of the width
+    return value(w) if callable(value) else value
+
+
+def _position_window(data, positions, halo):
+    # the part of data that the positions read (halo samples from each of them) and the positions relative to it, so
+    # the CPU backends only convert that part of a long trace. It ends one sample after the last window, a position is
+    # valid if position+halo < len(data) in the part exactly if it is in data.
+    positions = np.asarray(positions, dtype=np.int64)
+    if len(positions) == 0:
+        return data[:0], positions
+    n = len(data)
+    start = min(max(0, int(positions.min())), n)
+    stop = max(start, min(n, int(positions.max())+halo+1))
+    return data[start:stop], positions-start
+
+
+def register_backend(backend_class):
+    """
+        Class decorator that makes a backend selectable by its name.
+    """
+    BACKENDS[backend_class.name] = backend_class
+    return backend_class
+
+
+class ComputeBackend:
+    """
+        Interface of a compute backend. Curves are float32 and use the invalid-position values of the OpenCL kernels:
+        0 (Pearson) / -FLT_MAX (SAD) for start positions whose rounds do not fit, 0 / -1 for template positions that do not fit.
+
+        :param session: ComputeSession, only used by the OpenCL backend
+    """
+    name = None
+    # considered by the "auto" selection
+    auto_select = True
+
+    def __init__(self, session=None):
+        self.session = session
+
+    @classmethod
+    def is_available(cls):
+        return True
+
+    def max_tile_samples(self):
+        """
+            Longest trace (in samples, including the halo) that is processed at once, None for no limit.
+            Derived from the host memory budget, a tile needs about 8 float32 values per sample.
+        """
+        budget = host_memory_budget()
+        if budget is None:
+            return None
+        return max(1, budget//(8*np.dtype(np.float32).itemsize))
+
+    def quality_curves(self, data, w_list, no_similar_rounds, metric="pearson", engine="per_width"):
+        """
+            Yields (w, quality curve) for every width in w_list. metric is "pearson" or "sad", engine "per_width", "multi_width" or "prefix_sum".
+        """
+        raise NotImplementedError
+
+    def quality_curves_async(self, data, w_list, no_similar_rounds, metric="pearson", engine="per_width"):
+        """
+            Like quality_curves, but yields (w, quality curve, event). If event is not None the curve is only complete
+            after event.wait(), meanwhile the backend already works on the next width.
+        """
+        for w, correlation_host in self.quality_curves(data, w_list, no_similar_rounds, metric, engine):
+            yield w, correlation_host, None
+
+    def quality_curve_at(self, data, w, no_similar_rounds, positions, metric="pearson"):
+        """
+            Round-similarity of width w at the given start positions only (same values as the full curve).
+        """
+        raise NotImplementedError
+
+    def quality_top_k(self, data, w, no_similar_rounds, k, metric="pearson", engine="per_width", detrend_window=None, detrend_length=None,
+                      normalize_by_max=False, suppression_radius=0):
+        """
+            Best k (score, index) pairs of the quality curve of width w after the post-processing of reduce_quality_curve.
+            Backends that keep the curve on the device override this, so only the k pairs are transferred.
+        """
+        for _, curve in self.quality_curves(data, [w], no_similar_rounds, metric, engine):
+            return reduce_quality_curve(curve, k, detrend_window, detrend_length, normalize_by_max, suppression_radius)
+
+    def quality_top_k_widths(self, data, w_list, no_similar_rounds, k, metric="pearson", engine="per_width", detrend_window=None,
+                             detrend_length=None, normalize_by_max=False, suppression_radius=0):
+        """
+            Yields (w, quality_top_k of w) for every width in w_list, detrend_window and detrend_length may be
+            functions of w. Backends that evaluate several widths in one launch override this.
+        """
+        for w in w_list:
+            yield w, self.quality_top_k(data, w, no_similar_rounds, k, metric, engine, _per_width(detrend_window, w),
+                                        _per_width(detrend_length, w), normalize_by_max, suppression_radius)
+
+    def template_correlation(self, trace, template, first_idx, count, stride=1):
+        """
+            Pearson correlation of template with trace[i:i+len(template)] for i = first_idx+j*stride, j = 0 ... count-1.
+        """
+        return self.template_correlation_at(trace, template, first_idx+stride*np.arange(count))
+
+    def template_sad(self, trace, template, first_idx, count, stride=1):
+        """
+            SAD of template with trace[i:i+len(template)] for i = first_idx+j*stride, j = 0 ... count-1.
+        """
+        return self.template_sad_at(trace, template, first_idx+stride*np.arange(count))
+
+    def template_correlation_at(self, trace, template, positions):
+        """
+            Pearson correlation of template with trace[i:i+len(template)] for every i in positions.
+        """
+        raise NotImplementedError
+
+    def template_sad_at(self, trace, template, positions):
+        """
+            SAD of template with trace[i:i+len(template)] for every i in positions.
+        """
+        raise NotImplementedError
+
+
+@register_backend
+class OpenCLBackend(ComputeBackend):
+    name = "opencl"
+
+    @classmethod
+    def is_available(cls):
+        if cl is None:
+            return False
+        try:
+            return any(len(platform.get_devices()) > 0 for platform in cl.get_platforms())
+        except cl.Error:
+            return False
+
+    def __init__(self, session=None):
+        super().__init__(session)
+        # TuningCache of src/autotuner.py, loaded on the first template search
+        self.tuning_cache = None
+
+    def get_session(self):
+        if self.session is None:
+            from src.compute_session import get_default_session
+            self.session = get_default_session()
+        return self.session
+
+    def max_tile_samples(self):
+        # every buffer has to fit into one allocation, the prefix_sum engine needs about 8 trace sized buffers at once
+        device = self.get_session().device
+        return min(device.max_mem_alloc_size, device.global_mem_size//8)//np.dtype(np.float32).itemsize
+
+    def quality_curves(self, data, w_list, no_similar_rounds, metric="pearson", engine="per_width"):
+        if engine == "multi_width":
+            for w, correlation_host in self._quality_curves_multi_width(data, w_list, no_similar_rounds, metric):
+                yield w, correlation_host
+        elif engine == "prefix_sum":
+            for w in w_list:
+                yield w, self._quality_curve_prefix_sum(data, w, no_similar_rounds)
+        else:
+            for w in w_list:
+                yield w, self._quality_curve_per_width(data, w, no_similar_rounds, metric)
+
+    def quality_curves_async(self, data, w_list, no_similar_rounds, metric="pearson", engine="per_width"):
+        # double buffered: width k+1 is enqueued before width k is handed out, its result is copied back with a
+        # non-blocking copy on the transfer queue. The programs of the upcoming widths are built in a background thread.
+        if engine == "prefix_sum":
+            for w, correlation_host, event in super().quality_curves_async(data, w_list, no_similar_rounds, metric, engine):
+                yield w, correlation_host, event
+            return
+        session = self.get_session()
+        n = len(data)
+        data_dev = session.to_device(data)
+        curve_bytes = n*np.dtype(np.float32).itemsize
+        if engine == "multi_width":
+            options = ["-DROUNDS="+str(no_similar_rounds)]+sample_options(data)
+            if metric == "sad":
+                options.append("-DMETRIC_SAD")
+            builds = [(MULTI_WIDTH_KERNEL, "quality_multi_width", options)]*len(w_list)
+        else:
+            builds = [(AUTOCORR_KERNEL if metric == "pearson" else AUTOSAD_KERNEL, "correlate", ["-DWIDTH="+str(w)]+sample_options(data))
+                      for w in w_list]
+
+        with ThreadPoolExecutor(max_workers=1) as builder:
+            programs = [builder.submit(session.get_program, source, options)
+                        for source, _, options in builds]
+            # copy event of the last curve in each of the two output buffers
+            copy_events = [None, None]
+            # per width buffers of the multi_width engine, kept until their kernels are done
+            widths_buffers = []
+            previous = None
+            for idx, w in enumerate(w_list):
+                slot = idx % 2
+                programs[idx].result()
+                source, name, options = builds[idx]
+                kernel = session.get_kernel(source, name, options)
+                quality_dev = session.scratch_buffer(
+                    "quality_pipeline_"+str(slot), curve_bytes)
+                # the buffer may only be overwritten once the previous curve in it is copied back
+                wait_for = [copy_events[slot]
+                            ] if copy_events[slot] is not None else None
+                if engine == "multi_width":
+                    widths_dev = cl.Buffer(session.context, cl.mem_flags.READ_ONLY |
+                                           cl.mem_flags.COPY_HOST_PTR, hostbuf=np.array([w], dtype=np.int32))
+                    widths_buffers.append(widths_dev)
+                    kernel_event = kernel(session.queue, (n, 1), None, data_dev, quality_dev, widths_dev, np.int32(n),
+                                          wait_for=wait_for)
+                else:
+                    kernel_event = kernel(session.queue, (n,), None, data_dev, quality_dev, np.int32(no_similar_rounds),
+                                          np.int32(n), wait_for=wait_for)
+                correlation_host = np.empty(n, dtype=np.float32)
+                copy_events[slot] = cl.enqueue_copy(session.transfer_queue, correlation_host, quality_dev,
+                                                    is_blocking=False, wait_for=[kernel_event])
+                session.queue.flush()
+                session.transfer_queue.flush()
+                if previous is not None:
+                    yield previous
+                previous = (w, correlation_host, copy_events[slot])
+            if previous is not None:
+                yield previous
+            session.transfer_queue.finish()
+            for widths_dev in widths_buffers:
+                widths_dev.release()
+
+    def quality_curve_at(self, data, w, no_similar_rounds, positions, metric="pearson"):
+        session = self.get_session()
+        quality_host = np.empty(len(positions), dtype=np.float32)
+        if len(positions) == 0:
+            return quality_host
+        data_dev = session.to_device(data)
+        options = ["-DROUNDS="+str(no_similar_rounds)]+sample_options(data)
+        if metric == "sad":
+            options.append("-DMETRIC_SAD")
+        positions_host = np.ascontiguousarray(positions, dtype=np.int32)
+        positions_dev = session.scratch_buffer(
+            "quality_positions", positions_host.nbytes)
+        cl.enqueue_copy(session.queue, positions_dev, positions_host)
+        quality_dev = session.scratch_buffer("quality", quality_host.nbytes)
+        session.get_kernel(MULTI_WIDTH_KERNEL, "quality_positions", options)(
+            session.queue, (len(positions),), None, data_dev, quality_dev, positions_dev, np.int32(w), np.int32(len(data)))
+        cl.enqueue_copy(session.queue, quality_host, quality_dev)
+        return quality_host
+
+    def template_correlation(self, trace, template, first_idx, count, stride=1):
+        return self._template_kernel(TEMPLATE_CORRELATION_KERNEL, template, trace, count, first_idx=first_idx, stride=stride)
+
+    def template_sad(self, trace, template, first_idx, count, stride=1):
+        return self._template_kernel(TEMPLATE_SAD_KERNEL, template, trace, count, first_idx=first_idx, stride=stride)
+
+    def template_correlation_at(self, trace, template, positions):
+        return self._template_kernel(TEMPLATE_CORRELATION_KERNEL, template, trace, len(positions), positions=positions)
+
+    def template_sad_at(self, trace, template, positions):
+        return self._template_kernel(TEMPLATE_SAD_KERNEL, template, trace, len(positions), positions=positions)
+
+    def _template_kernel(self, programstring, template_candidate, trace, count, first_idx=0, stride=1, positions=None):
+        # runs a template kernel for count positions of the (device-resident) trace, either first_idx+j*stride
+        # or the given positions. Only these positions are computed and copied back.
+        session = self.get_session()
+        correlation_host = np.empty(count, dtype=np.float32)
+        if count == 0:
+            return correlation_host
+        trace_dev = session.to_device(trace)
+        template_candidate_host = np.ascontiguousarray(
+            template_candidate, dtype=np.float32)
+        template_candidate_dev = cl.Buffer(
+            session.context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=template_candidate_host)
+        correlation_dev = session.scratch_buffer(
+            "template_correlation", correlation_host.nbytes)
+
+        tuned = self._tuned_template_config(programstring, len(
+            template_candidate), stride) if positions is None else None
+        if tuned is not None:
+            from src.autotuner import launch_tuned_template_kernel
+            launch_tuned_template_kernel(session, tuned[0], tuned[1], trace_dev, len(trace), template_candidate_dev, len(template_candidate),
+                                         correlation_dev, first_idx, count, stride, sample_options(trace))
+        elif positions is None:
+            kernel = session.get_kernel(
+                programstring, "correlate", sample_options(trace))
+            kernel(session.queue, (count,), None, trace_dev, correlation_dev, template_candidate_dev, np.int32(
+                len(template_candidate)), np.int32(len(trace)), np.int32(first_idx), np.int32(stride))
+        else:
+            positions_host = np.ascontiguousarray(positions, dtype=np.int32)
+            positions_dev = session.scratch_buffer(
+                "template_positions", positions_host.nbytes)
+            cl.enqueue_copy(session.queue, positions_dev, positions_host)
+            kernel = session.get_kernel(
+                programstring, "correlate_indices", sample_options(trace))
+            kernel(session.queue, (count,), None, trace_dev, correlation_dev, template_candidate_dev, np.int32(
+                len(template_candidate)), np.int32(len(trace)), positions_dev)
+        cl.enqueue_copy(session.queue, correlation_host, correlation_dev)
+        template_candidate_dev.release()
+        return correlation_host
+
+    def _tuned_template_config(self, programstring, template_length, stride):
+        # (kernel name, config) of the tuning cache for the strided template kernels, None for the default kernel.
+        # With CO_FINDER_AUTOTUNE=1 missing entries are tuned on first use.
+        from src.autotuner import AUTOTUNE_ENV_VAR, TuningCache, config_fits, tune_template_kernel
+        if self.tuning_cache is None:
+            self.tuning_cache = TuningCache()
+        kernel_name = "template_sad" if programstring == TEMPLATE_SAD_KERNEL else "template_correlation"
+        session = self.get_session()
+        config = self.tuning_cache.get(
+            session.device, kernel_name, template_length)
+        if config is None and os.environ.get(AUTOTUNE_ENV_VAR) == "1":
+            config = tune_template_kernel(
+                session, kernel_name, template_length, cache=self.tuning_cache)
+        if config is None or not config_fits(session.device, config, template_length, stride):
+            return None
+        return kernel_name, config
+
+    def _quality_curve_per_width(self, data, w, no_similar_rounds, metric):
+        # one program per width, the mean segment lives in a private array of WIDTH floats
+        session = self.get_session()
+        data_dev = session.to_device(data)
+        correlation_dev = session.scratch_buffer(
+            "quality", len(data)*np.dtype(np.float32).itemsize)
+        kernel = session.get_kernel(AUTOCORR_KERNEL if metric == "pearson" else AUTOSAD_KERNEL,
+                                    "correlate", options=["-DWIDTH="+str(w)]+sample_options(data))
+
+        # all start positions need to be considered!
+        kernel(session.queue, (len(data),), None, data_dev,
+               correlation_dev, np.int32(no_similar_rounds), np.int32(len(data)))
+
+        correlation_host = np.empty(len(data), dtype=np.float32)
+        cl.enqueue_copy(session.queue, correlation_host, correlation_dev)
+        return correlation_host
+
+    def _multi_width_batch_size(self, n, nr_widths):
+        # widths per launch: all of their curves have to fit into one device allocation and the memory budget
+        curve_bytes = n*np.dtype(np.float32).itemsize
+        budget = min(self.get_session().device.max_mem_alloc_size,
+                     host_memory_budget(MULTI_WIDTH_BUDGET))
+        return max(1, min(nr_widths, int(budget//curve_bytes)))
+
+    def _quality_curves_multi_width(self, data, w_list, no_similar_rounds, metric):
+        # one program for all widths, batches of widths are evaluated in a single 2D launch (position x width)
+        session = self.get_session()
+        n = len(data)
+        curve_bytes = n*np.dtype(np.float32).itemsize
+        widths_per_launch = self._multi_width_batch_size(n, len(w_list))
+        for batch_start in range(0, len(w_list), widths_per_launch):
+            w_batch = w_list[batch_start:batch_start+widths_per_launch]
+            quality_dev = self._quality_buffer(
+                data, w_batch, no_similar_rounds, metric, "multi_width")
+            # one curve at a time, so the host never holds more than the curve that is handed out
+            for row, w in enumerate(w_batch):
+                correlation_host = np.empty(n, dtype=np.float32)
+                cl.enqueue_copy(session.queue, correlation_host,
+                                quality_dev, src_offset=row*curve_bytes)
+                yield int(w), correlation_host
+
+    def quality_top_k(self, data, w, no_similar_rounds, k, metric="pearson", engine="per_width", detrend_window=None, detrend_length=None,
+                      normalize_by_max=False, suppression_radius=0):
+        for _, top_k in self.quality_top_k_widths(data, [w], no_similar_rounds, k, metric, engine, detrend_window, detrend_length,
+                                                  normalize_by_max, suppression_radius):
+            return top_k
+
+    def quality_top_k_widths(self, data, w_list, no_similar_rounds, k, metric="pearson", engine="per_width", detrend_window=None,
+                             detrend_length=None, normalize_by_max=False, suppression_radius=0):
+        # curves, detrended curves and the reduction stay on the device, only k pairs per width are copied back.
+        # The multi_width engine evaluates and reduces a batch of widths at once (one curve per row of the buffers).
+        n = len(data)
+        batch_size = self._multi_width_batch_size(
+            n, len(w_list)) if engine == "multi_width" else 1
+        for batch_start in range(0, len(w_list), batch_size):
+            w_batch = w_list[batch_start:batch_start+batch_size]
+            values_dev = self._quality_buffer(
+                data, w_batch, no_similar_rounds, metric, engine)
+            top_k_rows = self._reduce_rows(values_dev, n, w_batch, k, detrend_window, detrend_length,
+                                           normalize_by_max, suppression_radius)
+            for w, top_k in zip(w_batch, top_k_rows):
+                yield w, top_k
+
+    def _reduce_rows(self, values_dev, n, w_batch, k, detrend_window, detrend_length, normalize_by_max, suppression_radius):
+        # post-processing and top k of the curves of w_batch (rows of n values of values_dev)
+        session = self.get_session()
+        rows = len(w_batch)
+        float_size = np.dtype(np.float32).itemsize
+        options = ["-DTOP_K="+str(int(k))]
+        if detrend_window is not None:
+            detrended_dev = session.scratch_buffer(
+                "detrended", rows*n*float_size)
+            detrend = session.get_kernel(POSTPROCESS_KERNEL, "detrend", options)
+            for row, w in enumerate(w_batch):
+                length = n if _per_width(detrend_length, w) is None else _per_width(detrend_length, w)
+                offset = int(_per_width(detrend_window, w)/2)
+                # positions per work item: long enough to amortize summing up the first window
+                block = max(256, 2*offset)
+                detrend(session.queue, (-(-n//block),), None, values_dev, detrended_dev, np.int32(length),
+                        np.int32(offset), np.int32(n), np.int32(block), np.int32(row))
+            values_dev = detrended_dev
+        scales_dev = None
+        if normalize_by_max and detrend_window is None:
+            maxima = np.array([best[0, 0] for best in self._top_k(values_dev, n, 1, rows=rows)], dtype=np.float32)
+            scales_dev = cl.Buffer(session.context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                                   hostbuf=np.float32(1.)/maxima)
+        if suppression_radius <= 0:
+            return self._top_k(values_dev, n, k, scales_dev, rows)
+
+        # greedy peak suppression of all rows at once: best value, clear its neighbourhood, repeat (k small transfers)
+        work_dev = session.scratch_buffer("top_k_work", rows*n*float_size)
+        cl.enqueue_copy(session.queue, work_dev, values_dev,
+                        byte_count=rows*n*float_size)
+        picks_dev = session.scratch_buffer(
+            "top_k_picks", rows*np.dtype(np.int32).itemsize)
+        suppress = session.get_kernel(POSTPROCESS_KERNEL, "suppress", options)
+        picks = [[] for _ in range(rows)]
+        for _ in range(k):
+            best_rows = self._top_k(work_dev, n, 1, scales_dev, rows)
+            if all(len(best) == 0 for best in best_rows):
+                break
+            for row_picks, best in zip(picks, best_rows):
+                if len(best) > 0:
+                    row_picks.append(best[0])
+            cl.enqueue_copy(session.queue, picks_dev, np.array(
+                [best[0, 1] if len(best) > 0 else -1 for best in best_rows], dtype=np.int32))
+            suppress(session.queue, (2*int(suppression_radius)+1, rows), None, work_dev, picks_dev,
+                     np.int32(suppression_radius), np.int32(n))
+        return [np.array(row_picks).reshape(-1, 2) for row_picks in picks]
+
+    def _top_k(self, values_dev, count, k, scales_dev=None, rows=1, block=1024):
+        # every work item reduces a block of one row to its k best (value*scale of the row, index) pairs, repeated
+        # until one block per row is left. Returns one array of pairs per row.
+        session = self.get_session()
+        kernel = session.get_kernel(
+            POSTPROCESS_KERNEL, "top_k_block", ["-DTOP_K="+str(int(k))])
+        indices_dev = None
+        stage = 0
+        while True:
+            n_blocks = -(-count//block)
+            out_values_dev = session.scratch_buffer(
+                "top_k_values_"+str(stage % 2), rows*n_blocks*k*np.dtype(np.float32).itemsize)
+            out_indices_dev = session.scratch_buffer(
+                "top_k_indices_"+str(stage % 2), rows*n_blocks*k*np.dtype(np.int32).itemsize)
+            kernel(session.queue, (n_blocks, rows), None, values_dev, indices_dev, np.int32(count), np.int32(block),
+                   scales_dev, out_values_dev, out_indices_dev)
+            values_dev, indices_dev, count = out_values_dev, out_indices_dev, n_blocks*k
+            scales_dev = None
+            stage += 1
+            if n_blocks == 1:
+                break
+        values_host = np.empty((rows, k), dtype=np.float32)
+        indices_host = np.empty((rows, k), dtype=np.int32)
+        cl.enqueue_copy(session.queue, values_host, values_dev)
+        cl.enqueue_copy(session.queue, indices_host, indices_dev)
+        found = indices_host >= 0
+        return [np.column_stack((values[row_found], indices[row_found]))
+                for values, indices, row_found in zip(values_host, indices_host, found)]
+
+    def _quality_buffer(self, data, w_batch, no_similar_rounds, metric, engine):
+        # device buffer with the quality curves of the widths in w_batch, one row of len(data) values per width (the
+        # multi-width kernel gives the same values as the per-width one). prefix_sum takes a single width.
+        if engine == "prefix_sum":
+            return self._prefix_sum_buffer(data, w_batch[0], no_similar_rounds)
+        session = self.get_session()
+        n = len(data)
+        options = ["-DROUNDS="+str(no_similar_rounds)]+sample_options(data)
+        if metric == "sad":
+            options.append("-DMETRIC_SAD")
+        widths_dev = session.scratch_buffer(
+            "quality_width", len(w_batch)*np.dtype(np.int32).itemsize)
+        cl.enqueue_copy(session.queue, widths_dev,
+                        np.array(w_batch, dtype=np.int32))
+        quality_dev = session.scratch_buffer(
+            "quality", len(w_batch)*n*np.dtype(np.float32).itemsize)
+        session.get_kernel(MULTI_WIDTH_KERNEL, "quality_multi_width", options)(
+            session.queue, (n, len(w_batch)), None, session.to_device(data), quality_dev, widths_dev, np.int32(n))
+        return quality_dev
+
+    def _quality_curve_prefix_sum(self, data, w, no_similar_rounds):
+        correlation_dev = self._prefix_sum_buffer(data, w, no_similar_rounds)
+        correlation_host = np.empty(len(data), dtype=np.float32)
+        cl.enqueue_copy(self.get_session().queue,
+                        correlation_host, correlation_dev)
+        return correlation_host
+
+    def _prefix_sum_buffer(self, data, w, no_similar_rounds):
+        session = self.get_session()
+        n = len(data)
+        rounds = no_similar_rounds
+        float_size = np.dtype(np.float32).itemsize
+        # centering the trace keeps the float32 window sums small
+        offset = np.float32(np.mean(data, dtype=np.float64))
+        n_comb = n-(rounds-1)*w
+        n_windows = n-w+1
+        n_comb_windows = n_comb-w+1
+        # start positions per work item: long enough to amortize the O(R*w) start of every block
+        block = max(256, min(2*w, n//8192))
+
+        # the prefix sums are taken over voltages, integer traces are converted once on the host
+        data_dev = session.to_device(data, np.float32)
+        comb_dev = session.scratch_buffer("prefix_comb", n_comb*float_size)
+        sum_x_dev = session.scratch_buffer(
+            "prefix_sum_x", n_windows*float_size)
+        square_sum_x_dev = session.scratch_buffer(
+            "prefix_square_sum_x", n_windows*float_size)
+        sum_comb_dev = session.scratch_buffer(
+            "prefix_sum_comb", n_comb_windows*float_size)
+        square_sum_comb_dev = session.scratch_buffer(
+            "prefix_square_sum_comb", n_comb_windows*float_size)
+        correlation_dev = session.scratch_buffer("quality", n*float_size)
+
+        options = ["-DROUNDS="+str(rounds)]
+        session.get_kernel(PREFIX_QUALITY_KERNEL, "comb_sum", options)(
+            session.queue, (n_comb,), None, data_dev, comb_dev, np.int32(w), np.int32(n_comb), offset)
+        window_sums = session.get_kernel(
+            PREFIX_QUALITY_KERNEL, "window_sums", options)
+        window_sums(session.queue, (-(-n_windows//block),), None, data_dev, sum_x_dev,
+                    square_sum_x_dev, np.int32(w), np.int32(n_windows), np.int32(block), offset)
+        window_sums(session.queue, (-(-n_comb_windows//block),), None, comb_dev, sum_comb_dev,
+                    square_sum_comb_dev, np.int32(w), np.int32(n_comb_windows), np.int32(block), np.float32(0))
+        session.get_kernel(PREFIX_QUALITY_KERNEL, "quality_prefix", options)(session.queue, (-(-n//block),), None, data_dev, comb_dev, sum_x_dev, square_sum_x_dev,
+                                                                              sum_comb_dev, square_sum_comb_dev, correlation_dev, np.int32(w), np.int32(n), np.int32(block), offset)
+        return correlation_dev
+
+
+@register_backend
+class NumbaBackend(ComputeBackend):
+    # parallel CPU kernels with the float32 arithmetic of the OpenCL kernels
+    name = "numba"
+
+    def quality_curves(self, data, w_list, no_similar_rounds, metric="pearson", engine="per_width"):
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        for w in w_list:
+            if engine == "prefix_sum":
+                yield w, prefix_quality_curve(data, w, no_similar_rounds)
+            elif metric == "sad":
+                # the CPU kernels have no per-width compile step, so per_width and multi_width are the same loop
+                yield w, numba_kernels.quality_curve_sad(data, w, no_similar_rounds)
+            else:
+                yield w, numba_kernels.quality_curve_pearson(data, w, no_similar_rounds)
+
+    def quality_curve_at(self, data, w, no_similar_rounds, positions, metric="pearson"):
+        data, positions = _position_window(data, positions, no_similar_rounds*w)
+        return numba_kernels.quality_positions(np.ascontiguousarray(data, dtype=np.float32), w, no_similar_rounds,
+                                               np.ascontiguousarray(positions, dtype=np.int64), metric == "sad")
+
+    def template_correlation_at(self, trace, template, positions):
+        trace, positions = _position_window(trace, positions, len(template))
+        return numba_kernels.template_correlation(np.ascontiguousarray(trace, dtype=np.float32), np.ascontiguousarray(
+            template, dtype=np.float32), np.ascontiguousarray(positions, dtype=np.int64))
+
+    def template_sad_at(self, trace, template, positions):
+        trace, positions = _position_window(trace, positions, len(template))
+        return numba_kernels.template_sad(np.ascontiguousarray(trace, dtype=np.float32), np.ascontiguousarray(
+            template, dtype=np.float32), np.ascontiguousarray(positions, dtype=np.int64))
+
+
+@register_backend
+class NumpyBackend(ComputeBackend):
+    # float64 reference implementation without any compiled code, slow for the direct metrics
+    name = "numpy"
+    auto_select = False
+
+    # number of float64 values that are materialized at once
+    block_elements = 1 << 22
+
+    def quality_curves(self, data, w_list, no_similar_rounds, metric="pearson", engine="per_width"):
+        for w in w_list:
+            if metric == "sad":
+                yield w, self._quality_curve_sad(data, w, no_similar_rounds)
+            else:
+                # the prefix-sum curve is the exact O(N*R) evaluation in double precision
+                yield w, prefix_quality_curve(data, w, no_similar_rounds)
+
+    def quality_curve_at(self, data, w, no_similar_rounds, positions, metric="pearson"):
+        if metric == "sad":
+            return self._quality_sad_at(data, w, no_similar_rounds, positions)
+        return prefix_quality_curve(data, w, no_similar_rounds)[positions]
+
+    def _quality_curve_sad(self, data, w, no_similar_rounds):
+        return self._quality_sad_at(data, w, no_similar_rounds, np.arange(len(data)))
+
+    def _quality_sad_at(self, data, w, no_similar_rounds, positions):
+        data, positions = _position_window(data, positions, no_similar_rounds*w)
+        quality = np.full(len(positions), np.finfo(
+            np.float32).min, dtype=np.float32)
+        valid = np.nonzero((positions >= 0) & (
+            positions+no_similar_rounds*w < len(data)))[0]
+        if len(valid) == 0:
+            return quality
+        windows = np.lib.stride_tricks.sliding_window_view(
+            np.asarray(data, dtype=np.float64), w)
+        round_offsets = np.arange(no_similar_rounds)*w
+        block = max(1, self.block_elements//(no_similar_rounds*w))
+        for first in range(0, len(valid), block):
+            out = valid[first:first+block]
+            # (rounds, positions, w)
+            rounds = windows[positions[out][None, :]+round_offsets[:, None]]
+            mean_segment = np.mean(rounds, axis=0)
+            quality[out] = - \
+                np.mean(np.sum(np.abs(rounds-mean_segment), axis=2), axis=0)
+        return quality
+
+    def _template_windows(self, trace, template, positions):
+        # yields (output indices, windows) for the valid positions in blocks
+        template_length = len(template)
+        trace, positions = _position_window(trace, positions, template_length)
+        valid = np.nonzero((positions >= 0) & (
+            positions+template_length < len(trace)))[0]
+        if len(valid) == 0:
+            return
+        windows = np.lib.stride_tricks.sliding_window_view(
+            np.asarray(trace, dtype=np.float64), template_length)
+        block = max(1, self.block_elements//template_length)
+        for first in range(0, len(valid), block):
+            out = valid[first:first+block]
+            yield out, windows[positions[out]]
+
+    def template_correlation_at(self, trace, template, positions):
+        correlation = np.zeros(len(positions), dtype=np.float32)
+        centered_template = np.asarray(template, dtype=np.float64)
+        centered_template = centered_template-np.mean(centered_template)
+        for out, windows in self._template_windows(trace, template, positions):
+            centered = windows-np.mean(windows, axis=1)[:, None]
+            denominator = np.sqrt(np.sum(centered*centered, axis=1)
+                                  * np.sum(centered_template*centered_template))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                correlation[out] = centered @ centered_template/denominator
+        return correlation
+
+    def template_sad_at(self, trace, template, positions):
+        sad = np.full(len(positions), -1, dtype=np.float32)
+        template = np.asarray(template, dtype=np.float64)
+        for out, windows in self._template_windows(trace, template, positions):
+            sad[out] = np.sum(np.abs(windows-template), axis=1)
+        return sad
+
+
+def reduce_quality_curve(curve, k, detrend_window=None, detrend_length=None, normalize_by_max=False, suppression_radius=0):
+    """
+        Host version of the Algorithm 1 post-processing: moving-average detrend of the first detrend_length values
+        (all if None, the rest becomes 0) or, without detrending, division by the maximum. Returns the best k
+        (score, index) pairs like top_x_array, with greedy peak suppression if suppression_radius > 0.
+    """
+    if detrend_window is not None:
+        length = len(curve) if detrend_length is None else detrend_length
+        curve = np.concatenate((detrending_filter(
+            curve[:length], detrend_window), np.zeros(len(curve)-length)))
+    elif normalize_by_max:
+        curve = curve/curve.max(axis=0)
+    return top_k_peaks(np.asarray(curve), k, suppression_radius)
+
+
+# host memory for the full-length curves of one batch of widths in tiled_quality_curves (if no budget is set)
+TILED_CURVE_BUDGET = 1 << 28
+
+
+def _tile_start(start, n, tile_samples):
+    # the last tile is moved back so that it is as long as the others (and longer than the halo)
+    return min(start, max(0, n-tile_samples))
+
+
+def tiled_quality_curves(backend, data, w_list, no_similar_rounds, metric="pearson", engine="per_width", tile_samples=None,
+                         budget_bytes=None):
+    """
+        backend.quality_curves on tiles of at most tile_samples samples (None: backend.max_tile_samples()).
+        Every tile overlaps the next one by a halo of no_similar_rounds*max(widths) samples, so every start position sees
+        all of its rounds and the assembled curves are the same as from an untiled run (the prefix_sum engine centers
+        each tile on its own mean, which only changes the rounding).
+        The widths are processed in batches whose full-length curves fit into budget_bytes (default the host memory
+        budget or TILED_CURVE_BUDGET, at least one width per batch), every batch is yielded (and can be freed) before
+        the tiles of the next one are computed.
+    """
+    if tile_samples is None:
+        tile_samples = backend.max_tile_samples()
+    n = len(data)
+    if tile_samples is None or n <= tile_samples or len(w_list) == 0:
+        for w, curve in backend.quality_curves(data, w_list, no_similar_rounds, metric, engine):
+            yield w, curve
+        return
+
+    if budget_bytes is None:
+        budget_bytes = host_memory_budget(TILED_CURVE_BUDGET)
+    batch_size = max(1, int(budget_bytes)//(n*np.dtype(np.float32).itemsize))
+    for first in range(0, len(w_list), batch_size):
+        batch = w_list[first:first+batch_size]
+        halo = no_similar_rounds*max(batch)
+        positions_per_tile = tile_samples-halo
+        if positions_per_tile <= 0:
+            raise ValueError("tiles of " + str(tile_samples) +
+                             " samples are shorter than the halo of " + str(halo) + " samples")
+        curves = {w: np.empty(n, dtype=np.float32) for w in batch}
+        for start in range(0, n, positions_per_tile):
+            stop = min(start+positions_per_tile, n)
+            tile_start = _tile_start(start, n, tile_samples)
+            tile = data[tile_start:tile_start+tile_samples]
+            for w, curve in backend.quality_curves(tile, batch, no_similar_rounds, metric, engine):
+                curves[w][start:stop] = curve[start-tile_start:stop-tile_start]
+        for w in batch:
+            yield w, curves.pop(w)
+
+
+def tiled_template_search(function, trace, template, first_idx, count, tile_samples=None, stride=1):
+    """
+        Runs a strided template primitive (e.g. backend.template_sad) for the positions first_idx+j*stride, j < count,
+        on tiles of at most tile_samples samples that overlap by len(template) samples. Same result as the untiled call.
+    """
+    n = len(trace)
+    template_length = len(template)
+    if tile_samples is None or n <= tile_samples:
+        return function(trace, template, first_idx, count, stride)
+
+    if tile_samples <= template_length:
+        raise ValueError("tiles of " + str(tile_samples) +
+                         " samples are shorter than the template of " + str(template_length) + " samples")
+    positions_per_tile = max(1, (tile_samples-template_length-1)//stride+1)
+    result = np.empty(count, dtype=np.float32)
+    for first in range(0, count, positions_per_tile):
+        last = min(first+positions_per_tile, count)
+        start = first_idx+first*stride
+        tile_start = _tile_start(start, n, tile_samples)
+        result[first:last] = function(
+            trace[tile_start:tile_start+tile_samples], template, start-tile_start, last-first, stride)
+    return result
+
+
+def tiled_positions(function, data, positions, halo, tile_samples=None):
+    """
+        Runs function(tile, positions in the tile) for arbitrary start positions on tiles of at most tile_samples samples.
+        Every position needs halo samples after it (e.g. the template length), the results are returned in the order of positions.
+    """
+    n = len(data)
+    positions = np.asarray(positions, dtype=np.int64)
+    if tile_samples is None or n <= tile_samples:
+        return function(data, positions)
+
+    positions_per_tile = tile_samples-halo
+    if positions_per_tile <= 0:
+        raise ValueError("tiles of " + str(tile_samples) +
+                         " samples are shorter than the halo of " + str(halo) + " samples")
+    result = np.empty(len(positions), dtype=np.float32)
+    order = np.argsort(positions, kind="stable")
+    sorted_positions = positions[order]
+    first = 0
+    while first < len(order):
+        start = max(0, int(sorted_positions[first]))
+        last = int(np.searchsorted(sorted_positions,
+                   start+positions_per_tile, side="left"))
+        tile_start = _tile_start(start, n, tile_samples)
+        result[order[first:last]] = function(
+            data[tile_start:tile_start+tile_samples], sorted_positions[first:last]-tile_start)
+        first = last
+    return result
+
+
+def tiled_template_search_at(function, trace, template, positions, tile_samples=None):
+    """
+        Runs a template primitive for arbitrary positions (e.g. backend.template_sad_at) on tiles of at most tile_samples samples.
+    """
+    return tiled_positions(lambda tile, tile_positions: function(tile, template, tile_positions), trace, positions, len(template), tile_samples)
+
+
+def available_backends():
+    return [name for name, backend_class in BACKENDS.items() if backend_class.is_available()]
+
+
+_fastest_backend = None
+
+
+def select_fastest_backend(n=1 << 17, w=32, no_similar_rounds=10, print_info=False):
+    """
+        Times the direct SAD quality curve and a template SAD on a random trace with every available backend
+        that takes part in the automatic selection and returns the name of the fastest one.
+        The result is cached for the process.
+    """
+    global _fastest_backend
+    if _fastest_backend is not None:
+        return _fastest_backend
+    candidates = [name for name in available_backends()
+                  if BACKENDS[name].auto_select]
+    if len(candidates) == 0:
+        _fastest_backend = "numpy"
+    elif len(candidates) == 1:
+        _fastest_backend = candidates[0]
+    else:
+        data = np.random.default_rng(0).normal(size=n).astype(np.float32)
+        template = data[:w*no_similar_rounds]
+        times = {}
+        for name in candidates:
+            backend = BACKENDS[name]()
+
+            def run():
+                for _ in backend.quality_curves(data, [w], no_similar_rounds, metric="sad"):
+                    pass
+                backend.template_sad(data, template, 0, n)
+            # the first call compiles (or loads) the kernels
+            run()
+            t_start = perf_counter()
+            run()
+            times[name] = perf_counter()-t_start
+        _fastest_backend = min(times, key=times.get)
+        if print_info:
+            print("backend micro-benchmark: " + ", ".join(name + " " + str(round(elapsed, 4)) +
+                  " s" for name, elapsed in times.items()) + " -> " + _fastest_backend)
+    return _fastest_backend
+
+
+def get_backend(backend=None, session=None):
+    """
+        Returns a backend instance.
+
+        :param backend: a ComputeBackend instance, a registered name or "auto". None uses CO_FINDER_BACKEND and falls back to "auto"
+        :param session: ComputeSession for the OpenCL backend, None uses the process wide default session
+    """
+    if isinstance(backend, ComputeBackend):
+        return backend
+    if backend is None:
+        backend = os.environ.get(BACKEND_ENV_VAR) or "auto"
+    if backend == "auto":
+        backend = select_fastest_backend()
+    if backend not in BACKENDS:
+        raise ValueError("unknown backend: " + str(backend) +
+                         " (registered: " + ", ".join(BACKENDS) + ")")
+    if not BACKENDS[backend].is_available():
+        raise RuntimeError("backend " + str(backend) +
+                           " is not available on this machine")
+    return BACKENDS[backend](session=session)
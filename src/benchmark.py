@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+# Benchmarks and accuracy comparisons for the different similarity engines.
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+import numpy as np
+from scipy.signal import find_peaks
+
+from src.autocorrelation_accl import Autocorrelation_Accelerator
+from src.backends import available_backends
+
+
+def _time_call(function, repeats):
+    # returns (best wall time in seconds, result of the last call)
+    best = None
+    for _ in range(repeats):
+        t_start = perf_counter()
+        result = function()
+        elapsed = perf_counter()-t_start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark_template_metrics(trace, template, idx_list=[], repeats=3, session=None):
+    """
+        Times the exact SAD kernel against the FFT based SSD for one template search and checks how similar the best matches are.
+
+        :return: dict with the run times in seconds and the overlap of the best len(trace)/len(template) matches
+    """
+    accl = Autocorrelation_Accelerator(session=session)
+    sad_time, sad = _time_call(lambda: accl.calc_distance(
+        template, trace, idx_list, distance_metric="sad"), repeats)
+    ssd_time, ssd = _time_call(lambda: accl.calc_distance(
+        template, trace, idx_list, distance_metric="ssd"), repeats)
+
+    nr_matches = max(1, int(len(trace)/len(template)))
+    best_sad = set(np.argsort(sad)[:nr_matches])
+    best_ssd = set(np.argsort(ssd)[:nr_matches])
+    results = {"sad_time_sec": sad_time, "ssd_time_sec": ssd_time,
+               "best_match_overlap": len(best_sad & best_ssd)/float(nr_matches)}
+    print("Template length " + str(len(template)) + ", " + str(len(sad)) + " positions:")
+    print("\tSAD: " + str(round(sad_time, 4)) + " s")
+    print("\tSSD: " + str(round(ssd_time, 4)) + " s")
+    print("\tOverlap of the best " + str(nr_matches) + " matches: " +
+          str(round(results["best_match_overlap"]*100, 1)) + "%")
+    return results
+
+
+def compare_template_metrics(testcase, decimation_factor, metrics=("sad", "ssd"), exact_clk_cycles=None, error_margin=0.1, allowed_sub_peak_delta=2):
+    """
+        Runs the notebook workflow on a bundled testcase (find COs, refine the template with SAD) and then searches the
+        refined template once per distance metric. Prints the run time of every search and the Evaluator statistics.
+
+        :param testcase: name of the testcase as used by TraceImporter
+        :param decimation_factor: decimation factor, see the proposed factors in encapsulated_execution.ipynb
+        :return: dict metric -> dict with time_sec, hitrate, mean, std_dev and quantile_95
+    """
+    from src.trace_creator import TraceImporter
+    from src.sample_finder import SampleFinder
+    from src.refiner import Refiner
+    from src.evaluator import Evaluator
+
+    trace_container = TraceImporter(testcase).trace_container
+    trace_container.decimate_trace(decimation_factor)
+    if exact_clk_cycles is None:
+        exact_clk_cycles = trace_container.known_width_clk_cycles
+    sample_finder = SampleFinder(trace_container, exact_clk_cycles=exact_clk_cycles,
+                                 error_margin=error_margin, allowed_sub_peak_delta=allowed_sub_peak_delta)
+    sample_finder.full_auto_find_COs(sad_approach=False)
+    refined_template = Refiner(trace_container).get_template_with_sad()
+    found_start_idx = trace_container.calculated_start_idx_aes
+
+    results = {}
+    for metric in metrics:
+        t_start = perf_counter()
+        trace_container.calculated_start_idx_aes = sample_finder.find_COs_with_template(
+            refined_template, use_sad=True, distance_metric=metric)
+        elapsed = perf_counter()-t_start
+        evaluator = Evaluator(trace_container)
+        results[metric] = {"time_sec": elapsed, "hitrate": evaluator.hitrate, "mean": evaluator.mean,
+                           "std_dev": evaluator.std_dev, "quantile_95": evaluator.quantile_95}
+        trace_container.calculated_start_idx_aes = found_start_idx
+
+    print("Testcase " + str(testcase) + ":")
+    for metric in metrics:
+        print("\t" + metric + ": " + str(round(results[metric]["time_sec"], 3)) + " s, hitrate " + str(round(results[metric]["hitrate"]*100, 1)) +
+              "%, mean " + str(results[metric]["mean"]) + ", std_dev " + str(results[metric]["std_dev"]))
+    return results
+
+
+def synthetic_co_trace(n=1 << 16, w=50, no_similar_rounds=10, nr_cos=8, noise=0.3, seed=0):
+    """
+        Random noise with nr_cos embedded COs of no_similar_rounds similar rounds of w samples each.
+
+        :return: (trace as float32, sorted start indices of the COs)
+    """
+    rng = np.random.default_rng(seed)
+    co_length = w*no_similar_rounds
+    round_pattern = rng.normal(size=w)
+    # every round differs a bit from the others (like the round keys), so a CO only matches itself at one offset
+    round_differences = rng.normal(scale=0.5, size=(no_similar_rounds, w))
+    trace = rng.normal(scale=noise, size=n)
+    slots = np.arange(co_length, n-2*co_length, 2*co_length)
+    start_idx = np.sort(rng.choice(slots, size=nr_cos, replace=False))
+    for idx in start_idx:
+        rounds = round_pattern + round_differences + \
+            rng.normal(scale=noise, size=(no_similar_rounds, w))
+        trace[idx:idx+co_length] += rounds.reshape(-1)
+    return trace.astype(np.float32), start_idx
+
+
+def compare_backends(backend_names=None, w=50, no_similar_rounds=10, nr_cos=8, n=1 << 16, tolerance=1e-3, seed=0):
+    """
+        Cross-backend equivalence check: runs the quality curves of Algorithm 1 (pearson and sad) and the template
+        searches (correlation and SAD) with every backend on a synthetic trace and compares them with the first backend.
+        The indices the pipeline would pick (best start position, the nr_cos best template matches) have to be identical,
+        the values have to agree within tolerance (relative to the largest value).
+
+        :param backend_names: backends to compare, defaults to all available ones
+        :return: True if all backends agree
+    """
+    if backend_names is None:
+        backend_names = available_backends()
+    trace, start_idx = synthetic_co_trace(
+        n, w, no_similar_rounds, nr_cos, seed=seed)
+    co_length = w*no_similar_rounds
+    template = trace[start_idx[0]:start_idx[0]+co_length]
+
+    def found_matches(similarity):
+        peaks, _ = find_peaks(similarity, distance=co_length)
+        return np.sort(peaks[np.argsort(similarity[peaks])[::-1][:nr_cos]])
+
+    results = {}
+    for name in backend_names:
+        accl = Autocorrelation_Accelerator(
+            trace, no_similar_rounds, backend=name)
+        # key -> list of curves
+        curves = {}
+        for metric in ("pearson", "sad"):
+            curves[metric] = [curve for _, curve in accl.quality_curves(
+                [w-1, w], metric)]
+        curves["template_correlation"] = [accl.correlate(
+            trace, template, np.arange(n), print_times=False)]
+        sad = accl.calc_sad(template, trace)
+        curves["template_sad"] = [sad]
+        indices = {metric: np.array([np.argmax(curve) for curve in curves[metric]])
+                   for metric in ("pearson", "sad")}
+        indices["template_correlation"] = found_matches(
+            curves["template_correlation"][0])
+        # positions without a full window are marked with -1
+        indices["template_sad"] = found_matches(-np.where(sad < 0, sad.max(), sad))
+        results[name] = (curves, indices)
+
+    all_equal = True
+    reference_name = backend_names[0]
+    reference_curves, reference_indices = results[reference_name]
+    for name in backend_names[1:]:
+        curves, indices = results[name]
+        for key in reference_curves:
+            max_diff = 0.
+            for reference, other in zip(reference_curves[key], curves[key]):
+                valid = reference > np.finfo(np.float32).min
+                scale = max(1e-12, np.max(np.abs(reference[valid])))
+                max_diff = max(max_diff, np.max(
+                    np.abs(reference.astype(np.float64)-other))/scale)
+            same_indices = np.array_equal(reference_indices[key], indices[key])
+            ok = same_indices and max_diff <= tolerance
+            all_equal = all_equal and ok
+            print(reference_name + " vs " + name + ", " + key + ": max relative difference " + str(max_diff) +
+                  (", same indices" if same_indices else ", DIFFERENT indices") + ("" if ok else " -> MISMATCH"))
+    print("template SAD finds the embedded COs: " +
+          str(np.array_equal(reference_indices["template_sad"], start_idx)))
+    return all_equal
+
+
+def _first_and_steady_times(backend_name, n, w, no_similar_rounds, repeats, warm_up):
+    # runs in a fresh process, so the first call includes compiling (or loading the numba disk cache / OpenCL programs)
+    trace, _ = synthetic_co_trace(n, w, no_similar_rounds)
+    timings = {"warm_up": 0.}
+    if warm_up and backend_name == "numba":
+        from src.numba_kernels import warm_up as numba_warm_up
+        timings["warm_up"] = numba_warm_up()
+    t_start = perf_counter()
+    accl = Autocorrelation_Accelerator(trace, no_similar_rounds, backend=backend_name)
+    list(accl.quality_curves([w], "sad"))
+    timings["first_result"] = timings["warm_up"] + perf_counter()-t_start
+    timings["steady_state"], _ = _time_call(
+        lambda: list(accl.quality_curves([w], "sad")), repeats)
+    timings["throughput"] = n/timings["steady_state"]
+    return timings
+
+
+def benchmark_time_to_first_result(backend_names=None, n=1 << 20, w=50, no_similar_rounds=10, repeats=3, warm_up=False):
+    """
+        Time to the first quality curve of a new process (warm up, compilation / cache loading and the first call) and
+        the steady-state time of the same call (best of repeats), reported separately.
+        The numba functions are cached on disk, so only the very first run after a change compiles them.
+
+        :param warm_up: call src.numba_kernels.warm_up before the first call (like the worker processes of the scheduler)
+        :return: dict backend name -> dict with warm_up, first_result and steady_state in seconds and throughput in
+                 start positions per second
+    """
+    if backend_names is None:
+        backend_names = available_backends()
+    results = {}
+    for name in backend_names:
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            timings = executor.submit(_first_and_steady_times, name, n, w,
+                                      no_similar_rounds, repeats, warm_up).result()
+        results[name] = timings
+        print(name + ": first result after " + str(timings["first_result"]) + " s (warm up " +
+              str(timings["warm_up"]) + " s), steady state " + str(timings["steady_state"]) + " s = " +
+              str(timings["throughput"]/1e6) + " M positions/s")
+    return results
+
+
+# plotting and export stacks that the compute path must not import (see the lazy imports in src/helper.py)
+PLOTTING_MODULES = ("matplotlib", "tikzplotlib", "holoviews", "bokeh", "pandas")
+COMPUTE_MODULES = ("src.autocorrelation_accl", "src.sample_finder", "src.refiner", "src.trace_creator",
+                   "src.scheduler", "src.helper", "src.trace_container", "src.benchmark")
+
+
+def check_headless_imports(modules=COMPUTE_MODULES, max_seconds=10.):
+    """
+        Import regression check of the compute path: imports modules in a fresh interpreter (like a headless worker)
+        and fails if that loads any of PLOTTING_MODULES or takes longer than max_seconds.
+
+        :return: (ok, import time in seconds, names of the loaded plotting modules)
+    """
+    code = ("import json, sys, time\n"
+            "t_start = time.perf_counter()\n"
+            "for name in " + repr(list(modules)) + ":\n"
+            "    __import__(name)\n"
+            "elapsed = time.perf_counter()-t_start\n"
+            "print(json.dumps([elapsed, sorted(sys.modules)]))\n")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, "-c", code], cwd=root, check=True,
+                            capture_output=True, text=True).stdout
+    elapsed, loaded = json.loads(output.splitlines()[-1])
+    plotting = [name for name in loaded if name.split(".")[0] in PLOTTING_MODULES]
+    ok = not plotting and elapsed <= max_seconds
+    print("headless imports: " + str(elapsed) + " s" + ("" if not plotting else ", plotting modules loaded: " +
+          ", ".join(sorted({name.split(".")[0] for name in plotting}))) + ("" if ok else " -> FAILED"))
+    return ok, elapsed, plotting
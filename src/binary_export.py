@@ -0,0 +1,255 @@
+#!/usr/bin/python3
+# Binary export of long traces, similarity curves and CO segment sets. The arrays are written in blocks (memory mapped
+# inputs are never loaded completely) to .npy files, raw append-only .bin files or chunked HDF5, the metadata (fs,
+# decimation factor, width, start indices, ...) goes to a JSON sidecar next to them. load_binary maps them back.
+import json
+import os
+
+import numpy as np
+
+from src.quantized_trace import QuantizedTrace
+
+BINARY_MODES = ("npy", "memmap", "hdf5")
+EXTENSIONS = {"npy": ".npy", "memmap": ".bin", "hdf5": ".h5"}
+# samples per written block
+BLOCK_SIZE = 1 << 20
+# samples per HDF5 chunk
+HDF5_CHUNK_SIZE = 1 << 16
+# name of a single (not dict) array in the sidecar and the HDF5 file
+DATA_NAME = "data"
+
+
+def sidecar_filename(filename):
+    return filename + ".json"
+
+
+def _json_value(value):
+    # numpy scalars and arrays as plain python values
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_json_value(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _json_value(item) for key, item in value.items()}
+    return value
+
+
+def write_sidecar(filename, sidecar):
+    with open(sidecar_filename(filename), "w") as sidecar_file:
+        json.dump(_json_value(sidecar), sidecar_file, indent=1)
+
+
+def read_sidecar(filename):
+    with open(sidecar_filename(filename)) as sidecar_file:
+        return json.load(sidecar_file)
+
+
+def _array_filename(filename, name, mode):
+    # one file per array for npy / memmap, dict columns get their name appended
+    if name == DATA_NAME:
+        return filename + EXTENSIONS[mode]
+    return filename + "." + name + EXTENSIONS[mode]
+
+
+def _rows_per_block(shape, block_size):
+    return max(1, block_size//max(1, int(np.prod(shape[1:]))))
+
+
+def _source(data, block_size):
+    # (shape, dtype, (start, block) iterator, quantization) of an array, memmap, list or QuantizedTrace
+    quantization = None
+    if isinstance(data, QuantizedTrace):
+        quantization = {"gain": data.gain, "offset": data.offset}
+        data = data.codes
+    elif not hasattr(data, "shape"):
+        data = np.asarray(data)
+    first = np.asarray(data[:1])
+    shape = (len(data),)+first.shape[1:]
+    rows = _rows_per_block(shape, block_size)
+    blocks = ((start, np.asarray(data[start:start+rows]))
+              for start in range(0, len(data), rows))
+    return shape, first.dtype, blocks, quantization
+
+
+def _write_raw(path, dtype, blocks):
+    with open(path, "wb") as raw_file:
+        for _, block in blocks:
+            np.ascontiguousarray(block, dtype=dtype).tofile(raw_file)
+
+
+def _write_npy(path, shape, dtype, blocks):
+    if shape[0] == 0:
+        np.save(path, np.zeros(shape, dtype=dtype))
+        return
+    array = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+    for start, block in blocks:
+        array[start:start+len(block)] = block
+    array.flush()
+    del array
+
+
+def _write_hdf5(path, sources):
+    import h5py
+    with h5py.File(path, "w") as h5_file:
+        for name, (shape, dtype, blocks, _) in sources.items():
+            chunks = (max(1, min(shape[0], _rows_per_block(shape, HDF5_CHUNK_SIZE))),)+shape[1:]
+            # unlimited first axis, so the dataset can be extended later
+            dataset = h5_file.create_dataset(name, shape=shape, dtype=dtype, chunks=chunks,
+                                             maxshape=(None,)+shape[1:])
+            for start, block in blocks:
+                dataset[start:start+len(block)] = block
+
+
+def _save_sources(filename, sources, mode, metadata, columns):
+    if mode not in BINARY_MODES:
+        raise ValueError("unknown mode: " + str(mode))
+    if mode == "hdf5":
+        files = [filename + EXTENSIONS[mode]]
+        _write_hdf5(files[0], sources)
+    else:
+        files = []
+        for name, (shape, dtype, blocks, _) in sources.items():
+            files.append(_array_filename(filename, name, mode))
+            if mode == "npy":
+                _write_npy(files[-1], shape, dtype, blocks)
+            else:
+                _write_raw(files[-1], dtype, blocks)
+    arrays = {name: {"shape": list(shape), "dtype": np.dtype(dtype).str, "quantization": quantization}
+              for name, (shape, dtype, _, quantization) in sources.items()}
+    write_sidecar(filename, {"mode": mode, "columns": columns,
+                  "arrays": arrays, "metadata": metadata or {}})
+    return files
+
+
+def save_binary(filename, data, mode="npy", metadata=None, block_size=BLOCK_SIZE):
+    """
+        Writes data in blocks of block_size samples to filename + extension of mode and metadata (dict of JSON
+        serializable values, numpy values are converted) to the sidecar filename + ".json".
+        A QuantizedTrace is stored as its codes (gain and offset go to the sidecar).
+
+        :param data: array (any number of dimensions, blocks are taken along the first axis), memmap, QuantizedTrace or
+                     dict column name -> array (like Exporter.export_dict)
+        :param mode: "npy" (one .npy file per array), "memmap" (one raw .bin file per array, see ArrayAppender) or
+                     "hdf5" (one .h5 file with a chunked dataset per array, needs h5py)
+        :return: list of the written files (without the sidecar)
+    """
+    columns = isinstance(data, dict)
+    arrays = {str(name): array for name, array in data.items()
+              } if columns else {DATA_NAME: data}
+    sources = {name: _source(array, block_size) for name, array in arrays.items()}
+    return _save_sources(filename, sources, mode, metadata, columns)
+
+
+def save_segments(filename, trace, start_idx, length, mode="npy", metadata=None, block_size=BLOCK_SIZE):
+    """
+        Writes the CO segments trace[start:start+length] of all start indices as one (segments x length) array
+        (blocks of about block_size samples are cut at a time), start_idx and length are added to the metadata.
+    """
+    start_idx = np.asarray(start_idx, dtype=np.int64)
+    length = int(length)
+    if np.any(start_idx < 0) or np.any(start_idx+length > len(trace)):
+        raise ValueError("all segments have to lie inside the trace")
+    shape, dtype, _, quantization = _source(trace[:0], block_size)
+    shape = (len(start_idx), length)
+    rows = _rows_per_block(shape, block_size)
+    source = trace.codes if isinstance(trace, QuantizedTrace) else trace
+    blocks = ((first, np.stack([np.asarray(source[start:start+length]) for start in start_idx[first:first+rows]]))
+              for first in range(0, len(start_idx), rows))
+    metadata = dict(metadata or {}, start_idx=start_idx, length=length)
+    return _save_sources(filename, {DATA_NAME: (shape, dtype, blocks, quantization)}, mode, metadata, False)
+
+
+def _load_array(path, mode, name, info):
+    shape = tuple(info["shape"])
+    dtype = np.dtype(info["dtype"])
+    if mode == "npy":
+        array = np.load(path, mmap_mode="r")
+    elif mode == "hdf5":
+        import h5py
+        # the dataset keeps the file open and reads lazily (like a memmap)
+        array = h5py.File(path, "r")[name]
+    elif shape[0] == 0:
+        array = np.zeros(shape, dtype=dtype)
+    else:
+        array = np.memmap(path, dtype=dtype, mode="r", shape=shape)
+    if info["quantization"] is not None:
+        return QuantizedTrace(array, info["quantization"]["gain"], info["quantization"]["offset"])
+    return array
+
+
+def load_binary(filename):
+    """
+        Counterpart of save_binary / save_segments / ArrayAppender: (data, metadata), the arrays are memory mapped
+        (read only) or h5py datasets, so they are read at disk speed on access.
+    """
+    sidecar = read_sidecar(filename)
+    mode = sidecar["mode"]
+    arrays = {}
+    for name, info in sidecar["arrays"].items():
+        path = filename + EXTENSIONS[mode] if mode == "hdf5" else _array_filename(filename, name, mode)
+        arrays[name] = _load_array(path, mode, name, info)
+    data = arrays if sidecar["columns"] else arrays[DATA_NAME]
+    return data, sidecar["metadata"]
+
+
+class ArrayAppender:
+    """
+        Raw binary file (filename + ".bin") that grows block by block, e.g. for curves that are computed tile by tile.
+        The sidecar is written on flush / close and holds the valid length, load_binary memory maps the file.
+
+        :param row_shape: shape of one entry (() for 1d arrays)
+        :param append: continue an existing file (data written after its last flush is dropped)
+    """
+
+    def __init__(self, filename, dtype=np.float32, row_shape=(), metadata=None, append=False):
+        self.filename = filename
+        self.path = filename + EXTENSIONS["memmap"]
+        self.metadata = dict(metadata or {})
+        if append and os.path.exists(sidecar_filename(filename)):
+            sidecar = read_sidecar(filename)
+            if sidecar["mode"] != "memmap" or sidecar["columns"]:
+                raise ValueError(filename + " is no appendable array")
+            info = sidecar["arrays"][DATA_NAME]
+            self.dtype = np.dtype(info["dtype"])
+            self.row_shape = tuple(info["shape"][1:])
+            self.length = info["shape"][0]
+            self.metadata = dict(sidecar["metadata"], **self.metadata)
+            self._file = open(self.path, "r+b")
+            self._file.truncate(self.length*self._row_bytes())
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self.dtype = np.dtype(dtype)
+            self.row_shape = tuple(row_shape)
+            self.length = 0
+            self._file = open(self.path, "wb")
+
+    def _row_bytes(self):
+        return int(np.prod(self.row_shape))*self.dtype.itemsize
+
+    def append(self, block):
+        block = np.ascontiguousarray(block, dtype=self.dtype)
+        if block.shape[1:] != self.row_shape:
+            raise ValueError("block of shape " + str(block.shape) +
+                             " does not fit rows of shape " + str(self.row_shape))
+        block.tofile(self._file)
+        self.length += len(block)
+
+    def flush(self):
+        self._file.flush()
+        write_sidecar(self.filename, {"mode": "memmap", "columns": False,
+                                      "arrays": {DATA_NAME: {"shape": [self.length]+list(self.row_shape),
+                                                             "dtype": self.dtype.str, "quantization": None}},
+                                      "metadata": self.metadata})
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+import hashlib
+import os
+import tempfile
+from time import perf_counter
+
+import numpy as np
+import pyopencl as cl
+
+from src.quantized_trace import QuantizedTrace
+
+
+def default_cache_dir():
+    """
+        Directory for persistent caches. CO_FINDER_CACHE_DIR overrides the default ~/.cache/co-finder (or $XDG_CACHE_HOME/co-finder).
+    """
+    if os.environ.get("CO_FINDER_CACHE_DIR"):
+        return os.environ["CO_FINDER_CACHE_DIR"]
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "co-finder")
+
+
+class ProgramCache:
+    """
+        On-disk cache of compiled OpenCL program binaries.
+        Entries are keyed by the kernel source, the build options and the identity of device, driver and platform,
+        so a rerun (or a fresh process) loads the binary instead of compiling the kernel again.
+
+        :param cache_dir: where the binaries are stored, defaults to <default_cache_dir()>/opencl
+        :param enabled: if False (or CO_FINDER_NO_PROGRAM_CACHE is set) everything is compiled from source
+    """
+
+    def __init__(self, cache_dir=None, enabled=True):
+        if cache_dir is None:
+            cache_dir = os.path.join(default_cache_dir(), "opencl")
+        self.cache_dir = cache_dir
+        self.enabled = enabled and not os.environ.get(
+            "CO_FINDER_NO_PROGRAM_CACHE")
+        self.hits = 0
+        self.misses = 0
+        self.load_time_sec = 0.
+        self.compile_time_sec = 0.
+
+    def key(self, source, options, device):
+        identity = [source, " ".join(options), device.name, device.vendor, device.version,
+                    device.driver_version, device.platform.name, device.platform.version, cl.VERSION_TEXT]
+        return hashlib.sha256("\0".join(identity).encode("utf-8")).hexdigest()
+
+    def build(self, context, source, options=()):
+        """
+            Returns the built program, loaded from the cache if possible, otherwise compiled and stored.
+        """
+        options = list(options)
+        device = context.devices[0]
+        if self.enabled:
+            filename = os.path.join(
+                self.cache_dir, self.key(source, options, device) + ".bin")
+            if os.path.exists(filename):
+                t_start = perf_counter()
+                try:
+                    with open(filename, "rb") as binary_file:
+                        binary = binary_file.read()
+                    program = cl.Program(context, [device], [
+                                         binary]).build(options=options)
+                    self.hits += 1
+                    self.load_time_sec += perf_counter()-t_start
+                    return program
+                except (cl.Error, OSError):
+                    # stale or broken entry, it gets replaced below
+                    pass
+
+        t_start = perf_counter()
+        program = cl.Program(context, source).build(options=options)
+        self.misses += 1
+        self.compile_time_sec += perf_counter()-t_start
+        if self.enabled:
+            self._store(filename, program)
+        return program
+
+    def _store(self, filename, program):
+        try:
+            binary = program.get_info(cl.program_info.BINARIES)[0]
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # write to a temporary file first so concurrent processes never read half written binaries
+            file_descriptor, tmp_name = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(file_descriptor, "wb") as binary_file:
+                binary_file.write(binary)
+            os.replace(tmp_name, filename)
+        except (cl.Error, OSError) as e:
+            print("WARNING: could not store OpenCL program in cache: " + str(e))
+
+    def clear(self):
+        if os.path.isdir(self.cache_dir):
+            for filename in os.listdir(self.cache_dir):
+                if filename.endswith(".bin"):
+                    os.remove(os.path.join(self.cache_dir, filename))
+
+    def print_stats(self):
+        print("OpenCL program cache (" + str(self.cache_dir) + "): " + str(self.hits) + " hits (loaded in " + str(round(self.load_time_sec, 3)) +
+              " s), " + str(self.misses) + " misses (compiled in " + str(round(self.compile_time_sec, 3)) + " s)")
+
+
+class ComputeSession:
+    """
+        Long-lived OpenCL state that is shared by the SampleFinder, the Refiner and every Autocorrelation_Accelerator of a run.
+        It owns the device selection, the command queue, the compiled programs and device-resident copies of the traces,
+        so that a trace is uploaded once and every kernel is built once per process.
+
+        :param context: an existing pyopencl context. If None, one is created without prompting (respects PYOPENCL_CTX).
+        :param max_resident_traces: number of host arrays that are kept on the device at the same time
+        :param print_info: print which device is used
+        :param program_cache: ProgramCache for compiled kernels, defaults to the on-disk cache in the user cache directory
+    """
+
+    def __init__(self, context=None, max_resident_traces=2, print_info=False, program_cache=None):
+        if context is None:
+            context = cl.create_some_context(interactive=False)
+        self.context = context
+        self.device = context.devices[0]
+        self.queue = cl.CommandQueue(context)
+        # second in-order queue for non-blocking device -> host copies, so they overlap with the kernels on queue
+        self.transfer_queue = cl.CommandQueue(context)
+        self.max_resident_traces = max_resident_traces
+        if program_cache is None:
+            program_cache = ProgramCache()
+        self.program_cache = program_cache
+
+        self._programs = {}
+        self._kernels = {}
+        # list of (host_array, device_array, device_buffer), most recently used last
+        self._resident = []
+        self._scratch = {}
+        if print_info:
+            print("ComputeSession uses device: " + str(self.device.name) +
+                  " (" + str(self.device.platform.name) + ")")
+
+    def get_program(self, source, options=()):
+        """
+            Returns the built program for source and build options. Every combination is only compiled once per session.
+        """
+        options = tuple(options)
+        key = (source, options)
+        if key not in self._programs:
+            self._programs[key] = self.program_cache.build(
+                self.context, source, options)
+        return self._programs[key]
+
+    def get_kernel(self, source, name, options=()):
+        """
+            Returns the kernel called name of the program for source and build options. The kernel object is reused.
+        """
+        key = (source, tuple(options), name)
+        if key not in self._kernels:
+            self._kernels[key] = cl.Kernel(
+                self.get_program(source, options), name)
+        return self._kernels[key]
+
+    def to_device(self, host_array, dtype=None):
+        """
+            Returns a READ_ONLY buffer that holds host_array converted to dtype.
+            dtype None keeps the integer codes of a QuantizedTrace (the kernels convert them, see sample_options)
+            and converts everything else to float32.
+            The buffer is cached for as long as the very same host array object is passed in again.
+        """
+        if dtype is None:
+            dtype = host_array.codes.dtype if isinstance(
+                host_array, QuantizedTrace) else np.float32
+        dtype = np.dtype(dtype)
+        for idx, entry in enumerate(self._resident):
+            if entry[0] is host_array and entry[1].dtype == dtype:
+                # move to the end, it is the most recently used one now
+                self._resident.append(self._resident.pop(idx))
+                return entry[2]
+
+        if isinstance(host_array, QuantizedTrace) and dtype == host_array.codes.dtype:
+            device_array = np.ascontiguousarray(host_array.codes)
+        else:
+            device_array = np.ascontiguousarray(host_array, dtype=dtype)
+        buffer = cl.Buffer(self.context, cl.mem_flags.READ_ONLY |
+                           cl.mem_flags.COPY_HOST_PTR, hostbuf=device_array)
+        self._resident.append((host_array, device_array, buffer))
+        while len(self._resident) > self.max_resident_traces:
+            self._resident.pop(0)[2].release()
+        return buffer
+
+    def scratch_buffer(self, name, nbytes, flags=cl.mem_flags.READ_WRITE):
+        """
+            Returns a device buffer of at least nbytes that is reused between calls with the same name.
+        """
+        buffer = self._scratch.get(name)
+        if buffer is None or buffer.size < nbytes:
+            if buffer is not None:
+                buffer.release()
+            buffer = cl.Buffer(self.context, flags, max(1, int(nbytes)))
+            self._scratch[name] = buffer
+        return buffer
+
+    def release(self, host_array=None):
+        """
+            Frees the device copy of host_array, or all device buffers of the session if host_array is None.
+        """
+        for idx in reversed(range(len(self._resident))):
+            if host_array is None or self._resident[idx][0] is host_array:
+                self._resident.pop(idx)[2].release()
+        if host_array is None:
+            for buffer in self._scratch.values():
+                buffer.release()
+            self._scratch = {}
+
+
+_default_session = None
+
+
+def get_default_session():
+    """
+        Returns the process wide ComputeSession, it is created on first use.
+    """
+    global _default_session
+    if _default_session is None:
+        _default_session = ComputeSession()
+    return _default_session
+
+
+def set_default_session(session):
+    global _default_session
+    _default_session = session
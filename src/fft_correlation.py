@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+# O(N log L) template matching: the sliding dot product of the template with the trace is computed with an
+# overlap-save FFT convolution, the mean/variance of every window comes from rolling window sums.
+import numpy as np
+import scipy.fft
+
+from src.helper import block_window_sum
+
+
+class RollingStatsCache:
+    """
+        Caches the window sums (sum x, sum x^2) of a trace per window length, so repeated template searches on
+        the same trace (e.g. one per width or one per refinement round) only compute them once.
+        Entries are kept for the very same trace object, at most max_entries of them.
+    """
+
+    def __init__(self, max_entries=4):
+        self.max_entries = max_entries
+        # list of (trace, window_length, offset, window_sum, window_square_sum), most recently used last
+        self._entries = []
+
+    def get(self, trace, window_length):
+        """
+            Returns (offset, window_sum, window_square_sum) of the trace centered by offset for all
+            len(trace)-window_length+1 windows.
+        """
+        for idx, entry in enumerate(self._entries):
+            if entry[0] is trace and entry[1] == window_length:
+                self._entries.append(self._entries.pop(idx))
+                return entry[2:]
+        offset = np.mean(trace, dtype=np.float64)
+        centered = np.asarray(trace, dtype=np.float64) - offset
+        window_sum = block_window_sum(centered, window_length)
+        window_square_sum = block_window_sum(
+            centered*centered, window_length)
+        self._entries.append(
+            (trace, window_length, offset, window_sum, window_square_sum))
+        while len(self._entries) > self.max_entries:
+            self._entries.pop(0)
+        return offset, window_sum, window_square_sum
+
+    def clear(self):
+        self._entries = []
+
+
+rolling_stats_cache = RollingStatsCache()
+
+
+def fft_cross_correlation(x, template, count, fft_len=None, chunks_per_batch=32, workers=-1):
+    """
+        Returns c[i] = sum_j template[j]*x[i+j] for i = 0 ... count-1 (float64) using overlap-save.
+
+        :param fft_len: FFT length, defaults to a fast length of at least 4*len(template)
+        :param chunks_per_batch: number of FFT chunks that are transformed at once (bounds the memory)
+        :param workers: threads used by scipy.fft (-1 = all cores)
+    """
+    template_length = len(template)
+    if fft_len is None:
+        fft_len = scipy.fft.next_fast_len(
+            max(4*template_length, 1 << 15), real=True)
+    step = fft_len-template_length+1
+    template_spectrum = np.conj(scipy.fft.rfft(
+        np.asarray(template, dtype=np.float64), fft_len))
+
+    result = np.empty(count, dtype=np.float64)
+    chunk_starts = np.arange(0, count, step)
+    for batch_start in range(0, len(chunk_starts), chunks_per_batch):
+        starts = chunk_starts[batch_start:batch_start+chunks_per_batch]
+        segments = np.zeros((len(starts), fft_len), dtype=np.float64)
+        for row, start in enumerate(starts):
+            segment = x[start:start+fft_len]
+            segments[row, :len(segment)] = segment
+        spectra = scipy.fft.rfft(segments, axis=-1, workers=workers)
+        spectra *= template_spectrum
+        correlated = scipy.fft.irfft(
+            spectra, fft_len, axis=-1, workers=workers)
+        for row, start in enumerate(starts):
+            valid = min(step, count-start)
+            result[start:start+valid] = correlated[row, :valid]
+    return result
+
+
+def normalized_cross_correlation(trace, template, first_idx=0, count=None, stats_cache=rolling_stats_cache):
+    """
+        Pearson correlation of template with trace[i:i+len(template)] for i = first_idx ... first_idx+count-1.
+        Same semantics as the OpenCL correlate kernel: 0 where i+len(template) >= len(trace). Returns float32.
+    """
+    n = len(trace)
+    template_length = len(template)
+    if count is None:
+        count = n-first_idx
+    correlation = np.zeros(count, dtype=np.float32)
+    valid_count = min(count, n-template_length-first_idx)
+    if valid_count <= 0:
+        return correlation
+
+    offset, window_sum, window_square_sum = stats_cache.get(
+        trace, template_length)
+    centered_template = np.asarray(template, dtype=np.float64)
+    centered_template = centered_template - np.mean(centered_template)
+    # sum over the centered template removes the mean of the window from the dot product
+    numerator = fft_cross_correlation(np.asarray(
+        trace[first_idx:first_idx+valid_count+template_length-1], dtype=np.float64) - offset, centered_template, valid_count)
+    window_sum = window_sum[first_idx:first_idx+valid_count]
+    window_variance = window_square_sum[first_idx:first_idx +
+                                        valid_count] - window_sum*window_sum/template_length
+    denominator = np.sqrt(np.maximum(window_variance, 0)
+                          * np.sum(centered_template*centered_template))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation[:valid_count] = np.where(
+            denominator > 0, numerator/denominator, 0)
+    return correlation
+
+
+def sum_of_squared_differences(trace, template, first_idx=0, count=None, stats_cache=rolling_stats_cache):
+    """
+        SSD of template with trace[i:i+len(template)] for i = first_idx ... first_idx+count-1, computed as
+        sum t^2 - 2*(t correlated with x) + rolling sum x^2. Same edge semantics as the OpenCL SAD kernel:
+        -1 where i+len(template) >= len(trace). Returns float32.
+    """
+    n = len(trace)
+    template_length = len(template)
+    if count is None:
+        count = n-first_idx
+    ssd = np.full(count, -1, dtype=np.float32)
+    valid_count = min(count, n-template_length-first_idx)
+    if valid_count <= 0:
+        return ssd
+
+    # differences do not change if template and trace are both shifted by the trace mean
+    offset, window_sum, window_square_sum = stats_cache.get(
+        trace, template_length)
+    centered_template = np.asarray(template, dtype=np.float64) - offset
+    dot_product = fft_cross_correlation(np.asarray(
+        trace[first_idx:first_idx+valid_count+template_length-1], dtype=np.float64) - offset, centered_template, valid_count)
+    ssd[:valid_count] = np.maximum(np.sum(centered_template*centered_template) - 2*dot_product +
+                                   window_square_sum[first_idx:first_idx+valid_count], 0)
+    return ssd
@@ -2,19 +2,18 @@
 import numpy as np
 import scipy
 
-import matplotlib.pyplot as plt
-import tikzplotlib
-import holoviews as hv
-from bokeh.plotting import figure, show
-from bokeh.io import output_notebook, reset_output, save, output_file
-from bokeh.palettes import Dark2_5 as palette
-
+# the plotting and export stacks (matplotlib, tikzplotlib, holoviews, bokeh, pandas) are imported by the functions that
+# use them, so the compute path (and every headless worker process) starts without them
 import os
-from numba import jit
+import collections
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from numba import jit, float32, float64, int16
 from scipy import signal
 import itertools
 
-import pandas as pd
+from src.lod_pyramid import MinMaxPyramid
+from src.binary_export import save_binary, save_segments
 
 
 # printlvl="debug"
@@ -59,24 +58,127 @@ def odd(number):
         return number
 
 
-@jit(nopython=True)
-def detrending_filter(y, windowsize):
+def _detrended_range(segment, segment_start, first, last, offset, n):
+    # detrended values first ... last-1 of a signal of length n, segment = y[segment_start:...] holds all of their windows
+    cumulative = np.zeros(len(segment)+1, dtype=np.float64)
+    np.cumsum(segment, dtype=np.float64, out=cumulative[1:])
+    idx = np.arange(first, last)
+    lo = np.maximum(0, idx-offset)-segment_start
+    hi = np.minimum(n-1, idx+offset)-segment_start
+    # an empty window gives NaN like np.mean
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = (cumulative[hi]-cumulative[lo])/(hi-lo)
+    return segment[idx-segment_start]-mean
+
+
+class StreamingDetrender:
+    """
+        detrending_filter for a signal that arrives in chunks of any length (e.g. tiles or a memory mapped file):
+        push returns every detrended value whose window is complete, finish the rest. The concatenated outputs are
+        the same as detrending_filter of the whole signal, only windowsize samples are buffered.
+    """
+
+    def __init__(self, windowsize, dtype=np.float64):
+        self.offset = int(windowsize/2)
+        self.dtype = dtype
+        # buffered samples start at buffer_start, the next output is position
+        self._buffer = np.zeros(0, dtype=np.float64)
+        self._buffer_start = 0
+        self._position = 0
+
+    def push(self, chunk):
+        self._buffer = np.concatenate(
+            (self._buffer, np.asarray(chunk, dtype=np.float64)))
+        seen = self._buffer_start+len(self._buffer)
+        # the window of i ends at i+offset as long as the signal is longer than that
+        return self._emit(max(self._position, seen-self.offset), None)
+
+    def finish(self):
+        seen = self._buffer_start+len(self._buffer)
+        return self._emit(seen, seen)
+
+    def _emit(self, last, n):
+        first = self._position
+        if n is None:
+            n = self._buffer_start+len(self._buffer)+1
+        result = _detrended_range(
+            self._buffer, self._buffer_start, first, last, self.offset, n).astype(self.dtype)
+        self._position = last
+        # keep the samples of the upcoming windows
+        keep_from = max(0, last-self.offset)
+        self._buffer = self._buffer[keep_from-self._buffer_start:]
+        self._buffer_start = keep_from
+        return result
+
+
+def detrending_filter_chunks(y, windowsize, chunk_size=1 << 20):
+    """
+        Yields (start, detrended y[start:start+chunk_size]) of detrending_filter, y is read chunk by chunk
+        (memory mapped arrays are never loaded completely).
+    """
     offset = int(windowsize/2)
-    result_signal = np.array(
-        [y[i]-np.mean(y[max(0, i-offset):min(len(y)-1, i+offset)]) for i in range(len(y))])
-    return result_signal
+    n = len(y)
+    dtype = y.dtype if np.issubdtype(y.dtype, np.floating) else np.float64
+    for first in range(0, n, chunk_size):
+        last = min(first+chunk_size, n)
+        segment_start = max(0, first-offset)
+        segment = np.asarray(
+            y[segment_start:min(n, last+offset)], dtype=np.float64)
+        yield first, _detrended_range(segment, segment_start, first, last, offset, n).astype(dtype)
 
 
-@jit(nopython=True)
+def detrending_filter(y, windowsize, chunk_size=1 << 20):
+    """
+        Moving-average detrend y[i]-mean(y[max(0, i-offset):min(len(y)-1, i+offset)]) with offset = int(windowsize/2)
+        (the window never contains the last sample, an empty window gives NaN). O(N) from cumulative sums in float64,
+        which restart for every chunk of chunk_size outputs. Float input keeps its dtype.
+    """
+    if not hasattr(y, "dtype"):
+        y = np.asarray(y)
+    result = np.empty(len(y), dtype=y.dtype if np.issubdtype(
+        y.dtype, np.floating) else np.float64)
+    for first, chunk in detrending_filter_chunks(y, windowsize, chunk_size):
+        result[first:first+len(chunk)] = chunk
+    return result
+
+
+# argument types compiled by src.numba_kernels.warm_up (template and trace of the same dtype)
+SAD_SIGNATURES = [(float32[::1], float32[::1]), (float64[::1], float64[::1]),
+                  (int16[::1], int16[::1])]
+
+
+@jit(nopython=True, cache=True)
 def calc_sad_over_everything(template, trace):
     return [np.sum(np.array([np.abs(template[idx]-trace[i+idx]) for idx in range(len(template))], type=float)) for i in range(len(trace)-len(template)-1)]
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def calc_sad(a, b):
     return np.sum(np.array([np.abs(a[idx]-b[idx]) for idx in range(len(a))], type=float))
 
 
+def block_window_sum(f, w, count=None, block_size=1 << 16):
+    """
+        Returns the sums of the windows f[k:k+w] for k = 0 ... count-1 in float64.
+        The cumulative sums restart for every block of block_size windows, so the rounding error depends on the
+        block size and not on the length of f.
+    """
+    f = np.asarray(f)
+    w = int(w)
+    if count is None:
+        count = len(f)-w+1
+    count = max(0, int(count))
+    result = np.empty(count, dtype=np.float64)
+    for block_start in range(0, count, block_size):
+        block_count = min(block_size, count-block_start)
+        cumulative = np.zeros(block_count+w, dtype=np.float64)
+        np.cumsum(f[block_start:block_start+block_count+w-1],
+                  dtype=np.float64, out=cumulative[1:])
+        result[block_start:block_start +
+               block_count] = cumulative[w:] - cumulative[:block_count]
+    return result
+
+
 def autocorr_loop(len_all_rounds, w, data, no_similar_rounds):
     correlation_list = [np.mean([np.abs(np.corrcoef(mean_axis0(np.array([data[i+w*f:i+w*(f+1)] for f in range(no_similar_rounds)])),
                                 data[i+j*w:i+(j+1)*w])[0, 1]) for j in range(no_similar_rounds)]) for i in range(len(data)-len_all_rounds)]
@@ -88,21 +190,82 @@ def mean_axis0(a):
     return np.array([np.mean(a[:, i]) for i in range(a.shape[1])])
 
 
-def highpass_filter(y, fr, stop_freq=100000000, pass_freq=150000000):
-    filter_stop_freq = stop_freq  # Hz
-    filter_pass_freq = pass_freq  # Hz
-    filter_order = min((101, odd(int(len(y)/4))))
-
-    # High-pass filter
+@functools.lru_cache(maxsize=32)
+def highpass_design(fr, stop_freq, pass_freq, filter_order):
+    """
+        firls high-pass of filter_order (odd) taps and its autocorrelation, the zero-phase impulse response of
+        filtfilt. Cached per (fr, stop_freq, pass_freq, filter_order), the arrays are read-only.
+    """
     nyquist_rate = fr / 2.
     desired = (0, 0, 1, 1)
-    bands = (0, filter_stop_freq, filter_pass_freq, nyquist_rate)
-    filter_coefs = scipy.signal.firls(
-        filter_order, bands, desired, nyq=nyquist_rate)
+    bands = (0, stop_freq, pass_freq, nyquist_rate)
+    filter_coefs = scipy.signal.firls(filter_order, bands, desired, fs=fr)
+    zero_phase = np.convolve(filter_coefs, filter_coefs[::-1])
+    filter_coefs.flags.writeable = False
+    zero_phase.flags.writeable = False
+    return filter_coefs, zero_phase
+
+
+def _odd_extended(y, start, stop):
+    # y[start:stop] of the odd extension of filtfilt (2*y[0]-y[-j] before, 2*y[n-1]-y[2*(n-1)-j] after the signal)
+    n = len(y)
+    segment = np.asarray(y[max(0, start):min(n, stop)], dtype=np.float64)
+    if start < 0:
+        left = 2*float(y[0]) - np.asarray(y[1:1-start], dtype=np.float64)[::-1]
+        segment = np.concatenate((left, segment))
+    if stop > n:
+        right = 2*float(y[n-1]) - \
+            np.asarray(y[2*n-1-stop:n-1], dtype=np.float64)[::-1]
+        segment = np.concatenate((segment, right))
+    return segment
+
+
+def highpass_filter_chunks(y, fr, stop_freq=100000000, pass_freq=150000000, block_size=1 << 20, workers=None):
+    """
+        Yields (start, filtered y[start:start+block_size]) of highpass_filter. Every block is read with an overlap of
+        filter_order-1 samples on both sides and convolved (FFT) with the zero-phase response of the filter, blocks run in
+        workers threads and at most 2*workers blocks are in flight (memory mapped input is read block by block).
+    """
+    n = len(y)
+    filter_order = min((101, odd(int(n/4))))
+    _, zero_phase = highpass_design(
+        fr, stop_freq, pass_freq, filter_order)
+    halo = filter_order-1
+    if n <= 3*filter_order:
+        raise ValueError("the trace has to be longer than " +
+                         str(3*filter_order) + " samples (padlen of filtfilt)")
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    def filtered_block(start):
+        segment = _odd_extended(y, start-halo, min(n, start+block_size)+halo)
+        return start, signal.fftconvolve(segment, zero_phase, mode="valid")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = collections.deque()
+        for start in range(0, n, block_size):
+            in_flight.append(executor.submit(filtered_block, start))
+            if len(in_flight) >= 2*workers:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def highpass_filter(y, fr, stop_freq=100000000, pass_freq=150000000, block_size=1 << 20, out=None, workers=None):
+    """
+        Zero-phase firls high-pass, same as scipy.signal.filtfilt(filter_coefs, [1], y) with its default odd padding
+        (up to rounding). For an FIR filter the padded forward-backward pass is a convolution with the autocorrelation of
+        the filter on the odd extension of y, so it is computed in overlapping blocks (see highpass_filter_chunks).
 
-    # Apply high-pass filter
-    filtered_audio = scipy.signal.filtfilt(filter_coefs, [1], y)
-    return filtered_audio
+        :param out: float64 array (or memmap) for the result, allocated if None
+    """
+    if not hasattr(y, "dtype"):
+        y = np.asarray(y)
+    if out is None:
+        out = np.empty(len(y), dtype=np.float64)
+    for start, block in highpass_filter_chunks(y, fr, stop_freq, pass_freq, block_size, workers):
+        out[start:start+len(block)] = block
+    return out
 
 
 # Pick top N values out of list:
@@ -111,7 +274,27 @@ def top_x_array(a, N, scale=1):
     return np.column_stack((a[max_ind], max_ind*scale))
 
 
+# Like top_x_array, but greedily skips values within suppression_radius samples of an earlier pick.
+# Equal values go to the larger index first (reversed stable sort), so the picks do not depend on the sort algorithm
+def top_k_peaks(a, N, suppression_radius=0):
+    order = np.argsort(a, kind="stable")[::-1]
+    if suppression_radius <= 0:
+        picked = order[:N]
+    else:
+        picked = []
+        for idx in order:
+            if all(abs(idx-other) > suppression_radius for other in picked):
+                picked.append(idx)
+                if len(picked) == N:
+                    break
+    picked = np.array(picked, dtype=int)
+    return np.column_stack((a[picked], picked))
+
+
 def plot_found_segments(trace, starting_points, length):
+    from bokeh.io import output_notebook, reset_output
+    from bokeh.palettes import Dark2_5 as palette
+    from bokeh.plotting import figure, show
     reset_output()
     output_notebook()
     p = figure(width=900, height=600, title="Different extracted CO-Segments")
@@ -145,6 +328,7 @@ class Exporter:
                    delimiter=',', header="y_values,x_values", comments='')
 
     def export_dict(self, dict_save, filename="i_was_lazy"):
+        import pandas as pd
         df = pd.DataFrame.from_dict(dict_save)
         df.to_csv(str(self.root_folder)+str(filename)+".csv", mode='w')
         print("EXPORTED TO: " + str(self.root_folder)+str(filename)+".csv")
@@ -153,9 +337,34 @@ class Exporter:
         df_save.to_csv(str(self.root_folder)+str(filename)+".csv", mode='w')
         print("EXPORTED TO: " + str(self.root_folder)+str(filename)+".csv")
 
+    def export_binary(self, data, filename="i_was_lazy", mode="npy", metadata=None, fs=1):
+        """
+            Binary counterpart of export_data / export_dict, written in blocks with a JSON sidecar for the metadata
+            (see src/binary_export.py, reload with load_binary).
+
+            :param data: array, memmap, QuantizedTrace or dict column name -> array
+            :param mode: "npy", "memmap" or "hdf5"
+            :param metadata: e.g. TraceContainer.export_metadata()
+        """
+        metadata = dict(metadata or {})
+        metadata.setdefault("fs", fs)
+        files = save_binary(str(self.root_folder)+str(filename), data, mode, metadata)
+        print("EXPORTED TO: " + ", ".join(files))
+        return files
+
+    def export_segments(self, trace, starting_points, length, filename="i_was_lazy", mode="npy", metadata=None):
+        """
+            The CO segments (like plot_found_segments) as one (segments x length) array, see export_binary.
+        """
+        files = save_segments(str(self.root_folder)+str(filename), trace, starting_points, length, mode, metadata)
+        print("EXPORTED TO: " + ", ".join(files))
+        return files
+
     def export_tikz(self, data_y, filename="i_was_lazy", data_x=None):
         if data_x == None:
             data_x = np.arange(0, len(data_y), step=1, dtype=int)
+        import matplotlib.pyplot as plt
+        import tikzplotlib
         plt.style.use("ggplot")
         plt.plot(data_x, data_y, "-")
         plt.xlabel("Sample (1)")
@@ -181,19 +390,22 @@ class Plotter:
         self.show()
 
     def show(self):
+        import holoviews as hv
+        from bokeh.io import output_file, output_notebook, reset_output, save
+        from bokeh.plotting import show
         hv.extension('bokeh')
         reset_output()
         output_notebook()
         if self.decimation_factor > 1:
-            # itertools.islice(self.x, 0, None, self.decimation_factor)#signal.decimate(self.x, self.decimation_factor)
-            self.x = signal.decimate(self.x, self.decimation_factor)
-            self.y = signal.decimate(self.y, self.decimation_factor)
+            # min/max envelope with one point per decimation_factor samples, the x values are picked, not filtered
+            pixels = max(1, len(self.y)//self.decimation_factor)
+            x = np.asarray(self.x)
+            x_idx, self.y = MinMaxPyramid.build(
+                self.y).line(0, len(self.y), pixels, self.y)
             if self.additional_y_stuff != None:
-                self.additional_y_stuff = signal.decimate(
-                    self.additional_y_stuff, self.decimation_factor)
-            if self.additional_x_stuff != None:
-                self.additional_x_stuff = signal.decimate(
-                    self.additional_x_stuff, self.decimation_factor)
+                self.additional_y_stuff = [MinMaxPyramid.build(y_stuff).line(
+                    0, len(y_stuff), pixels, y_stuff)[1] for y_stuff in self.additional_y_stuff]
+            self.x = x[x_idx]
         curve = hv.Curve((self.x, np.array(self.y)), label=self.curve_label)
         if self.additional_y_stuff != None:
             for y_stuff in self.additional_y_stuff:
@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+# Min/max level-of-detail pyramid for plotting long traces and similarity curves. Every level holds the minimum and
+# maximum of fixed blocks of samples, a plot of any range is drawn from the finest level with at most one block per
+# pixel, so it costs O(pixels) instead of O(range) and narrow spikes stay visible (unlike decimation with a lowpass).
+import os
+
+import numpy as np
+
+
+class MinMaxPyramid:
+    """
+        Level k holds the min / max of blocks of block*factor**k samples of a signal of length samples.
+        Ranges that need less than block samples per pixel are drawn from the signal itself.
+
+        :param minima: list of the minima of every level (finest first)
+        :param maxima: list of the maxima of every level
+    """
+
+    def __init__(self, length, block, factor, minima, maxima):
+        self.length = int(length)
+        self.block = int(block)
+        self.factor = int(factor)
+        self.minima = minima
+        self.maxima = maxima
+
+    @classmethod
+    def build(cls, y, block=64, factor=4, chunk_size=1 << 22):
+        """
+            One O(N) pass over y (read in chunks, so memory mapped signals are never loaded completely).
+        """
+        n = len(y)
+        chunk_size = max(block, chunk_size//block*block)
+        n_blocks = -(-n//block)
+        minima = maxima = None
+        for start in range(0, n, chunk_size):
+            chunk = np.asarray(y[start:start+chunk_size])
+            if minima is None:
+                dtype = chunk.dtype if np.issubdtype(
+                    chunk.dtype, np.floating) else np.float32
+                minima = np.empty(n_blocks, dtype=dtype)
+                maxima = np.empty(n_blocks, dtype=dtype)
+            edges = np.arange(0, len(chunk), block)
+            minima[start//block:start//block+len(edges)
+                   ] = np.minimum.reduceat(chunk, edges)
+            maxima[start//block:start//block+len(edges)
+                   ] = np.maximum.reduceat(chunk, edges)
+        if minima is None:
+            minima = maxima = np.zeros(0, dtype=np.float32)
+        levels_min, levels_max = [minima], [maxima]
+        while len(levels_min[-1]) > 1:
+            edges = np.arange(0, len(levels_min[-1]), factor)
+            levels_min.append(np.minimum.reduceat(levels_min[-1], edges))
+            levels_max.append(np.maximum.reduceat(levels_max[-1], edges))
+        return cls(n, block, factor, levels_min, levels_max)
+
+    @classmethod
+    def for_trace(cls, y, filename=None, block=64, factor=4):
+        """
+            The pyramid of y, loaded from filename (e.g. next to the trace file) if it was built for a signal of the same
+            length with the same blocks, otherwise built and stored there. filename None only builds it.
+        """
+        if filename is not None and os.path.exists(filename):
+            pyramid = cls.load(filename)
+            if pyramid.length == len(y) and pyramid.block == block and pyramid.factor == factor:
+                return pyramid
+        pyramid = cls.build(y, block, factor)
+        if filename is not None:
+            pyramid.save(filename)
+        return pyramid
+
+    def save(self, filename):
+        arrays = {"length": self.length,
+                  "block": self.block, "factor": self.factor}
+        for level, (minima, maxima) in enumerate(zip(self.minima, self.maxima)):
+            arrays["min_" + str(level)] = minima
+            arrays["max_" + str(level)] = maxima
+        # np.savez appends .npz to other names
+        with open(filename, "wb") as pyramid_file:
+            np.savez(pyramid_file, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as arrays:
+            nr_levels = sum(1 for key in arrays.files if key.startswith("min_"))
+            return cls(arrays["length"], arrays["block"], arrays["factor"],
+                       [arrays["min_" + str(level)] for level in range(nr_levels)],
+                       [arrays["max_" + str(level)] for level in range(nr_levels)])
+
+    def _range(self, start, stop):
+        stop = self.length if stop is None else min(int(stop), self.length)
+        start = max(0, int(start))
+        return start, max(start, stop)
+
+    def envelope(self, start=0, stop=None, pixels=1000, y=None):
+        """
+            (x, lower, upper) of the range start ... stop-1 with at most pixels entries, x is the first sample of every
+            entry. A range of at most pixels samples gives the samples of y (lower = upper). Otherwise the entries are
+            the blocks of the finest level with at most pixels blocks in the range, a range that needs blocks smaller
+            than the finest level is reduced from y directly (at most block*pixels samples). Without y the finest level
+            is the limit.
+        """
+        start, stop = self._range(start, stop)
+        pixels = max(1, int(pixels))
+        count = stop-start
+        if y is not None and count <= pixels:
+            values = np.asarray(y[start:stop])
+            return np.arange(start, stop), values, values
+        samples_per_entry = -(-count//pixels)
+        if y is not None and samples_per_entry < self.block:
+            values = np.asarray(y[start:stop])
+            edges = np.arange(0, count, samples_per_entry)
+            return start+edges, np.minimum.reduceat(values, edges), np.maximum.reduceat(values, edges)
+        level = 0
+        while level+1 < len(self.minima):
+            block_size = self.block*self.factor**level
+            if -(-stop//block_size)-start//block_size <= pixels:
+                break
+            level += 1
+        block_size = self.block*self.factor**level
+        first = start//block_size
+        last = -(-stop//block_size)
+        return np.arange(first, last)*block_size, self.minima[level][first:last], self.maxima[level][first:last]
+
+    def line(self, start=0, stop=None, pixels=1000, y=None):
+        """
+            (x, y) of a single line through the envelope with at most pixels points (the samples of y, or the min and
+            max of at most pixels/2 entries), for line plots.
+        """
+        start, stop = self._range(start, stop)
+        if y is not None and stop-start <= pixels:
+            x, values, _ = self.envelope(start, stop, pixels, y)
+            return x, values
+        x, lower, upper = self.envelope(start, stop, max(1, int(pixels)//2), y)
+        return np.repeat(x, 2), np.column_stack((lower, upper)).reshape(-1)
@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+# Numba-parallel CPU versions of the OpenCL similarity kernels in src/opencl_kernels.py.
+# They use the same float32 arithmetic in the same order as the kernels, so both backends agree up to rounding,
+# and split the start positions in chunks that are distributed over all cores.
+from time import perf_counter
+
+import numpy as np
+from numba import boolean, float32, float64, int64, njit, prange
+
+# start positions per parallel task
+CHUNK_SIZE = 4096
+
+
+@njit(cache=True)
+def _round_pearson(data, i, w, rounds, sum_X, sum_XY, squareSum_X):
+    # round-correlation of start position i, sum_X, sum_XY and squareSum_X are scratch arrays of length rounds
+    rounds_f = np.float32(rounds)
+    w_f = np.float32(w)
+    sum_X[:] = 0
+    sum_XY[:] = 0
+    squareSum_X[:] = 0
+    sum_Y = np.float32(0)
+    squareSum_Y = np.float32(0)
+    for avg_idx in range(w):
+        avg_value = np.float32(0)
+        for r in range(rounds):
+            avg_value += data[i+avg_idx+r*w]/rounds_f
+        sum_Y += avg_value
+        squareSum_Y += avg_value*avg_value
+        for r in range(rounds):
+            x = data[i+avg_idx+r*w]
+            sum_X[r] += x
+            sum_XY[r] += x*avg_value
+            squareSum_X[r] += x*x
+    avg_correlation = np.float32(0)
+    for r in range(rounds):
+        numerator = w_f*sum_XY[r] - sum_X[r]*sum_Y
+        denominator = (w_f*squareSum_X[r] - sum_X[r]*sum_X[r]) * \
+            (w_f*squareSum_Y - sum_Y*sum_Y)
+        # the kernel adds a double literal, so the square root is taken in double precision
+        round_correlation = np.float32(
+            np.float64(numerator)/np.sqrt(np.float64(denominator)+0.00001))
+        avg_correlation += round_correlation/rounds_f
+    return avg_correlation
+
+
+@njit(cache=True)
+def _round_sad(data, i, w, rounds, sad):
+    # negative round-SAD of start position i, sad is a scratch array of length rounds
+    rounds_f = np.float32(rounds)
+    sad[:] = 0
+    for avg_idx in range(w):
+        avg_value = np.float32(0)
+        for r in range(rounds):
+            avg_value += data[i+avg_idx+r*w]/rounds_f
+        for r in range(rounds):
+            sad[r] -= abs(avg_value-data[i+avg_idx+r*w])
+    avg_correlation = np.float32(0)
+    for r in range(rounds):
+        avg_correlation += sad[r]/rounds_f
+    return avg_correlation
+
+
+@njit(parallel=True, cache=True)
+def quality_positions(data, w, no_similar_rounds, positions, metric_sad):
+    """
+        Algorithm 1 round-similarity at the given start positions (same as AUTOCORR_KERNEL / AUTOSAD_KERNEL).
+        data must be float32. Positions whose rounds do not fit get 0 (Pearson) or -FLT_MAX (SAD).
+    """
+    n = len(data)
+    rounds = no_similar_rounds
+    invalid = np.finfo(np.float32).min if metric_sad else np.float32(0)
+    quality = np.empty(len(positions), dtype=np.float32)
+    n_chunks = (len(positions)+CHUNK_SIZE-1)//CHUNK_SIZE
+    for chunk in prange(n_chunks):
+        scratch = np.empty((3, rounds), dtype=np.float32)
+        for j in range(chunk*CHUNK_SIZE, min((chunk+1)*CHUNK_SIZE, len(positions))):
+            i = positions[j]
+            if i < 0 or i+rounds*w >= n:
+                quality[j] = invalid
+            elif metric_sad:
+                quality[j] = _round_sad(data, i, w, rounds, scratch[0])
+            else:
+                quality[j] = _round_pearson(
+                    data, i, w, rounds, scratch[0], scratch[1], scratch[2])
+    return quality
+
+
+def quality_curve_pearson(data, w, no_similar_rounds):
+    """
+        Algorithm 1 round-correlation of every start position (same as AUTOCORR_KERNEL). data must be float32.
+    """
+    return quality_positions(data, w, no_similar_rounds, np.arange(len(data)), False)
+
+
+def quality_curve_sad(data, w, no_similar_rounds):
+    """
+        Algorithm 1 negative round-SAD of every start position (same as AUTOSAD_KERNEL). data must be float32.
+    """
+    return quality_positions(data, w, no_similar_rounds, np.arange(len(data)), True)
+
+
+@njit(parallel=True, cache=True)
+def template_correlation(data, template, positions):
+    """
+        Pearson correlation of template at the given positions (same as TEMPLATE_CORRELATION_KERNEL).
+    """
+    n = len(data)
+    template_length = len(template)
+    n_f = np.float32(template_length)
+    correlation = np.zeros(len(positions), dtype=np.float32)
+    for j in prange(len(positions)):
+        i = positions[j]
+        if i < 0 or i+template_length >= n:
+            continue
+        sum_X = np.float32(0)
+        sum_Y = np.float32(0)
+        sum_XY = np.float32(0)
+        squareSum_X = np.float32(0)
+        squareSum_Y = np.float32(0)
+        for k in range(template_length):
+            x = data[i+k]
+            y = template[k]
+            sum_X += x
+            sum_Y += y
+            sum_XY += x*y
+            squareSum_X += x*x
+            squareSum_Y += y*y
+        correlation[j] = (n_f*sum_XY - sum_X*sum_Y) / np.sqrt(
+            (n_f*squareSum_X - sum_X*sum_X)*(n_f*squareSum_Y - sum_Y*sum_Y))
+    return correlation
+
+
+@njit(parallel=True, cache=True)
+def template_sad(data, template, positions):
+    """
+        SAD of template at the given positions (same as TEMPLATE_SAD_KERNEL).
+    """
+    n = len(data)
+    template_length = len(template)
+    sad = np.full(len(positions), np.float32(-1), dtype=np.float32)
+    for j in prange(len(positions)):
+        i = positions[j]
+        if i < 0 or i+template_length >= n:
+            continue
+        value = np.float32(0)
+        for k in range(template_length):
+            value += abs(template[k]-data[i+k])
+        sad[j] = value
+    return sad
+
+
+# samples that are summed between two threshold checks of template_sad_early_abandon
+ABANDON_BLOCK = 16
+
+
+@njit(parallel=True, cache=True)
+def template_sad_early_abandon(data, template, positions, threshold):
+    """
+        SAD of template at the given positions like template_sad (same values), but the sum of a position is abandoned
+        as soon as it exceeds threshold. Returns (values, complete), where complete[j] is False if the value is only a
+        partial sum (> threshold, and never larger than the full SAD). All positions have to fit into data.
+    """
+    template_length = len(template)
+    values = np.empty(len(positions), dtype=np.float32)
+    complete = np.ones(len(positions), dtype=np.bool_)
+    for j in prange(len(positions)):
+        i = positions[j]
+        value = np.float32(0)
+        k = 0
+        while k < template_length:
+            stop = min(k+ABANDON_BLOCK, template_length)
+            for kk in range(k, stop):
+                value += abs(template[kk]-data[i+kk])
+            k = stop
+            if value > threshold and k < template_length:
+                complete[j] = False
+                break
+        values[j] = value
+    return values, complete
+
+
+# argument types compiled by warm_up: the float32 traces, int64 positions and python ints / bools the backends pass
+QUALITY_SIGNATURES = [(float32[::1], int64, int64, int64[::1], boolean)]
+TEMPLATE_SIGNATURES = [(float32[::1], float32[::1], int64[::1])]
+EARLY_ABANDON_SIGNATURES = [(float32[::1], float32[::1], int64[::1], float32),
+                            (float32[::1], float32[::1], int64[::1], float64)]
+
+
+def warm_up(print_info=False):
+    """
+        Compiles the numba functions for the common argument types before the first real call, e.g. in the initializer
+        of a worker process. All of them are cached on disk (cache=True), so only the very first process compiles them
+        and every later one just loads the machine code. Other argument types are still compiled lazily on first use.
+
+        :return: seconds spent
+    """
+    # imported here: both modules import this one
+    from src.helper import SAD_SIGNATURES, calc_sad, calc_sad_over_everything
+    from src.sad_search import _greedy_picks
+
+    functions = [(quality_positions, QUALITY_SIGNATURES),
+                 (template_correlation, TEMPLATE_SIGNATURES),
+                 (template_sad, TEMPLATE_SIGNATURES),
+                 (template_sad_early_abandon, EARLY_ABANDON_SIGNATURES),
+                 (_greedy_picks, [(int64[::1], int64, int64, int64, int64)]),
+                 (calc_sad, SAD_SIGNATURES),
+                 (calc_sad_over_everything, SAD_SIGNATURES)]
+    t_start = perf_counter()
+    for function, signatures in functions:
+        for signature in signatures:
+            function.compile(signature)
+    elapsed = perf_counter()-t_start
+    if print_info:
+        print("numba warm up: " + str(sum(len(signatures) for _, signatures in functions)) + " signatures in " +
+              str(elapsed) + " s")
+    return elapsed
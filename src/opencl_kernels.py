@@ -0,0 +1,598 @@
+#!/usr/bin/python3
+# OpenCL kernel sources used by the Autocorrelation_Accelerator.
+# Per-width constants are passed as build options (e.g. -DWIDTH=123) so that
+# the ComputeSession can reuse compiled programs across calls.
+
+FP64_PRAGMA = """
+#if __OPENCL_VERSION__ < 120
+    #if cl_khr_fp64
+        #pragma OPENCL EXTENSION cl_khr_fp64 : enable
+    #elif cl_amd_fp64
+        #pragma OPENCL EXTENSION cl_amd_fp64 : enable
+    #else
+        #error Missing double precision extension
+    #endif
+#endif
+"""
+
+# Trace samples are float, or integer ADC codes (build options of QuantizedTrace.kernel_options in src/quantized_trace.py:
+# -DSAMPLE_T=short -DSAMPLE_GAIN=... -DSAMPLE_OFFSET=...) that SAMPLE converts to voltages gain*(code-offset) in registers.
+SAMPLE_DEFINES = """
+#ifndef SAMPLE_T
+    #define SAMPLE_T float
+#endif
+#ifdef SAMPLE_GAIN
+    #define SAMPLE(x) (((float)(x)-(SAMPLE_OFFSET))*(SAMPLE_GAIN))
+    #define SAMPLE4(p) ((convert_float4(vload4(0, p))-(SAMPLE_OFFSET))*(SAMPLE_GAIN))
+#else
+    #define SAMPLE(x) ((float)(x))
+    #define SAMPLE4(p) convert_float4(vload4(0, p))
+#endif
+"""
+
+# SAD of a template against the positions first_idx+j*stride for j < get_global_size(0) (correlate)
+# or against the positions in indices (correlate_indices)
+TEMPLATE_SAD_KERNEL = FP64_PRAGMA + SAMPLE_DEFINES + """
+float sad_calculation(__global const SAMPLE_T* X, __global const float* avg_segment_adj, int n){
+    float sad = 0;
+    for (int i = 0; i < n; ++i){
+        sad += fabs((float)(avg_segment_adj[i]-SAMPLE(X[i])));
+    }
+    return sad;
+}
+
+__kernel void correlate(__global const SAMPLE_T *data, __global float *correlation, __global const float *template_candidate, const int template_length, const int n, const int first_idx, const int stride){
+    int j = get_global_id(0);
+    int i = first_idx + j*stride;
+
+    // Abort if we would otherwise run out of valid idx
+    if(i+template_length >= n){
+        correlation[j] = -1;
+        return;
+    }
+    correlation[j] = sad_calculation(&data[i], template_candidate, template_length);
+}
+
+__kernel void correlate_indices(__global const SAMPLE_T *data, __global float *correlation, __global const float *template_candidate, const int template_length, const int n, __global const int *indices){
+    int j = get_global_id(0);
+    int i = indices[j];
+
+    if(i < 0 || i+template_length >= n){
+        correlation[j] = -1;
+        return;
+    }
+    correlation[j] = sad_calculation(&data[i], template_candidate, template_length);
+}
+"""
+
+# Pearson correlation of a template against the positions first_idx+j*stride (correlate) or indices[j] (correlate_indices)
+TEMPLATE_CORRELATION_KERNEL = FP64_PRAGMA + SAMPLE_DEFINES + """
+float correlationCoefficient(__global const SAMPLE_T* X, __global const float* avg_segment_adj, int n){
+    float sum_X = 0, sum_Y = 0, sum_XY = 0;
+    float squareSum_X = 0, squareSum_Y = 0;
+
+    for (int i = 0; i < n; ++i){
+        float x = SAMPLE(X[i]);
+        sum_X = sum_X + x;
+        sum_Y = sum_Y + avg_segment_adj[i];
+        sum_XY = sum_XY + x * avg_segment_adj[i];
+        squareSum_X = squareSum_X + x * x;
+        squareSum_Y = squareSum_Y + avg_segment_adj[i] * avg_segment_adj[i];
+    }
+    float corr = (float)(n * sum_XY - sum_X * sum_Y)  / sqrt((float)((n * squareSum_X - sum_X * sum_X) * (n * squareSum_Y - sum_Y * sum_Y)));
+    return corr;
+}
+
+__kernel void correlate(__global const SAMPLE_T *data, __global float *correlation, __global const float *template_candidate, const int template_length, const int n, const int first_idx, const int stride){
+    int j = get_global_id(0);
+    int i = first_idx + j*stride;
+
+    // Abort if we would otherwise run out of valid idx
+    if(i+template_length >= n){
+        correlation[j] = 0;
+        return;
+    }
+    correlation[j] = correlationCoefficient(&data[i], template_candidate, template_length);
+}
+
+__kernel void correlate_indices(__global const SAMPLE_T *data, __global float *correlation, __global const float *template_candidate, const int template_length, const int n, __global const int *indices){
+    int j = get_global_id(0);
+    int i = indices[j];
+
+    if(i < 0 || i+template_length >= n){
+        correlation[j] = 0;
+        return;
+    }
+    correlation[j] = correlationCoefficient(&data[i], template_candidate, template_length);
+}
+"""
+
+# Algorithm 1 round-similarity (Pearson), one program per WIDTH
+AUTOCORR_KERNEL = FP64_PRAGMA + SAMPLE_DEFINES + """
+float correlationCoefficient_stable(__global const SAMPLE_T* X, __private const float* avg_segment_adj, int n){
+    float sum_X = 0, sum_Y = 0, sum_XY = 0;
+    float squareSum_X = 0, squareSum_Y = 0;
+
+    for (int i = 0; i < n; ++i){
+        float x = SAMPLE(X[i]);
+        sum_X = sum_X + x;
+        sum_Y = sum_Y + avg_segment_adj[i];
+        sum_XY = sum_XY + x * avg_segment_adj[i];
+        squareSum_X = squareSum_X + x * x;
+        squareSum_Y = squareSum_Y + avg_segment_adj[i] * avg_segment_adj[i];
+    }
+    float corr = (float)(n * sum_XY - sum_X * sum_Y)  / sqrt((float)((n * squareSum_X - sum_X * sum_X) * (n * squareSum_Y - sum_Y * sum_Y))+0.00001);
+    return corr;
+}
+
+__kernel void correlate(__global const SAMPLE_T *data, __global float *correlation, const int max_rounds, const int n){
+    int i = get_global_id(0);
+    float avg_segment[WIDTH]= { 0 };
+
+    int w = WIDTH;
+    // Abort if we would otherwise run out of valid idx
+    if(i+max_rounds*w >= n){
+        correlation[i] = 0;
+        return;
+    }
+    // Create mean segment:
+    for(int round = 0; round < max_rounds; ++round){
+        for(int avg_idx=0; avg_idx<w; ++avg_idx){
+            avg_segment[avg_idx] += SAMPLE(data[i+avg_idx+(round*w)])/max_rounds;
+        }
+    }
+    //find avg correlation:
+    float avg_correlation = 0;
+    for(int round = 0; round < max_rounds; ++round){
+        float round_correlation = correlationCoefficient_stable(&data[i+round*w],avg_segment,w);
+        avg_correlation += round_correlation/max_rounds;
+    }
+    correlation[i] = avg_correlation;
+}
+"""
+
+# Algorithm 1 round-similarity (negative SAD), one program per WIDTH
+AUTOSAD_KERNEL = FP64_PRAGMA + SAMPLE_DEFINES + """
+float negative_sad_calculation(__global const SAMPLE_T* X, __private const float* avg_segment_adj, int n){
+    float sad = 0;
+    for (int i = 0; i < n; ++i){
+        sad -= fabs((float)(avg_segment_adj[i]-SAMPLE(X[i])));
+    }
+    return sad;
+}
+
+__kernel void correlate(__global const SAMPLE_T *data, __global float *correlation, const int max_rounds, const int n){
+    int i = get_global_id(0);
+    float avg_segment[WIDTH]= { 0 };
+
+    int w = WIDTH;
+    // Abort if we would otherwise run out of valid idx
+    if(i+max_rounds*w >= n){
+        correlation[i] = -FLT_MAX;
+        return;
+    }
+    // Create mean segment:
+    for(int round = 0; round < max_rounds; ++round){
+        for(int avg_idx=0; avg_idx<w; ++avg_idx){
+            avg_segment[avg_idx] += SAMPLE(data[i+avg_idx+(round*w)])/max_rounds;
+        }
+    }
+    //find avg correlation:
+    float avg_correlation = 0;
+    for(int round = 0; round < max_rounds; ++round){
+        float round_correlation = negative_sad_calculation(&data[i+round*w],avg_segment,w);
+        avg_correlation += round_correlation/max_rounds;
+    }
+    correlation[i] = avg_correlation;
+}
+"""
+
+# Algorithm 1 round-similarity for a batch of widths in one launch (2D NDRange: position x width).
+# The width is a runtime argument, only the number of rounds (ROUNDS) is a build option. Instead of a private
+# mean segment of WIDTH floats, every round keeps its own running sums while the mean segment is streamed.
+# Build with -DMETRIC_SAD for the negative SAD round-similarity.
+# quality_positions evaluates one width at the start positions given in positions (coarse-to-fine search).
+MULTI_WIDTH_KERNEL = FP64_PRAGMA + SAMPLE_DEFINES + """
+#ifdef METRIC_SAD
+    #define INVALID_QUALITY -FLT_MAX
+#else
+    #define INVALID_QUALITY 0
+#endif
+
+float round_quality(__global const SAMPLE_T *data, int i, int w){
+#ifdef METRIC_SAD
+    float sad[ROUNDS];
+    for(int round = 0; round < ROUNDS; ++round){
+        sad[round] = 0;
+    }
+    for(int avg_idx = 0; avg_idx < w; ++avg_idx){
+        float avg_value = 0;
+        for(int round = 0; round < ROUNDS; ++round){
+            avg_value += SAMPLE(data[i+avg_idx+(round*w)])/ROUNDS;
+        }
+        for(int round = 0; round < ROUNDS; ++round){
+            sad[round] -= fabs((float)(avg_value-SAMPLE(data[i+avg_idx+(round*w)])));
+        }
+    }
+    float avg_correlation = 0;
+    for(int round = 0; round < ROUNDS; ++round){
+        avg_correlation += sad[round]/ROUNDS;
+    }
+#else
+    float sum_X[ROUNDS], sum_XY[ROUNDS], squareSum_X[ROUNDS];
+    float sum_Y = 0, squareSum_Y = 0;
+    for(int round = 0; round < ROUNDS; ++round){
+        sum_X[round] = 0;
+        sum_XY[round] = 0;
+        squareSum_X[round] = 0;
+    }
+    for(int avg_idx = 0; avg_idx < w; ++avg_idx){
+        // value of the mean segment at avg_idx
+        float avg_value = 0;
+        for(int round = 0; round < ROUNDS; ++round){
+            avg_value += SAMPLE(data[i+avg_idx+(round*w)])/ROUNDS;
+        }
+        sum_Y = sum_Y + avg_value;
+        squareSum_Y = squareSum_Y + avg_value * avg_value;
+        for(int round = 0; round < ROUNDS; ++round){
+            float x = SAMPLE(data[i+avg_idx+(round*w)]);
+            sum_X[round] = sum_X[round] + x;
+            sum_XY[round] = sum_XY[round] + x * avg_value;
+            squareSum_X[round] = squareSum_X[round] + x * x;
+        }
+    }
+    //find avg correlation:
+    float avg_correlation = 0;
+    for(int round = 0; round < ROUNDS; ++round){
+        float round_correlation = (float)(w * sum_XY[round] - sum_X[round] * sum_Y)  / sqrt((float)((w * squareSum_X[round] - sum_X[round] * sum_X[round]) * (w * squareSum_Y - sum_Y * sum_Y))+0.00001);
+        avg_correlation += round_correlation/ROUNDS;
+    }
+#endif
+    return avg_correlation;
+}
+
+__kernel void quality_multi_width(__global const SAMPLE_T *data, __global float *quality, __global const int *widths, const int n){
+    int i = get_global_id(0);
+    int width_idx = get_global_id(1);
+    int w = widths[width_idx];
+    __global float *correlation = quality + (size_t)width_idx*get_global_size(0);
+
+    // Abort if we would otherwise run out of valid idx
+    if(i+ROUNDS*w >= n){
+        correlation[i] = INVALID_QUALITY;
+        return;
+    }
+    correlation[i] = round_quality(data, i, w);
+}
+
+__kernel void quality_positions(__global const SAMPLE_T *data, __global float *quality, __global const int *positions, const int w, const int n){
+    int j = get_global_id(0);
+    int i = positions[j];
+
+    if(i < 0 || i+ROUNDS*w >= n){
+        quality[j] = INVALID_QUALITY;
+        return;
+    }
+    quality[j] = round_quality(data, i, w);
+}
+"""
+
+# O(N*R) prefix-sum engine for the Algorithm 1 round-similarity (see src/prefix_quality.py for the math).
+# Every work item handles BLOCK consecutive positions: the window sums are computed from scratch at the first
+# position of the block and are then slid along with compensated (Kahan) summation, so the float precision
+# does not depend on the trace length. The trace is centered with offset before summing. Build with -DROUNDS=R.
+PREFIX_QUALITY_KERNEL = FP64_PRAGMA + """
+inline void kahan_add(float *sum, float *compensation, float value){
+    float y = value - *compensation;
+    float t = *sum + y;
+    *compensation = (t - *sum) - y;
+    *sum = t;
+}
+
+// comb[k] = sum over the rounds of (data[k+round*w]-offset) for k < n_comb
+__kernel void comb_sum(__global const float *data, __global float *comb, const int w, const int n_comb, const float offset){
+    int k = get_global_id(0);
+    if(k >= n_comb){
+        return;
+    }
+    float value = 0;
+    for(int round = 0; round < ROUNDS; ++round){
+        value += data[k+round*w] - offset;
+    }
+    comb[k] = value;
+}
+
+// window_sum[k] = sum of (src[k+j]-offset), window_square_sum[k] = sum of (src[k+j]-offset)^2 for j < w and k < n_windows
+__kernel void window_sums(__global const float *src, __global float *window_sum, __global float *window_square_sum, const int w, const int n_windows, const int block, const float offset){
+    int first = get_global_id(0)*block;
+    int last = min(first+block, n_windows);
+    if(first >= last){
+        return;
+    }
+    float sum = 0, sum_c = 0, square_sum = 0, square_sum_c = 0;
+    for(int j = 0; j < w; ++j){
+        float x = src[first+j] - offset;
+        kahan_add(&sum, &sum_c, x);
+        kahan_add(&square_sum, &square_sum_c, x*x);
+    }
+    window_sum[first] = sum;
+    window_square_sum[first] = square_sum;
+    for(int k = first+1; k < last; ++k){
+        float x_out = src[k-1] - offset;
+        float x_in = src[k-1+w] - offset;
+        kahan_add(&sum, &sum_c, x_in - x_out);
+        kahan_add(&square_sum, &square_sum_c, x_in*x_in - x_out*x_out);
+        window_sum[k] = sum;
+        window_square_sum[k] = square_sum;
+    }
+}
+
+__kernel void quality_prefix(__global const float *data, __global const float *comb, __global const float *sum_x, __global const float *square_sum_x,
+                             __global const float *sum_comb, __global const float *square_sum_comb, __global float *correlation,
+                             const int w, const int n, const int block, const float offset){
+    int first = get_global_id(0)*block;
+    int n_valid = n - ROUNDS*w;
+    int last = min(first+block, n_valid);
+    for(int i = max(first, n_valid); i < min(first+block, n); ++i){
+        correlation[i] = 0;
+    }
+    if(first >= last){
+        return;
+    }
+    // sum over j of (data[i+round*w+j]-offset)*comb[i+j]
+    float cross[ROUNDS], cross_c[ROUNDS];
+    for(int round = 0; round < ROUNDS; ++round){
+        cross[round] = 0;
+        cross_c[round] = 0;
+        for(int j = 0; j < w; ++j){
+            kahan_add(&cross[round], &cross_c[round], (data[first+round*w+j]-offset)*comb[first+j]);
+        }
+    }
+    for(int i = first; i < last; ++i){
+        if(i > first){
+            float comb_out = comb[i-1];
+            float comb_in = comb[i-1+w];
+            for(int round = 0; round < ROUNDS; ++round){
+                kahan_add(&cross[round], &cross_c[round], (data[i-1+round*w+w]-offset)*comb_in - (data[i-1+round*w]-offset)*comb_out);
+            }
+        }
+        float sum_Y = sum_comb[i]/ROUNDS;
+        float squareSum_Y = square_sum_comb[i]/(ROUNDS*ROUNDS);
+        float variance_Y = w * squareSum_Y - sum_Y * sum_Y;
+        float avg_correlation = 0;
+        for(int round = 0; round < ROUNDS; ++round){
+            float sum_X = sum_x[i+round*w];
+            float squareSum_X = square_sum_x[i+round*w];
+            float sum_XY = cross[round]/ROUNDS;
+            float round_correlation = (float)(w * sum_XY - sum_X * sum_Y)  / sqrt((float)((w * squareSum_X - sum_X * sum_X) * variance_Y)+0.00001);
+            avg_correlation += round_correlation/ROUNDS;
+        }
+        correlation[i] = avg_correlation;
+    }
+}
+"""
+
+# On-device post-processing of a quality curve, so only TOP_K (score, index) pairs per width go back to the host.
+# detrend: out[i] = y[i] - mean(y[max(0, i-offset) : min(length-1, i+offset)]) for i < length (like helper.detrending_filter),
+# 0 for length <= i < n. Every work item slides the window over a block of positions with Kahan compensated sums.
+# top_k_block: the TOP_K largest values*scale of a block, applied repeatedly to its own output until a single block is left.
+# With peak suppression the best value is picked TOP_K times and its neighbourhood is cleared with suppress in between.
+# The values may hold several curves of count values each (one per width of a multi-width launch): detrend works on
+# curve row, top_k_block and suppress take the curve as second dimension of the launch.
+POSTPROCESS_KERNEL = """
+inline void kahan_add(float *sum, float *compensation, float value){
+    float y = value - *compensation;
+    float t = *sum + y;
+    *compensation = (t - *sum) - y;
+    *sum = t;
+}
+
+__kernel void detrend(__global const float *y, __global float *out, const int length, const int offset, const int n, const int block,
+                      const int row){
+    int first = get_global_id(0)*block;
+    y += (long)row*n;
+    out += (long)row*n;
+    int last = min(first+block, n);
+    if(first >= n){
+        return;
+    }
+    int lo = max(0, first-offset);
+    int hi = max(lo, min(length-1, first+offset));
+    float sum = 0, sum_c = 0;
+    for(int j = lo; j < hi; ++j){
+        kahan_add(&sum, &sum_c, y[j]);
+    }
+    for(int i = first; i < last; ++i){
+        if(i >= length){
+            out[i] = 0;
+            continue;
+        }
+        int new_lo = max(0, i-offset);
+        int new_hi = min(length-1, i+offset);
+        while(hi < new_hi){
+            kahan_add(&sum, &sum_c, y[hi]);
+            ++hi;
+        }
+        while(lo < new_lo){
+            kahan_add(&sum, &sum_c, -y[lo]);
+            ++lo;
+        }
+        out[i] = hi > lo ? y[i] - sum/(hi-lo) : y[i];
+    }
+}
+
+__kernel void top_k_block(__global const float *values, __global const int *indices, const int count, const int block,
+                          __global const float *scales, __global float *out_values, __global int *out_indices){
+    int b = get_global_id(0);
+    int row = get_global_id(1);
+    int first = b*block;
+    int last = min(first+block, count);
+    long row_offset = (long)row*count;
+    long out_offset = ((long)row*get_global_size(0)+b)*TOP_K;
+    float scale = scales ? scales[row] : 1.0f;
+    float best_value[TOP_K];
+    int best_idx[TOP_K];
+    for(int k = 0; k < TOP_K; ++k){
+        best_value[k] = -INFINITY;
+        best_idx[k] = -1;
+    }
+    // insertion into the sorted list of the best TOP_K values, NaN (suppressed) values never get in
+    for(int j = first; j < last; ++j){
+        float value = values[row_offset+j]*scale;
+        if(!(value > best_value[TOP_K-1])){
+            continue;
+        }
+        int k = TOP_K-1;
+        while(k > 0 && value > best_value[k-1]){
+            best_value[k] = best_value[k-1];
+            best_idx[k] = best_idx[k-1];
+            --k;
+        }
+        best_value[k] = value;
+        best_idx[k] = indices ? indices[row_offset+j] : j;
+    }
+    for(int k = 0; k < TOP_K; ++k){
+        out_values[out_offset+k] = best_value[k];
+        out_indices[out_offset+k] = best_idx[k];
+    }
+}
+
+// peak suppression: removes the values within radius of the picked index of every curve (-1: none) from the next
+// top_k_block passes
+__kernel void suppress(__global float *values, __global const int *picks, const int radius, const int count){
+    int row = get_global_id(1);
+    int idx = picks[row];
+    int i = idx-radius+get_global_id(0);
+    if(idx >= 0 && i >= 0 && i < count){
+        values[(long)row*count+i] = NAN;
+    }
+}
+"""
+
+# Tunable variants of the strided template kernels (correlate of TEMPLATE_SAD_KERNEL / TEMPLATE_CORRELATION_KERNEL),
+# selected by build options and benchmarked by src/autotuner.py:
+#   -DMETRIC_SAD          SAD instead of the Pearson correlation
+#   -DTEMPLATE_CONSTANT   template in __constant memory
+#   -DTEMPLATE_LOCAL      every work group copies the template into __local memory (scratch)
+#   -DDATA_LOCAL          every work group copies the trace window of all its positions into __local memory (scratch)
+#   -DVECTORIZED          float4 inner loop (changes the summation order, so results differ by rounding)
+# The global size may be padded to a multiple of the work group size, work items j >= count do nothing.
+TUNED_TEMPLATE_KERNEL = FP64_PRAGMA + SAMPLE_DEFINES + """
+#ifdef METRIC_SAD
+    #define INVALID_RESULT -1
+#else
+    #define INVALID_RESULT 0
+#endif
+#ifdef TEMPLATE_CONSTANT
+    #define TEMPLATE_SPACE __constant
+#else
+    #define TEMPLATE_SPACE __global
+#endif
+#ifdef TEMPLATE_LOCAL
+    #define TEMPLATE_PTR_SPACE __local
+#else
+    #define TEMPLATE_PTR_SPACE TEMPLATE_SPACE
+#endif
+// the local trace window holds converted samples
+#ifdef DATA_LOCAL
+    #define DATA_PTR_SPACE __local
+    #define DATA_T float
+    #define DATA(x) (x)
+    #define DATA4(p) vload4(0, p)
+#else
+    #define DATA_PTR_SPACE __global
+    #define DATA_T SAMPLE_T
+    #define DATA(x) SAMPLE(x)
+    #define DATA4(p) SAMPLE4(p)
+#endif
+
+float similarity(DATA_PTR_SPACE const DATA_T* X, TEMPLATE_PTR_SPACE const float* Y, int n){
+#ifdef METRIC_SAD
+    float sad = 0;
+    int i = 0;
+#ifdef VECTORIZED
+    float4 sad4 = 0;
+    for (; i+4 <= n; i += 4){
+        sad4 += fabs(vload4(0, &Y[i])-DATA4(&X[i]));
+    }
+    sad = sad4.x + sad4.y + sad4.z + sad4.w;
+#endif
+    for (; i < n; ++i){
+        sad += fabs((float)(Y[i]-DATA(X[i])));
+    }
+    return sad;
+#else
+    float sum_X = 0, sum_Y = 0, sum_XY = 0;
+    float squareSum_X = 0, squareSum_Y = 0;
+    int i = 0;
+#ifdef VECTORIZED
+    float4 sum_X4 = 0, sum_Y4 = 0, sum_XY4 = 0, squareSum_X4 = 0, squareSum_Y4 = 0;
+    for (; i+4 <= n; i += 4){
+        float4 x = DATA4(&X[i]);
+        float4 y = vload4(0, &Y[i]);
+        sum_X4 += x;
+        sum_Y4 += y;
+        sum_XY4 += x*y;
+        squareSum_X4 += x*x;
+        squareSum_Y4 += y*y;
+    }
+    sum_X = sum_X4.x + sum_X4.y + sum_X4.z + sum_X4.w;
+    sum_Y = sum_Y4.x + sum_Y4.y + sum_Y4.z + sum_Y4.w;
+    sum_XY = sum_XY4.x + sum_XY4.y + sum_XY4.z + sum_XY4.w;
+    squareSum_X = squareSum_X4.x + squareSum_X4.y + squareSum_X4.z + squareSum_X4.w;
+    squareSum_Y = squareSum_Y4.x + squareSum_Y4.y + squareSum_Y4.z + squareSum_Y4.w;
+#endif
+    for (; i < n; ++i){
+        float x = DATA(X[i]);
+        sum_X = sum_X + x;
+        sum_Y = sum_Y + Y[i];
+        sum_XY = sum_XY + x * Y[i];
+        squareSum_X = squareSum_X + x * x;
+        squareSum_Y = squareSum_Y + Y[i] * Y[i];
+    }
+    float corr = (float)(n * sum_XY - sum_X * sum_Y)  / sqrt((float)((n * squareSum_X - sum_X * sum_X) * (n * squareSum_Y - sum_Y * sum_Y)));
+    return corr;
+#endif
+}
+
+__kernel void correlate_tuned(__global const SAMPLE_T *data, __global float *correlation, TEMPLATE_SPACE const float *template_candidate, __local float *scratch,
+                              const int template_length, const int n, const int first_idx, const int stride, const int count){
+    int j = get_global_id(0);
+    int i = first_idx + j*stride;
+#ifdef TEMPLATE_LOCAL
+    __local float *template_local = scratch;
+    for(int k = get_local_id(0); k < template_length; k += get_local_size(0)){
+        template_local[k] = template_candidate[k];
+    }
+    scratch += template_length;
+#endif
+#ifdef DATA_LOCAL
+    // all positions of the work group read from one shared window
+    int group_first = first_idx + get_group_id(0)*get_local_size(0)*stride;
+    int span = (get_local_size(0)-1)*stride + template_length;
+    for(int k = get_local_id(0); k < span; k += get_local_size(0)){
+        scratch[k] = group_first+k < n ? SAMPLE(data[group_first+k]) : 0;
+    }
+#endif
+#if defined(TEMPLATE_LOCAL) || defined(DATA_LOCAL)
+    barrier(CLK_LOCAL_MEM_FENCE);
+#endif
+    if(j >= count){
+        return;
+    }
+    if(i+template_length >= n){
+        correlation[j] = INVALID_RESULT;
+        return;
+    }
+#ifdef TEMPLATE_LOCAL
+    TEMPLATE_PTR_SPACE const float *template_ptr = template_local;
+#else
+    TEMPLATE_PTR_SPACE const float *template_ptr = template_candidate;
+#endif
+#ifdef DATA_LOCAL
+    correlation[j] = similarity(&scratch[i-group_first], template_ptr, template_length);
+#else
+    correlation[j] = similarity(&data[i], template_ptr, template_length);
+#endif
+}
+"""
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+# O(N*R) evaluation of the Algorithm 1 round-similarity q_w(i).
+#
+# The mean segment of start position i is a slice of the comb-summed trace M[k] = sum_r data[k+r*w] (divided by R),
+# so every sum of the Pearson correlation between round r and the mean segment is a window sum:
+#   sum x, sum x^2      -> windows of data and data^2 at i+r*w
+#   sum m, sum m^2      -> windows of M and M^2 at i
+#   sum x*m             -> windows of data[k+r*w]*M[k] at i
+# The window sums are built from cumulative sums that restart for every block of start positions, so the
+# precision does not degrade with the trace length.
+import numpy as np
+
+from src.helper import block_window_sum
+
+
+def prefix_quality_curve(data, w, no_similar_rounds, block_size=None, offset=None):
+    """
+        Computes the round-similarity of every start position for width w on the CPU.
+        Returns the same curve as the OpenCL kernels (float32, 0 for start positions whose rounds do not fit).
+
+        :param data: the trace
+        :param w: width of a round in samples
+        :param no_similar_rounds: number of rounds R that are averaged into the mean segment
+        :param block_size: start positions that are processed with one set of cumulative sums
+        :param offset: value that is subtracted from the trace before summing, defaults to the mean of the trace
+    """
+    w = int(w)
+    rounds = int(no_similar_rounds)
+    n = len(data)
+    quality = np.zeros(n, dtype=np.float32)
+    n_valid = n - rounds*w
+    if n_valid <= 0:
+        return quality
+    if block_size is None:
+        block_size = max(1 << 16, 4*rounds*w)
+    if offset is None:
+        offset = np.mean(data, dtype=np.float64)
+
+    for block_start in range(0, n_valid, block_size):
+        nb = min(block_size, n_valid-block_start)
+        # all samples touched by the start positions of this block
+        segment = np.asarray(
+            data[block_start:block_start+nb+rounds*w], dtype=np.float64) - offset
+
+        comb = np.zeros(nb+w, dtype=np.float64)
+        for r in range(rounds):
+            comb += segment[r*w:r*w+nb+w]
+        sum_m = block_window_sum(comb, w, nb, block_size=nb) / rounds
+        square_sum_m = block_window_sum(
+            comb*comb, w, nb, block_size=nb) / (rounds*rounds)
+        sum_x_all = block_window_sum(
+            segment, w, nb+(rounds-1)*w, block_size=nb+(rounds-1)*w)
+        square_sum_x_all = block_window_sum(
+            segment*segment, w, nb+(rounds-1)*w, block_size=nb+(rounds-1)*w)
+        variance_m = w*square_sum_m - sum_m*sum_m
+
+        avg_correlation = np.zeros(nb, dtype=np.float64)
+        for r in range(rounds):
+            sum_x = sum_x_all[r*w:r*w+nb]
+            square_sum_x = square_sum_x_all[r*w:r*w+nb]
+            sum_xm = block_window_sum(
+                segment[r*w:r*w+nb+w]*comb, w, nb, block_size=nb) / rounds
+            round_correlation = (w*sum_xm - sum_x*sum_m) / np.sqrt(
+                (w*square_sum_x - sum_x*sum_x)*variance_m + 0.00001)
+            avg_correlation += round_correlation/rounds
+        quality[block_start:block_start+nb] = avg_correlation
+    return quality
+
+
+def prefix_ssd_quality_curve(data, w, no_similar_rounds, block_size=None, offset=None):
+    """
+        Negative mean squared-difference round-similarity of every start position for width w:
+        -1/R * sum_r sum_j (m[j]-x_r[j])^2 = -1/R * (sum_r sum x_r^2 - R * sum m^2).
+        Returns float32 with -FLT_MAX for start positions whose rounds do not fit (like the SAD kernels).
+    """
+    w = int(w)
+    rounds = int(no_similar_rounds)
+    n = len(data)
+    quality = np.full(n, np.finfo(np.float32).min, dtype=np.float32)
+    n_valid = n - rounds*w
+    if n_valid <= 0:
+        return quality
+    if block_size is None:
+        block_size = max(1 << 16, 4*rounds*w)
+    if offset is None:
+        offset = np.mean(data, dtype=np.float64)
+
+    for block_start in range(0, n_valid, block_size):
+        nb = min(block_size, n_valid-block_start)
+        segment = np.asarray(
+            data[block_start:block_start+nb+rounds*w], dtype=np.float64) - offset
+
+        comb = np.zeros(nb+w, dtype=np.float64)
+        for r in range(rounds):
+            comb += segment[r*w:r*w+nb+w]
+        square_sum_x_all = block_window_sum(
+            segment*segment, w, nb+(rounds-1)*w, block_size=nb+(rounds-1)*w)
+        square_sum_x = np.zeros(nb, dtype=np.float64)
+        for r in range(rounds):
+            square_sum_x += square_sum_x_all[r*w:r*w+nb]
+        # R * sum m^2 with m = comb/R
+        square_sum_m = block_window_sum(
+            comb*comb, w, nb, block_size=nb) / rounds
+        quality[block_start:block_start+nb] = - \
+            np.maximum(square_sum_x - square_sum_m, 0)/rounds
+    return quality
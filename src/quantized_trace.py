@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+# Traces kept as the integer ADC codes of the oscilloscope plus the vertical gain and offset of the channel.
+# An int16 trace needs a quarter of the memory and bandwidth of a float64 one. The OpenCL kernels read the codes
+# directly and convert them to voltages in registers (see SAMPLE_DEFINES in src/opencl_kernels.py), everything else
+# sees the float32 voltages through the numpy array interface.
+import numpy as np
+from numpy.lib.mixins import NDArrayOperatorsMixin
+
+# OpenCL C type of every supported code dtype
+SAMPLE_TYPES = {np.dtype(np.int8): "char", np.dtype(np.int16): "short"}
+
+
+class QuantizedTrace(NDArrayOperatorsMixin):
+    """
+        Integer codes of a trace, the voltage of a code is gain*(code-offset) (same as LecroyWaveformParser).
+        Slicing gives a QuantizedTrace view, so tiles of the trace stay integer. numpy functions and operators work
+        on the float32 voltages.
+
+        :param codes: int8 or int16 array
+        :param gain: volts per code (voltage_scaling)
+        :param offset: code of 0 V (voltage_offset)
+    """
+
+    def __init__(self, codes, gain=1., offset=0.):
+        codes = np.asarray(codes)
+        if codes.dtype not in SAMPLE_TYPES:
+            raise ValueError("unsupported code dtype: " + str(codes.dtype))
+        self.codes = codes
+        self.gain = float(gain)
+        self.offset = float(offset)
+
+    @classmethod
+    def from_voltages(cls, voltages, dtype=np.int16, gain=None, offset=None):
+        """
+            Quantizes a float trace. Without gain / offset the full code range of dtype is spread over min ... max.
+        """
+        voltages = np.asarray(voltages, dtype=np.float64)
+        info = np.iinfo(dtype)
+        if gain is None or offset is None:
+            low, high = float(np.min(voltages)), float(np.max(voltages))
+            gain = max(high-low, np.finfo(np.float32).tiny)/(info.max-info.min)
+            offset = info.min-low/gain
+        codes = np.clip(np.rint(voltages/gain+offset), info.min, info.max)
+        return cls(codes.astype(dtype), gain, offset)
+
+    def to_voltages(self, dtype=np.float32):
+        # same float32 arithmetic as the SAMPLE macro of the kernels
+        return (self.codes.astype(dtype)-dtype(self.offset))*dtype(self.gain)
+
+    def kernel_options(self):
+        """
+            OpenCL build options of the kernels that read this trace.
+        """
+        return ["-DSAMPLE_T=" + SAMPLE_TYPES[self.codes.dtype],
+                "-DSAMPLE_GAIN=" + "%.9ef" % np.float32(self.gain),
+                "-DSAMPLE_OFFSET=" + "%.9ef" % np.float32(self.offset)]
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, idx):
+        codes = self.codes[idx]
+        if isinstance(idx, slice):
+            return QuantizedTrace(codes, self.gain, self.offset)
+        return ((np.asarray(codes, dtype=np.float32)-np.float32(self.offset))*np.float32(self.gain))[()]
+
+    def __array__(self, dtype=None, copy=None):
+        voltages = self.to_voltages()
+        return voltages if dtype is None else voltages.astype(dtype, copy=False)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = [np.asarray(x) if isinstance(x, QuantizedTrace)
+                  else x for x in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __repr__(self):
+        return "QuantizedTrace(" + str(len(self)) + " x " + str(self.codes.dtype) + ", gain=" + str(self.gain) + \
+            ", offset=" + str(self.offset) + ")"
+
+
+def sample_options(data):
+    """
+        OpenCL build options for the trace data ([] for float traces).
+    """
+    return data.kernel_options() if isinstance(data, QuantizedTrace) else []
@@ -1,23 +1,26 @@
 import numpy as np
 import itertools
-from bokeh.plotting import figure, show
-from bokeh.palettes import Dark2_5 as palette
-from bokeh.io import output_notebook, reset_output
 
 from src.autocorrelation_accl import Autocorrelation_Accelerator
-from src.helper import calc_sad
 
 
 class Refiner:
-    def __init__(self, trace_container):
+    def __init__(self, trace_container, session=None, template_engine="direct", backend=None):
         self.trace_container = trace_container
+        # pass the SampleFinder's session to reuse its device-resident trace, None uses the process wide default session
+        self.session = session
+        # "direct" or "fft" for the correlation in get_template_with_corr
+        self.template_engine = template_engine
+        # backend for the correlation in get_template_with_corr, see SampleFinder
+        self.backend = backend
 
     def get_template_with_sad(self, plot_template_on_index=0, plot_finished_template=False, use_top_x_percent=0):
         # adjust offsets when cutting. idea:
         # 1st. try all offsets (-max_offset to +max_offset) with SAD and see what is best
         # 2nd. try offsets in this bracket (-width,+width) for minimum SAD!
         # ranking possible due to min SAD for each trace!
-        accl = Autocorrelation_Accelerator()
+        accl = Autocorrelation_Accelerator(
+            session=self.session, template_engine=self.template_engine, backend=self.backend)
         rounds_in_co_template = self.trace_container.rounds_in_co_template
         max_offset = rounds_in_co_template
         width = int(self.trace_container.calculated_width)
@@ -35,29 +38,30 @@ class Refiner:
             start_aes_list[0]+(rounds_in_co_template)*width)]
         # for i, color in zip(range(show_offset,show_offset+nr_traces_to_show), colors): #Adjust range(n) to plot certain traces
 
-        for aes_idx, list_idx in zip(start_aes_list[1:], range(len(start_aes_list[1:]))):
-            sad_values = [calc_sad(baseline_encryption, trace[int(aes_idx-(offset)*width):int(aes_idx-(
-                offset)*width)+len(baseline_encryption)]) for offset in range(-max_offset, max_offset+1)]
-            best_offset = np.array(
-                range(-max_offset, max_offset+1))[np.argmin(sad_values)]
-
-            #sad_values = accl.calc_sad(baseline_encryption,trace[int(aes_idx-(max_offset*width)):int(aes_idx+(max_offset*width)+len(baseline_encryption))])
-            # best_offset_new=np.array(range(int(-(max_offset*width)),int((max_offset*width)+len(baseline_encryption))))[np.argmin(sad_values)]
-            sad_values_offset_width = [calc_sad(baseline_encryption, trace[int(aes_idx-(best_offset*width + offset_width)):int(
-                aes_idx-(best_offset*width + offset_width))+len(baseline_encryption)]) for offset_width in range(-width, width+1)]
-
-            best_offset_width = np.array(
-                range(-width, width+1))[np.argmin(sad_values_offset_width)]
-            #print("best offset old: " + str(best_offset) + " best offset width: " +str(best_offset_width) +"   best offset new" + str(best_offset_new))
+        # all (CO x offset) SADs in two batched calls: coarse offsets in multiples of width, then -width ... width around the best one
+        offsets = np.arange(-max_offset, max_offset+1)
+        sad_values = accl.calc_sad_matrix(
+            baseline_encryption, trace, start_aes_list[1:], -offsets*width)
+        best_offsets = offsets[np.argmin(sad_values, axis=1)] if len(
+            sad_values) > 0 else np.array([], dtype=int)
+        offsets_width = np.arange(-width, width+1)
+        sad_values_offset_width = accl.calc_sad_matrix(
+            baseline_encryption, trace, start_aes_list[1:]-best_offsets*width, -offsets_width)
+        cut_aes_traces = [finished_cut_aes_traces[0]]
+        for aes_idx, best_offset, sad_row in zip(start_aes_list[1:], best_offsets, sad_values_offset_width):
+            best_offset_width = offsets_width[np.argmin(sad_row)]
             if use_top_x_percent > 0:
                 df_id_to_sad.append({'list_idx': aes_idx, 'sad_value': np.amin(
-                    sad_values_offset_width)}, ignore_index=True)
-            # print(best_offset_width)
-            finished_cut_aes_traces = np.append(finished_cut_aes_traces, [trace[int(aes_idx-((max_offset+best_offset)*width + best_offset_width)):int(
-                aes_idx-((max_offset+best_offset)*width + best_offset_width))+len(finished_cut_aes_traces[0])]], axis=0)
+                    sad_row)}, ignore_index=True)
+            cut_aes_traces.append(trace[int(aes_idx-((max_offset+best_offset)*width + best_offset_width)):int(
+                aes_idx-((max_offset+best_offset)*width + best_offset_width))+len(finished_cut_aes_traces[0])])
+        finished_cut_aes_traces = np.array(cut_aes_traces)
         if plot_template_on_index > 0:
             show_offset = 35
             nr_traces_to_show = plot_template_on_index
+            from bokeh.io import output_notebook, reset_output
+            from bokeh.palettes import Dark2_5 as palette
+            from bokeh.plotting import figure, show
             reset_output()
             output_notebook()
             p = figure(width=900, height=600)
@@ -85,6 +89,8 @@ class Refiner:
         sad_adjusted_template = np.average([finished_cut_aes_traces[idx] for idx in idx_list], axis=0)[
             max_offset*width:len(finished_cut_aes_traces[0])-max_offset*width]
         if plot_finished_template:
+            from bokeh.io import output_notebook, reset_output
+            from bokeh.plotting import figure, show
             reset_output()
             output_notebook()
             p = figure(width=900, height=600)
@@ -100,7 +106,8 @@ class Refiner:
         # 1st. try all offsets (-max_offset to +max_offset) with SAD and see what is best
         # 2nd. try offsets in this bracket (-width,+width) for minimum SAD!
         # ranking possible due to min SAD for each trace!
-        accl = Autocorrelation_Accelerator()
+        accl = Autocorrelation_Accelerator(
+            session=self.session, template_engine=self.template_engine, backend=self.backend)
         rounds_in_co_template = self.trace_container.rounds_in_co_template
         if max_offset == None:
             max_offset = rounds_in_co_template
@@ -124,10 +131,10 @@ class Refiner:
             endpoint = int(aes_idx+max_offset*width+len(baseline_encryption))
             if startpoint < 0 or endpoint > len(trace):
                 continue
-            trace_segment = trace[startpoint:endpoint]
 
-            corr_values = accl.correlate(trace_segment, baseline_encryption, idx_list=range(
-                max_offset*width*2), print_times=False)
+            # correlate against the resident trace instead of uploading a new segment for every CO
+            corr_values = accl.correlate(trace, baseline_encryption, idx_list=np.arange(
+                startpoint, startpoint+max_offset*width*2), print_times=False)
             best_offset = np.argmax(corr_values)-max_offset*width
             if print_info:
                 print(best_offset)
@@ -147,6 +154,9 @@ class Refiner:
         if plot_template_on_index > 0:
             show_offset = 0
             nr_traces_to_show = plot_template_on_index
+            from bokeh.io import output_notebook, reset_output
+            from bokeh.palettes import Dark2_5 as palette
+            from bokeh.plotting import figure, show
             reset_output()
             output_notebook()
             p = figure(width=900, height=600)
@@ -174,6 +184,8 @@ class Refiner:
         sad_adjusted_template = np.average([finished_cut_aes_traces[idx] for idx in idx_list], axis=0)[
             max_offset*width:len(finished_cut_aes_traces[0])-max_offset*width]
         if plot_finished_template:
+            from bokeh.io import output_notebook, reset_output
+            from bokeh.plotting import figure, show
             reset_output()
             output_notebook()
             p = figure(width=900, height=600)
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+# Exact top-k SAD template search with pruning. Every position first gets a cheap lower bound of its SAD (PAA bound from
+# window sums). The most promising positions are evaluated first to get a k-th best SAD, every other position is then
+# only evaluated if its bound does not exceed it, and abandoned as soon as its partial sum does.
+import numpy as np
+from numba import njit
+
+from src.helper import block_window_sum
+from src.numba_kernels import template_sad_early_abandon
+
+# relative rounding error of a float32 SAD of length L is below (L+2)*2^-23, the lower bounds are lowered by that much
+FLOAT32_EPS = 2.**-23
+
+
+def paa_lower_bound(trace, template, positions, segments=16):
+    """
+        Lower bound of the SAD of template at every position: the template is split into segments parts (piecewise
+        aggregate approximation) and sum |sum of the trace part - sum of the template part| <= SAD (triangle inequality).
+        segments=1 is the bound of the window sums. Returns float64.
+    """
+    template = np.asarray(template, dtype=np.float64)
+    template_length = len(template)
+    segments = max(1, min(int(segments), template_length))
+    bounds = np.arange(segments+1)*template_length//segments
+    positions = np.asarray(positions)
+    lower_bound = np.zeros(len(positions), dtype=np.float64)
+    # window sums of the trace for each (at most two) segment length
+    window_sums = {}
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        length = last-first
+        if length not in window_sums:
+            window_sums[length] = block_window_sum(trace, length)
+        lower_bound += np.abs(window_sums[length][positions+first] -
+                              np.sum(template[first:last]))
+    # the float32 SADs may be rounded below the exact value
+    return lower_bound*(1-(template_length+2)*FLOAT32_EPS)
+
+
+@njit(cache=True)
+def _greedy_picks(order, k, suppression_before, suppression_after, nr_positions):
+    # the first k entries of order (indices, best first) that are not within suppression_before entries before or
+    # suppression_after entries after an earlier pick
+    suppressed = np.zeros(nr_positions, dtype=np.bool_)
+    picks = np.empty(k, dtype=np.int64)
+    nr_picks = 0
+    for idx in order:
+        if suppressed[idx]:
+            continue
+        picks[nr_picks] = idx
+        nr_picks += 1
+        if nr_picks == k:
+            break
+        suppressed[max(0, idx-suppression_before):min(nr_positions, idx+suppression_after+1)] = True
+    return picks[:nr_picks]
+
+
+def sad_top_k(trace, template, k, positions=None, suppression_radius=0, suppression_after=None, segments=16, first_batch=None,
+              print_info=False):
+    """
+        The k best (smallest SAD) matches of template among positions, greedily skipping matches within
+        suppression_radius entries of positions of a better match (like top_k_peaks on the negative SAD).
+        Gives the same matches as top_k_peaks on the negative exhaustive scan (template_sad of all positions), also for
+        equal SADs: ties go to the larger index.
+        All positions have to fit into the trace (i+len(template) < len(trace)).
+
+        :param positions: start positions, default all of them
+        :param suppression_after: entries after a match that are suppressed, default suppression_radius (e.g.
+                                  suppression_radius-1 for the half-open window of get_peaks_above_threshold)
+        :param segments: number of PAA segments of the lower bound
+        :param first_batch: number of positions that are evaluated first, default max(64*k, 4096)
+        :return: (indices into positions, SADs), best first
+    """
+    trace = np.ascontiguousarray(trace, dtype=np.float32)
+    template = np.ascontiguousarray(template, dtype=np.float32)
+    if positions is None:
+        positions = np.arange(len(trace)-len(template))
+    positions = np.asarray(positions, dtype=np.int64)
+    nr_positions = len(positions)
+    if suppression_after is None:
+        suppression_after = suppression_radius
+    if k <= 0 or nr_positions == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+
+    lower_bound = paa_lower_bound(trace, template, positions, segments)
+    # exact SADs (NaN while unknown)
+    sad = np.full(nr_positions, np.nan, dtype=np.float32)
+    batch = first_batch if first_batch is not None else max(64*k, 4096)
+    evaluated = 0
+    while True:
+        exact = np.flatnonzero(~np.isnan(sad))
+        # smallest SAD first, equal SADs larger index first (like top_k_peaks)
+        order = exact[np.lexsort((-exact, sad[exact]))]
+        picks = _greedy_picks(order, k, suppression_radius,
+                              suppression_after, nr_positions)
+        threshold = sad[picks[-1]] if len(picks) == k else np.inf
+        # everything that could still be better than (or as good as) the current k-th match
+        todo = np.flatnonzero(np.isnan(sad) & (lower_bound <= threshold))
+        if len(todo) == 0:
+            break
+        if np.isinf(threshold) and len(todo) > batch:
+            # not enough matches yet: the most promising positions first, everything else once there is a threshold
+            todo = todo[np.argpartition(lower_bound[todo], batch)[:batch]]
+            batch *= 2
+        values, complete = template_sad_early_abandon(
+            trace, template, positions[todo], threshold)
+        sad[todo[complete]] = values[complete]
+        # partial sums are better lower bounds
+        lower_bound[todo[~complete]] = values[~complete]
+        evaluated += len(todo)
+    if print_info:
+        print("sad_top_k: " + str(evaluated) + " of " + str(nr_positions) + " positions evaluated, " +
+              str(len(exact)) + " of them completely")
+    return picks, sad[picks]
@@ -2,21 +2,25 @@
 
 # sure imports
 import numpy as np
-import holoviews as hv
-from bokeh.plotting import figure, show
-from bokeh.io import output_notebook, reset_output
 
 from src.helper import _print, detrending_filter
 from src.autocorrelation_accl import Autocorrelation_Accelerator
 
 
 class SampleFinder:
-    def __init__(self, trace_container, top_x=10, do_plots=False, print_info=True, error_margin=0.02, exact_clk_cycles=None, allowed_sub_peak_delta=2):
+    def __init__(self, trace_container, top_x=10, do_plots=False, print_info=True, error_margin=0.02, exact_clk_cycles=None, allowed_sub_peak_delta=2, session=None, template_engine="direct", backend=None):
         if(print_info):
             print("initialized the sample finder with " + str(trace_container.nr_hidden_cos) +
                   " hidden aes cycles, sample rate of " + str(trace_container.get_fs()))
 
         self.trace_container = trace_container
+        # ComputeSession shared by all accelerators (and the Refiner), None uses the process wide default session
+        self.session = session
+        # "direct" or "fft" for the Pearson template searches (see Autocorrelation_Accelerator.correlate)
+        self.template_engine = template_engine
+        # "opencl", "numba" (parallel CPU kernels for machines without a GPU), "numpy" or "auto" for all similarity kernels,
+        # None uses CO_FINDER_BACKEND or "auto" (see src/backends.py)
+        self.backend = backend
 
         if exact_clk_cycles == None:
             self.min_clk_cycles = max(
@@ -35,6 +39,7 @@ class SampleFinder:
         self.do_plots = do_plots
         self.dict_plots = None
         self.df_corr_for_each_width = None
+        self.similarity_result = None
         self.allowed_sub_peak_delta = allowed_sub_peak_delta
 
         self.correlation_dict = {}
@@ -42,7 +47,7 @@ class SampleFinder:
         self.mean_event_dicts = {}
 
     #
-    def full_auto_find_COs(self, do_quality_plot=False, do_main_sub_peak_plot=False, sad_for_autocorr=False, sad_approach=True, avg_round_template=True, use_detrended=False):
+    def full_auto_find_COs(self, do_quality_plot=False, do_main_sub_peak_plot=False, sad_for_autocorr=False, sad_approach=True, avg_round_template=True, use_detrended=False, autocorr_engine=None, distance_metric="sad", backend=None, clock_stride=False, reduce_on_device=False, pipelined=False, scheduler=None, keep_curves="none"):
         """
             full_auto_find_COs Finds all COs in the trace in self.trace_container.
 
@@ -52,6 +57,14 @@ class SampleFinder:
             :param sad_approach: Calculates the similarity of the found template candidate (through step 1) with SAD instead of the Pearson correlation
             :param avg_round_template: Instead of using the entire CO as a template, average all rounds, then concatenate them together
             :param use_detrended: Use a rolling average filter to detrend the similarity of the similarity in step 1
+            :param distance_metric: "sad" or "ssd" (sum of squared differences, O(N log L) via FFT), used wherever sad_for_autocorr or sad_approach select a distance
+            :param autocorr_engine: "per_width", "multi_width" (all widths with one program and one launch per batch) or "prefix_sum" (O(N*R) per width, pearson only). None picks "multi_width" when more than one width is tested
+            :param backend: "opencl", "numba", "numpy" or "auto", None keeps the backend of the SampleFinder. Also used by the later template searches of this SampleFinder
+            :param clock_stride: Step 1 first evaluates start positions one clock period apart and refines only around the best ones (much faster, needs use_detrended=False)
+            :param reduce_on_device: detrend and pick the best start positions of Step 1 where the similarity was computed, only the top_x results of every width are copied back
+            :param pipelined: compute the next width of Step 1 while the current one is post-processed on the host
+            :param scheduler: WidthScheduler (src/scheduler.py) that spreads the widths of Step 1 over all OpenCL devices and CPU worker processes
+            :param keep_curves: "none", "memmap" or "memory", what self.similarity_result keeps of the full quality curves of Step 1 (see SimilarityResult)
             :return: returns a triple with the best_fitting_width found, a list of starting indices that we found and the CO-Template candidate that we chose.
         """
         f_device = self.trace_container.known_device_frequency
@@ -68,19 +81,29 @@ class SampleFinder:
         # 2. Test all possible widths, find starting index that has best autocorreltaion
         from time import process_time
         t1_start = process_time()
+        if backend != None:
+            self.backend = backend
+        if autocorr_engine == None:
+            autocorr_engine = "multi_width" if len(
+                possible_widths) > 1 else "per_width"
         opencl_autocorr = Autocorrelation_Accelerator(self.trace_container.get_trace(
-        ), self.trace_container.no_similar_rounds, self.top_x, do_plots=do_quality_plot, use_detrended=use_detrended, trace_container=self.trace_container)
+        ), self.trace_container.no_similar_rounds, self.top_x, do_plots=do_quality_plot, use_detrended=use_detrended, trace_container=self.trace_container, session=self.session, engine=autocorr_engine, backend=self.backend, start_stride=max(1, int(round(samples_per_clock))) if clock_stride else None, reduce_on_device=reduce_on_device, pipelined=pipelined, scheduler=scheduler, keep_curves=keep_curves)
         if sad_for_autocorr:
             best_widths, widths_correlation, correlation_for_each_width = opencl_autocorr.autosad_accelerated_updated(
-                possible_widths)
+                possible_widths, distance_metric=distance_metric)
         else:
             best_widths, widths_correlation, correlation_for_each_width = opencl_autocorr.autocorrelation_accelerated_updated(
                 possible_widths)
+        # per-width results of Step 1, the full curves can be requested from it
+        self.similarity_result = correlation_for_each_width
         t1_stop = process_time()
         self.alg1_time_sec = t1_stop-t1_start
         if self.print_info:
-            print("GPU: Finding best possible starting points used " +
+            backend_name = opencl_autocorr.get_backend().name
+            print(("GPU" if backend_name == "opencl" else backend_name) + ": Finding best possible starting points used " +
                   str((t1_stop-t1_start)) + " seconds")
+            if backend_name == "opencl":
+                opencl_autocorr.get_backend().get_session().program_cache.print_stats()
             print(best_widths)
             best_width = possible_widths[int(best_widths[0, 1])]
             starting_position = widths_correlation[int(
@@ -92,7 +115,7 @@ class SampleFinder:
         # 3. calculate best fitting width, utilizing the number of sub-peaks behind each main-peak.
         find_best_fitting_width_start = process_time()
         best_fitting_width, peak_idx_list, char_trace_template = self.get_best_fitting_width(
-            best_widths, possible_widths, widths_correlation, f_device, sad_approach=sad_approach, avg_round_template=avg_round_template, allowed_sub_peak_delta=self.allowed_sub_peak_delta, do_plots=do_main_sub_peak_plot)
+            best_widths, possible_widths, widths_correlation, f_device, sad_approach=sad_approach, avg_round_template=avg_round_template, allowed_sub_peak_delta=self.allowed_sub_peak_delta, do_plots=do_main_sub_peak_plot, distance_metric=distance_metric)
         find_best_fitting_width_end = process_time()
         self.alg2_time_sec = find_best_fitting_width_end-find_best_fitting_width_start
         if self.print_info:
@@ -169,7 +192,7 @@ class SampleFinder:
         return peak_idx, nr_of_peaks
 
     # Evaluate certain best width:
-    def get_peaks_for_width(self, f_device, width, starting_position, min_number_of_sub_peaks=8, do_plots=False, print_info=False, max_num_peaks=5000, new_chosen_mean_event=None, sad_approach=False, avg_round_template=True, allowed_sub_peak_delta=1):
+    def get_peaks_for_width(self, f_device, width, starting_position, min_number_of_sub_peaks=8, do_plots=False, print_info=False, max_num_peaks=5000, new_chosen_mean_event=None, sad_approach=False, avg_round_template=True, allowed_sub_peak_delta=1, distance_metric="sad"):
         samples_per_clock = self.trace_container.get_fs()/f_device
         w = int(width)
         i = int(starting_position)
@@ -193,7 +216,8 @@ class SampleFinder:
                 )[i:i+w*self.trace_container.rounds_in_co_template]
 
             if not sad_approach:
-                corrl_accl = Autocorrelation_Accelerator()
+                corrl_accl = Autocorrelation_Accelerator(
+                    session=self.session, template_engine=self.template_engine, backend=self.backend)
                 all_correlation = corrl_accl.correlate(
                     self.trace_container.get_trace(), chosen_mean_event, idx_list, opencl=True)
 
@@ -203,16 +227,19 @@ class SampleFinder:
                 self.correlation_dict[w] = all_correlation
                 self.filtered_correlation_dict[w] = filtered_correlation
             else:
-                corrl_accl = Autocorrelation_Accelerator()
+                corrl_accl = Autocorrelation_Accelerator(
+                    session=self.session, template_engine=self.template_engine, backend=self.backend)
                 self.mean_event_dicts[w] = chosen_mean_event
-                sad_over_everything = np.array(corrl_accl.calc_sad(
-                    self.mean_event_dicts[w], self.trace_container.get_trace(), idx_list=idx_list))
+                sad_over_everything = np.array(corrl_accl.calc_distance(
+                    self.mean_event_dicts[w], self.trace_container.get_trace(), idx_list=idx_list, distance_metric=distance_metric))
                 all_correlation = -1*sad_over_everything
                 filtered_correlation = detrending_filter(
                     all_correlation, (w)/correlation_step_size)
                 self.correlation_dict[w] = all_correlation
                 self.filtered_correlation_dict[w] = filtered_correlation
             if do_plots:
+                from bokeh.io import output_notebook, reset_output
+                from bokeh.plotting import figure, show
                 reset_output()
                 output_notebook()
                 p = figure(width=900, height=600)
@@ -260,7 +287,7 @@ class SampleFinder:
         return (peak_idx_list, least_peaks, chosen_mean_event)
 
     # Evaluate certain best width:
-    def get_best_fitting_width(self, best_widths, w_list, widths_correlation, f_device, sad_approach=False, avg_round_template=True, allowed_sub_peak_delta=1, do_plots=False):
+    def get_best_fitting_width(self, best_widths, w_list, widths_correlation, f_device, sad_approach=False, avg_round_template=True, allowed_sub_peak_delta=1, do_plots=False, distance_metric="sad"):
         best_fitting_width = 0
         least_peaks_array = np.zeros(
             len(best_widths[:, 1]))+self.trace_container.no_similar_rounds
@@ -284,7 +311,7 @@ class SampleFinder:
                 starting_position = widths_correlation[int(width_idx), 0, 1]
                 # Find number of main-peaks for this width with at least min_number_of_subpeaks:
                 peak_idx_list, least_peaks_array[least_peaks_array_idx], chosen_mean_events[idx] = self.get_peaks_for_width(f_device, width, starting_position, min_number_of_sub_peaks=min_number_of_sub_peaks, do_plots=do_plots, max_num_peaks=(
-                    self.trace_container.nr_hidden_cos*2 + self.trace_container.nr_hidden_cos*allowed_sub_peak_delta), sad_approach=sad_approach, avg_round_template=avg_round_template, allowed_sub_peak_delta=allowed_sub_peak_delta)
+                    self.trace_container.nr_hidden_cos*2 + self.trace_container.nr_hidden_cos*allowed_sub_peak_delta), sad_approach=sad_approach, avg_round_template=avg_round_template, allowed_sub_peak_delta=allowed_sub_peak_delta, distance_metric=distance_metric)
                 if least_peaks_array[least_peaks_array_idx] == -1:
                     continue
                 if(len(peak_idx_list) >= int(self.trace_container.nr_hidden_cos) and len(peak_idx_list) <= self.trace_container.nr_hidden_cos + int(self.trace_container.nr_hidden_cos*self.error_margin)):  # Margin for error :)
@@ -310,8 +337,14 @@ class SampleFinder:
                 return best_fitting_width, return_peak_idx_list, char_trace_template
         return -1, -1, -1  # no fitting width found!
 
-    def find_COs_with_template(self, template, do_plots=False, print_info=True, use_sad=True, no_decimation=True):
-        corrl_accl = Autocorrelation_Accelerator()
+    def find_COs_with_template(self, template, do_plots=False, print_info=True, use_sad=True, no_decimation=True, distance_metric="sad", top_k_sad=False):
+        """
+            :param top_k_sad: only search the nr_hidden_cos best SAD matches (pruned search), much faster on traces that
+                              are mostly idle. Same index convention and exclusion zone as get_peaks_above_threshold,
+                              but the raw SADs are ranked: no detrending and no threshold (both need the full curve).
+        """
+        corrl_accl = Autocorrelation_Accelerator(
+            session=self.session, template_engine=self.template_engine, backend=self.backend)
         samples_per_clock = self.trace_container.get_fs(
         )/self.trace_container.calculated_device_frequency
         w = int(self.trace_container.calculated_width)
@@ -327,15 +360,26 @@ class SampleFinder:
             correlation_step_size = 1
         idx_list = np.arange(start_offset, len(self.trace_container.get_trace(
         ))-len(template), step=correlation_step_size, dtype=int)
+        if use_sad and top_k_sad and distance_metric == "sad":
+            window_size = int(self.trace_container.calculated_width) * \
+                self.trace_container.no_similar_rounds
+            # same exclusion zone around a match as get_peaks_above_threshold: [idx-radius, idx+radius) entries
+            suppression_radius = int(window_size/correlation_step_size*0.7)
+            peak_positions, _ = corrl_accl.calc_sad_top_k(template, self.trace_container.get_trace(), self.trace_container.nr_hidden_cos,
+                                                          idx_list, suppression_radius, suppression_after=suppression_radius-1)
+            # entry of idx_list times the step, like get_peaks_above_threshold (without start_offset)
+            return np.searchsorted(idx_list, peak_positions)*correlation_step_size
         if use_sad:
-            correlation = np.array(corrl_accl.calc_sad(
-                template, self.trace_container.get_trace(), idx_list))*-1
+            correlation = np.array(corrl_accl.calc_distance(
+                template, self.trace_container.get_trace(), idx_list, distance_metric=distance_metric))*-1
         else:
             correlation = corrl_accl.correlate(
                 self.trace_container.get_trace(), template, idx_list, opencl=True)
         filtered_correlation = detrending_filter(
             correlation, (int(self.trace_container.calculated_width))/correlation_step_size)
         if do_plots:
+            import holoviews as hv
+            from bokeh.plotting import show
             curve = hv.Curve((range(0, len(filtered_correlation)), np.array(
                 filtered_correlation)), label="filtered correlation")
             curve = curve.options(xlabel='Sample', ylabel='correlation')
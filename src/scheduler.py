@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+# Distributes the quality curves of Algorithm 1 over every OpenCL device and a pool of CPU worker processes.
+# The work units are widths (or width x tile), every worker owns a deque of units and steals from the fullest deque
+# of the others once its own deque is empty, so fast and slow workers finish at about the same time.
+import multiprocessing
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+import numpy as np
+
+from src.backends import BACKENDS, OpenCLBackend, get_backend, tiled_quality_curves, _tile_start
+
+try:
+    import pyopencl as cl
+except ImportError:
+    cl = None
+
+
+class WorkStealingQueue:
+    """
+        One deque of work units per worker. The units are dealt in contiguous blocks (neighbouring widths share the
+        most similar cost), a worker takes from the front of its own deque and steals from the back of the fullest one.
+    """
+
+    def __init__(self, units, nr_workers):
+        self._lock = threading.Lock()
+        self._deques = [deque() for _ in range(nr_workers)]
+        for worker_idx, block in enumerate(np.array_split(np.arange(len(units)), nr_workers)):
+            self._deques[worker_idx].extend(units[idx] for idx in block)
+        self.stolen = [0]*nr_workers
+
+    def next(self, worker_idx):
+        """
+            Returns the next unit for worker_idx, None if there is no work left.
+        """
+        with self._lock:
+            own = self._deques[worker_idx]
+            if own:
+                return own.popleft()
+            victim = max(range(len(self._deques)),
+                         key=lambda idx: len(self._deques[idx]))
+            if not self._deques[victim]:
+                return None
+            self.stolen[worker_idx] += 1
+            return self._deques[victim].pop()
+
+    def clear(self):
+        with self._lock:
+            for unit_deque in self._deques:
+                unit_deque.clear()
+
+
+def _unit_curve(backend, data, unit, w_list, no_similar_rounds, metric, engine, tile_samples):
+    # quality curve of one work unit (w_idx, start, stop), only the positions start ... stop-1
+    w_idx, start, stop = unit
+    tile_start = 0 if tile_samples is None else _tile_start(
+        start, len(data), tile_samples)
+    tile = data if tile_samples is None else data[tile_start:tile_start+tile_samples]
+    for _, curve in tiled_quality_curves(backend, tile, [w_list[w_idx]], no_similar_rounds, metric, engine):
+        return curve[start-tile_start:stop-tile_start]
+
+
+class DeviceWorker:
+    """
+        One OpenCL device with its own context, queue and ComputeSession. Runs in a thread of the main process.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.name = "opencl:" + str(device.name).strip()
+        self._backend = None
+
+    def compute(self, data, unit, w_list, no_similar_rounds, metric, engine, tile_samples):
+        if self._backend is None:
+            from src.compute_session import ComputeSession
+            self._backend = OpenCLBackend(
+                ComputeSession(cl.Context([self.device])))
+        return _unit_curve(self._backend, data, unit, w_list, no_similar_rounds, metric, engine, tile_samples)
+
+    def load(self, data):
+        pass
+
+    def close(self):
+        if self._backend is not None:
+            self._backend.get_session().release()
+            self._backend = None
+
+
+# state of a CPU worker process
+_process_backend = None
+_process_data = None
+
+
+def _init_worker_process(backend_name, threads):
+    global _process_backend
+    if threads is not None and backend_name == "numba":
+        import numba
+        numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+    _process_backend = get_backend(backend_name)
+    if backend_name == "numba":
+        # compile (or load from the disk cache) before the first unit, so it does not delay the first result
+        from src.numba_kernels import warm_up
+        warm_up()
+
+
+def _load_process_data(data):
+    global _process_data
+    _process_data = data
+
+
+def _process_unit(unit, w_list, no_similar_rounds, metric, engine, tile_samples):
+    return _unit_curve(_process_backend, _process_data, unit, w_list, no_similar_rounds, metric, engine, tile_samples)
+
+
+class ProcessWorker:
+    """
+        One CPU worker process that runs a CPU backend ("numba" or "numpy") with the given number of threads.
+        Processes are spawned (not forked), so they never inherit OpenCL state of the main process.
+    """
+
+    def __init__(self, backend_name="numba", threads=None, index=0):
+        self.backend_name = backend_name
+        self.threads = threads
+        self.name = "cpu:" + backend_name + ":" + str(index)
+        self._executor = None
+
+    def load(self, data):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn"),
+                                                 initializer=_init_worker_process, initargs=(self.backend_name, self.threads))
+        self._executor.submit(_load_process_data, data).result()
+
+    def compute(self, data, unit, w_list, no_similar_rounds, metric, engine, tile_samples):
+        return self._executor.submit(_process_unit, unit, w_list, no_similar_rounds, metric, engine, tile_samples).result()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+def opencl_devices(device_types="gpu"):
+    """
+        All OpenCL devices of all platforms. device_types "gpu" keeps GPUs and accelerators only (the CPU is already
+        used by the worker processes), "all" keeps every device.
+    """
+    if cl is None or not OpenCLBackend.is_available():
+        return []
+    devices = []
+    for platform in cl.get_platforms():
+        for device in platform.get_devices():
+            if device_types == "all" or not device.type & cl.device_type.CPU:
+                devices.append(device)
+    return devices
+
+
+class WidthScheduler:
+    """
+        Computes the quality curves of many widths with all compute resources at once, see quality_curves.
+        The workers (OpenCL sessions, CPU processes) are created on first use and kept until close().
+
+        :param devices: list of OpenCL devices, None for all GPUs / accelerators (see opencl_devices), [] for none
+        :param cpu_workers: number of CPU worker processes, None for one per threads_per_process cores
+        :param cpu_backend: backend of the worker processes, "numba" or "numpy"
+        :param threads_per_process: threads of every worker process
+        :param tile_samples: split every width into units of at most tile_samples samples (including the halo), None keeps whole widths
+        :param print_info: print which worker computed how many units
+    """
+
+    def __init__(self, devices=None, cpu_workers=None, cpu_backend="numba", threads_per_process=4, tile_samples=None, print_info=False):
+        if devices is None:
+            devices = opencl_devices()
+        if cpu_backend not in BACKENDS:
+            raise ValueError("unknown backend: " + str(cpu_backend))
+        if cpu_workers is None:
+            cpu_workers = max(1, (os.cpu_count() or 1)//threads_per_process)
+        self.workers = [DeviceWorker(device) for device in devices] + \
+            [ProcessWorker(cpu_backend, threads_per_process, idx)
+             for idx in range(cpu_workers)]
+        if len(self.workers) == 0:
+            raise ValueError("the scheduler needs at least one device or CPU worker")
+        self.tile_samples = tile_samples
+        self.print_info = print_info
+        # worker name -> units computed / stolen in the last run
+        self.stats = {}
+
+    def _units(self, n, w_list, no_similar_rounds):
+        if self.tile_samples is None or n <= self.tile_samples:
+            return [(w_idx, 0, n) for w_idx in range(len(w_list))]
+        positions_per_tile = self.tile_samples-no_similar_rounds*max(w_list)
+        if positions_per_tile <= 0:
+            raise ValueError("tiles of " + str(self.tile_samples) + " samples are shorter than the halo of " +
+                             str(no_similar_rounds*max(w_list)) + " samples")
+        return [(w_idx, start, min(start+positions_per_tile, n))
+                for w_idx in range(len(w_list)) for start in range(0, n, positions_per_tile)]
+
+    def quality_curves(self, data, w_list, no_similar_rounds, metric="pearson", engine="per_width"):
+        """
+            Same as ComputeBackend.quality_curves: yields (w, quality curve) in the order of w_list, every width as soon
+            as all of its units are done. Every w*no_similar_rounds has to fit into data.
+        """
+        w_list = [int(w) for w in w_list]
+        if len(w_list) == 0:
+            return
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        n = len(data)
+        units = self._units(n, w_list, no_similar_rounds)
+        unit_tile_samples = None if len(units) == len(
+            w_list) else self.tile_samples
+        work = WorkStealingQueue(units, len(self.workers))
+        results = queue.Queue()
+        computed = [0]*len(self.workers)
+
+        def run(worker_idx):
+            worker = self.workers[worker_idx]
+            try:
+                worker.load(data)
+                while True:
+                    unit = work.next(worker_idx)
+                    if unit is None:
+                        break
+                    curve = worker.compute(
+                        data, unit, w_list, no_similar_rounds, metric, engine, unit_tile_samples)
+                    computed[worker_idx] += 1
+                    results.put((unit, curve, None))
+            except Exception as e:
+                work.clear()
+                results.put((None, None, e))
+
+        t_start = perf_counter()
+        threads = [threading.Thread(target=run, args=(idx,), daemon=True)
+                   for idx in range(len(self.workers))]
+        for thread in threads:
+            thread.start()
+        try:
+            curves = {}
+            missing_units = {}
+            for w_idx, _, _ in units:
+                missing_units[w_idx] = missing_units.get(w_idx, 0)+1
+            next_w_idx = 0
+            for _ in range(len(units)):
+                unit, curve, error = results.get()
+                if error is not None:
+                    raise error
+                w_idx, start, stop = unit
+                if w_idx not in curves:
+                    curves[w_idx] = np.empty(n, dtype=np.float32)
+                curves[w_idx][start:stop] = curve
+                missing_units[w_idx] -= 1
+                while next_w_idx < len(w_list) and missing_units[next_w_idx] == 0:
+                    yield w_list[next_w_idx], curves.pop(next_w_idx)
+                    next_w_idx += 1
+        finally:
+            work.clear()
+            for thread in threads:
+                thread.join()
+        self.stats = {worker.name: {"units": computed[idx], "stolen": work.stolen[idx]}
+                      for idx, worker in enumerate(self.workers)}
+        if self.print_info:
+            print("WidthScheduler: " + str(len(units)) + " units in " +
+                  str(round(perf_counter()-t_start, 3)) + " s")
+            for name, worker_stats in self.stats.items():
+                print("\t" + name + ": " + str(worker_stats["units"]) +
+                      " units (" + str(worker_stats["stolen"]) + " stolen)")
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+# Per-width results of Algorithm 1 without keeping one full-length curve per width in RAM.
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+
+KEEP_CURVES = ("none", "memmap", "memory")
+
+
+class SimilarityResult:
+    """
+        The top_x summary of every width of Algorithm 1 plus access to the full (post-processed) quality curves.
+        It can be used like the former list correlation_for_each_width: result[idx] is the curve of the idx-th width.
+
+        :param keep_curves: "none" keeps no curve, a requested curve is recomputed with recompute(w).
+                            "memmap" spills every curve to a memory mapped file (in spill_dir, default the temp directory)
+                            that is deleted with the result. "memory" keeps all curves in RAM.
+        :param recompute: function w -> curve, needed for keep_curves="none"
+        :param curve_dtype: dtype of the spilled curves (np.float32 or np.float16)
+    """
+
+    def __init__(self, keep_curves="none", recompute=None, curve_dtype=np.float32, spill_dir=None):
+        if keep_curves not in KEEP_CURVES:
+            raise ValueError("unknown keep_curves: " + str(keep_curves))
+        self.keep_curves = keep_curves
+        self.recompute = recompute
+        self.curve_dtype = np.dtype(curve_dtype)
+        self.spill_dir = spill_dir
+        self.widths = []
+        self.top_x = []
+        # curves (memory) or (filename, length) of the spilled curves (memmap)
+        self._curves = []
+        self._directory = None
+
+    def add(self, w, top_x, curve=None):
+        """
+            Adds the result of width w. curve is stored according to keep_curves (and dropped for "none").
+        """
+        self.widths.append(int(w))
+        self.top_x.append(top_x)
+        if curve is None or self.keep_curves == "none":
+            self._curves.append(None)
+        elif self.keep_curves == "memory":
+            self._curves.append(curve)
+        else:
+            self._curves.append(self._spill(curve))
+
+    def _spill(self, curve):
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(
+                prefix="co-finder-curves-", dir=self.spill_dir)
+            # the files are removed together with the result
+            self._finalizer = weakref.finalize(
+                self, shutil.rmtree, self._directory, True)
+        filename = os.path.join(self._directory, str(
+            len(self._curves)) + ".curve")
+        spilled = np.memmap(filename, dtype=self.curve_dtype,
+                            mode="w+", shape=(len(curve),))
+        spilled[:] = curve
+        spilled.flush()
+        del spilled
+        return filename, len(curve)
+
+    def curve(self, w):
+        """
+            Full curve of width w.
+        """
+        return self[self.widths.index(int(w))]
+
+    def __getitem__(self, idx):
+        stored = self._curves[idx]
+        if self.keep_curves == "memory" and stored is not None:
+            return stored
+        if self.keep_curves == "memmap" and stored is not None:
+            filename, length = stored
+            return np.memmap(filename, dtype=self.curve_dtype, mode="r", shape=(length,))
+        if self.recompute is None:
+            raise ValueError("the curves of this result were not kept")
+        return self.recompute(self.widths[idx])
+
+    def __len__(self):
+        return len(self.widths)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def nbytes_in_memory(self):
+        """
+            RAM used by the kept curves (the top_x summaries are not counted).
+        """
+        if self.keep_curves != "memory":
+            return 0
+        return sum(curve.nbytes for curve in self._curves if curve is not None)
+
+    def close(self):
+        """
+            Deletes the spilled curves.
+        """
+        if self._directory is not None:
+            self._finalizer()
+            self._directory = None
+            self._curves = [None]*len(self._curves)
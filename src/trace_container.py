@@ -2,17 +2,15 @@
 #!/usr/bin/python3
 
 import json
-from bokeh.models import Span
-import holoviews as hv
 #from holoviews.operation import decimate
 #from holoviews.operation.datashader import datashade
-from bokeh.plotting import figure, show
-from bokeh.io import output_notebook, reset_output, save, output_file
 import numpy as np
-from bokeh.io import curdoc
 from scipy.interpolate import interp1d
 from scipy import signal
 
+from src.lod_pyramid import MinMaxPyramid
+from src.quantized_trace import QuantizedTrace
+
 
 class TraceContainer:
     def __init__(self):
@@ -40,9 +38,16 @@ class TraceContainer:
 
         self.snr = None
 
+        # voltage of an ADC code: voltage_scaling*(code-voltage_offset), see set_trace_codes
+        self.voltage_scaling = None
+        self.voltage_offset = None
+
         self.quality_plot = None
         self.correlation_plot = None
 
+        # (raw, trigger) -> (signal, MinMaxPyramid of the signal) for plotting, see get_lod_pyramid
+        self._lod_pyramids = {}
+
     def import_by_name(self, nr_hidden_cos, averaged_measurements, no_similar_rounds, trace_raw, trace, decimation_factor, sampling_frequency, testcase, known_start_idx_aes=None, config=None, filename=None, rounds_in_co_template=None):
         self.nr_hidden_cos = nr_hidden_cos
         self.averaged_measurements = averaged_measurements
@@ -74,9 +79,9 @@ class TraceContainer:
             config, section, 'nr_hidden_cos')
         self.known_width_clk_cycles = self._check_and_get_int(
             config, section, 'approx_width_cycles')
-        self.voltage_scaling = self._check_and_get_int(
+        self.voltage_scaling = self._check_and_get_float(
             config, section, 'voltage_scaling')
-        self.voltage_offset = self._check_and_get_int(
+        self.voltage_offset = self._check_and_get_float(
             config, section, 'voltage_offset')
         self.N = self._check_and_get_int(config, section, 'N')
 
@@ -97,6 +102,16 @@ class TraceContainer:
                 print(item + " not found in config under section: "+section)
             return -1
 
+    def _check_and_get_float(self, config, section, item, print_info=False):
+        if config.has_option(section, item):
+            thing = float(config.get(section, item))
+            print("\t " + item + ": " + str(thing))
+            return thing
+        else:
+            if print_info:
+                print(item + " not found in config under section: "+section)
+            return None
+
     def print_trace_information(self):
         print("TraceContainer information:")
         print("Trace length:         " + str(len(self.get_trace())))
@@ -110,6 +125,51 @@ class TraceContainer:
             return self.trace_raw
         return self.trace
 
+    def set_trace_codes(self, codes, voltage_scaling=None, voltage_offset=None):
+        """
+            Keeps trace and trace_raw as int8 / int16 ADC codes (QuantizedTrace) instead of float64 voltages.
+            voltage_scaling / voltage_offset default to the values of the config (1 and 0 if they are missing).
+        """
+        if voltage_scaling is not None:
+            self.voltage_scaling = voltage_scaling
+        if voltage_offset is not None:
+            self.voltage_offset = voltage_offset
+        if isinstance(codes, QuantizedTrace):
+            trace = codes
+            self.voltage_scaling, self.voltage_offset = trace.gain, trace.offset
+        else:
+            trace = QuantizedTrace(codes, 1. if self.voltage_scaling is None else self.voltage_scaling,
+                                   0. if self.voltage_offset is None else self.voltage_offset)
+        self.trace = trace
+        self.trace_raw = trace
+
+    def quantize_trace(self, dtype=np.int16):
+        """
+            Replaces the float trace by ADC codes of dtype. Uses voltage_scaling / voltage_offset if they are known,
+            otherwise the code range is spread over the range of the trace (rounding error: half a code).
+        """
+        trace = self.trace
+        trace_raw = QuantizedTrace.from_voltages(
+            self.trace_raw, dtype, self.voltage_scaling, self.voltage_offset)
+        self.set_trace_codes(trace_raw)
+        if trace is not None and len(trace) != len(trace_raw):
+            # decimated trace, same codes
+            self.trace = QuantizedTrace.from_voltages(
+                trace, dtype, trace_raw.gain, trace_raw.offset)
+
+    def get_lod_pyramid(self, raw=False, trigger=False, filename=None):
+        """
+            Min/max pyramid of the (trigger) trace for plotting, built once per trace object (persisted in filename if given).
+        """
+        signal_to_plot = self.get_trigger_trace(
+            raw) if trigger else self.get_trace(raw)
+        cached = self._lod_pyramids.get((raw, trigger))
+        if cached is None or cached[0] is not signal_to_plot:
+            cached = (signal_to_plot, MinMaxPyramid.for_trace(
+                signal_to_plot, filename))
+            self._lod_pyramids[(raw, trigger)] = cached
+        return cached[1]
+
     def get_trigger_trace(self, raw=False):
         if raw:
             return self.trigger_trace_raw
@@ -120,6 +180,15 @@ class TraceContainer:
             return self.sampling_frequency_raw
         return self.sampling_frequency
 
+    def export_metadata(self, raw=False):
+        """
+            Metadata of the (raw) trace and the calculated COs, e.g. for the sidecar of Exporter.export_binary.
+        """
+        return {"testcase": self.testcase, "fs": self.get_fs(raw),
+                "decimation_factor": 1 if raw else self.decimation_factor,
+                "no_similar_rounds": self.no_similar_rounds, "width": self.calculated_width,
+                "start_idx": self.calculated_start_idx_aes}
+
     def get_no_similar_rounds(self):
         return self.no_similar_rounds
 
@@ -190,6 +259,9 @@ class TraceContainer:
         decimated_test_trace = signal.decimate(
             np.array(self.trace_raw), decimation_factor)
         if do_plots:
+            import holoviews as hv
+            from bokeh.io import output_notebook, reset_output
+            from bokeh.plotting import show
             hv.extension('bokeh')
             reset_output()
             output_notebook()
@@ -220,7 +292,15 @@ class TraceContainer:
                 np.array(self.trigger_trace_raw), decimation_factor)
         print("Finished decimating.")
 
-    def plot_trace(self, show_idx=True, show_known_idx=True, decimate_for_plot_factor=10, save_filename=None, plot_range_min=0, plot_range_max=None, show_trigger_trace=True, max_found_idx_to_show=None, export_csv=False, title=None, x_axis_in_time=False):
+    def plot_trace(self, show_idx=True, show_known_idx=True, decimate_for_plot_factor=10, save_filename=None, plot_range_min=0, plot_range_max=None, show_trigger_trace=True, max_found_idx_to_show=None, export_csv=False, title=None, x_axis_in_time=False, max_plot_points=4000):
+        """
+            decimate_for_plot_factor > 1 draws the min/max envelope of the range (see get_lod_pyramid) with one point per
+            decimate_for_plot_factor samples, but at most max_plot_points points per line, so any range of any trace is plotted in constant time.
+        """
+        import holoviews as hv
+        from bokeh.io import curdoc, output_file, output_notebook, save
+        from bokeh.models import Span
+        from bokeh.plotting import figure, show
         hv.extension('bokeh')
         output_notebook()
         p = figure(x_axis_label='Sample', y_axis_label='Amplitude',
@@ -229,9 +309,9 @@ class TraceContainer:
         if plot_range_max == None:
             plot_range_max = len(self.get_trace())
 
-        trace_to_plot = np.array(self.get_trace())[
-            plot_range_min:plot_range_max]
         if decimate_for_plot_factor == 1:
+            trace_to_plot = np.asarray(self.get_trace()[
+                plot_range_min:plot_range_max])
             if not x_axis_in_time:
                 x_data = range(0, len(trace_to_plot))
             else:
@@ -257,35 +337,33 @@ class TraceContainer:
                     p.add_layout(vline)
             # hv.save(curve,'test.svg',fmt='',backend='bokeh')
         else:
-            decimated_trace = signal.decimate(
-                trace_to_plot, decimate_for_plot_factor)
-            if not x_axis_in_time:
-                x_data = range(0, len(decimated_trace))
-            else:
-                x_data = np.arange(
-                    0, len(decimated_trace)/self.get_fs(), step=1/self.get_fs(), dtype=float)
+            pixels = max(1, min(max_plot_points, int(
+                (plot_range_max-plot_range_min)/decimate_for_plot_factor)))
+            x_samples, envelope = self.get_lod_pyramid().line(
+                plot_range_min, plot_range_max, pixels, self.get_trace())
+            x_data = x_samples-plot_range_min
+            if x_axis_in_time:
+                x_data = x_data/self.get_fs()
                 p.xaxis.axis_label = "Time [s]"
             # , legend_label="Power Trace")
-            p.line(x=x_data, y=np.array(decimated_trace), line_width=0.5)
+            p.line(x=x_data, y=np.asarray(envelope), line_width=0.5)
             if show_trigger_trace == True and self.trigger_trace is not None:
-                trigger_trace_to_plot = np.array(self.get_trigger_trace())[
-                    plot_range_min:plot_range_max]
-                decimated_trigger_trace = signal.decimate(
-                    trigger_trace_to_plot, decimate_for_plot_factor)
-                p.line(x=x_data, y=np.array(decimated_trigger_trace),
+                x_trigger, trigger_envelope = self.get_lod_pyramid(trigger=True).line(
+                    plot_range_min, plot_range_max, pixels, self.get_trigger_trace())
+                x_trigger = x_trigger-plot_range_min
+                if x_axis_in_time:
+                    x_trigger = x_trigger/self.get_fs()
+                p.line(x=x_trigger, y=np.asarray(trigger_envelope),
                        line_width=0.5, line_color='green', legend_label="Triggertrace")
+            scale = 1/self.get_fs() if x_axis_in_time else 1
             if show_idx == True and self.calculated_start_idx_aes is not None:
-                decimated_idx_aes = [
-                    idx/decimate_for_plot_factor for idx in self.calculated_start_idx_aes[:max_found_idx_to_show]]
-                for idx in decimated_idx_aes:
-                    vline = Span(location=idx-int(plot_range_min/decimate_for_plot_factor),
+                for idx in self.calculated_start_idx_aes[:max_found_idx_to_show]:
+                    vline = Span(location=(idx-plot_range_min)*scale,
                                  dimension='height', line_color='red', line_dash='dotted', line_width=0.5)
                     p.add_layout(vline)
             if show_known_idx == True and self.known_start_idx_aes is not None:
-                decimated_idx_aes = [
-                    idx/decimate_for_plot_factor for idx in self.known_start_idx_aes[:max_found_idx_to_show]]
-                for idx in decimated_idx_aes:
-                    vline = Span(location=idx-int(plot_range_min/decimate_for_plot_factor),
+                for idx in self.known_start_idx_aes[:max_found_idx_to_show]:
+                    vline = Span(location=(idx-plot_range_min)*scale,
                                  dimension='height', line_color='green', line_dash='dotted', line_width=0.5)
                     p.add_layout(vline)
 
@@ -4,18 +4,16 @@ import numpy as np
 from scipy import signal
 from scipy.io import loadmat
 
-import holoviews as hv
-from bokeh.plotting import  show
-from bokeh.io import output_notebook, reset_output
-
 from src.waveform_parser.lecroy_waveform_parser import LecroyWaveformBinaryParser
 
 from src.trace_container import TraceContainer
+from src.quantized_trace import QuantizedTrace
 import configparser
 
 
 class TraceImporter:
-    def __init__(self, testcase="langer_probes_short", averaged_measurements=10, number_of_aes=None, print_info=False, do_plots=False, index=0, use_lowpass=False):
+    def __init__(self, testcase="langer_probes_short", averaged_measurements=10, number_of_aes=None, print_info=False, do_plots=False, index=0, use_lowpass=False, trace_dtype=None):
+        # trace_dtype np.int16 / np.int8 keeps the trace as ADC codes (QuantizedTrace), None as float voltages
         self.trace_container = TraceContainer()
         base_path_traces = "traces/"
         #base_path_traces = ""
@@ -35,18 +33,23 @@ class TraceImporter:
             basepath = base_path_traces + "bbb_openssl/"
             filepath = "full_32.bin"
 
-            my_parse = LecroyWaveformBinaryParser(basepath+filepath)
+            my_parse = LecroyWaveformBinaryParser(
+                basepath+filepath, keep_codes=trace_dtype is not None)
             print(len(my_parse.data))
             #curve = hv.Curve((range(0,len(data)),np.array(data)),label="concat_trace")
-            data = np.array(my_parse.data)
+            data = my_parse.data if trace_dtype is not None else np.array(
+                my_parse.data)
 
             self.config = configparser.ConfigParser()
             self.config.read(basepath+"properties.ini",
                              encoding='unicode_escape')
             #read meaningful values!
             self.trace_container.import_from_config(self.config, filepath)
-            self.trace_container.trace = data[int(len(data)/2):]
-            self.trace_container.trace_raw = data[int(len(data)/2):]
+            if trace_dtype is not None:
+                self.trace_container.set_trace_codes(data[int(len(data)/2):])
+            else:
+                self.trace_container.trace = data[int(len(data)/2):]
+                self.trace_container.trace_raw = data[int(len(data)/2):]
 
         if testcase == "stm32f4_tinyaes":
             basepath = base_path_traces + "stm32f4/"
@@ -183,6 +186,10 @@ class TraceImporter:
             f_s_new = 1080000000
             self.trace_container.resample(f_s_new=f_s_new)
 
+        if trace_dtype is not None and self.trace_container.trace_raw is not None and \
+                not isinstance(self.trace_container.trace_raw, QuantizedTrace):
+            self.trace_container.quantize_trace(trace_dtype)
+
     def decimate_trace(self, decimation_factor, do_plots=False):
         self.decimation_factor = decimation_factor
         #decimate data:
@@ -191,6 +198,9 @@ class TraceImporter:
         decimated_test_trace = signal.decimate(
             np.array(self.trace_container.trace_raw), decimation_factor)
         if do_plots:
+            import holoviews as hv
+            from bokeh.io import output_notebook, reset_output
+            from bokeh.plotting import show
             hv.extension('bokeh')
             reset_output()
             output_notebook()
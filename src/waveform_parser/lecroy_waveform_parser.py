@@ -3,6 +3,9 @@
 import argparse
 import struct
 
+import numpy as np
+
+from src.quantized_trace import QuantizedTrace
 from src.waveform_parser.lecroy_waveform import LecroyWaveform, LecroyWaveformDescriptor
 
 
@@ -535,19 +538,42 @@ class LecroyWaveformParser:
         self.parseWaveformDescriptor()
         self.parseWaveform()
 
+    def parseCodes(self):
+        """
+            Parses the descriptor and returns the samples as QuantizedTrace (int8 / int16 codes with the vertical gain
+            and offset) instead of a list of floats.
+        """
+        self.parseWaveformDescriptor()
+        return self.parseWaveformCodes()
+
     def parseWaveformDescriptor(self):
         LecroyWaveformDescriptorParser(
             self.unprocessedData[self.WAVEDESCRIPTOR_OFFSET:self.WAVEDESCRIPTOR_OFFSET + self.WAVEDESCRIPTOR_LENGTH], self.waveform.getWaveformDescriptor())
 
-    def parseWaveform(self):
+    def waveformArrayOffset(self):
         waveformArrayOffset = self.WAVEDESCRIPTOR_OFFSET
-        waveformArrayLength = self.waveform.getWaveformDescriptor().getWaveArray1Length()
         waveformArrayOffset += self.waveform.getWaveformDescriptor().getWaveDescriptorBlockLength()
         waveformArrayOffset += self.waveform.getWaveformDescriptor().getUserTextBlockLength()
         waveformArrayOffset += self.waveform.getWaveformDescriptor().getReservedDescriptor1BlockLength()
         waveformArrayOffset += self.waveform.getWaveformDescriptor().getTrigTimeArrayLength()
         waveformArrayOffset += self.waveform.getWaveformDescriptor().getRISTimeArrayLength()
         waveformArrayOffset += self.waveform.getWaveformDescriptor().getReservedArray1Length()
+        return waveformArrayOffset
+
+    def parseWaveformCodes(self):
+        descriptor = self.waveform.getWaveformDescriptor()
+        waveformArrayOffset = self.waveformArrayOffset()
+        waveformArrayLength = descriptor.getWaveArray1Length()
+        dtype = np.dtype(
+            "<i2") if descriptor.getCommType() == LecroyWaveformDescriptor.CommType.WORD_FORMAT else np.dtype(np.int8)
+        codes = np.frombuffer(self.unprocessedData, dtype=dtype, count=waveformArrayLength //
+                              dtype.itemsize, offset=waveformArrayOffset).astype(dtype.newbyteorder("="))
+        self.setWaveformInformation()
+        return QuantizedTrace(codes, descriptor.getVerticalGain(), descriptor.getVerticalOffset())
+
+    def parseWaveform(self):
+        waveformArrayLength = self.waveform.getWaveformDescriptor().getWaveArray1Length()
+        waveformArrayOffset = self.waveformArrayOffset()
 
         unprocessedWaveformBytes = self.unprocessedData[
             waveformArrayOffset:waveformArrayOffset + waveformArrayLength]
@@ -557,6 +583,9 @@ class LecroyWaveformParser:
             data = self.waveform.getWaveformDescriptor().getVerticalGain(
             ) * (rawData - self.waveform.getWaveformDescriptor().getVerticalOffset())
             self.waveform.pushBackValue(data)
+        self.setWaveformInformation()
+
+    def setWaveformInformation(self):
         self.waveform.setHorizontalUnit(
             self.waveform.getWaveformDescriptor().getHorizontalUnit())
         self.waveform.setVerticalUnit(
@@ -568,8 +597,13 @@ class LecroyWaveformParser:
 
 
 class LecroyWaveformBinaryParser:
-    def __init__(self, file_path):
+    def __init__(self, file_path, keep_codes=False):
+        """
+            :param keep_codes: data becomes a QuantizedTrace of the ADC codes instead of a list of voltages
+                               (no timebase list either)
+        """
         self.file_path = file_path
+        self.keep_codes = keep_codes
         self.timebase = None
         self.data = None
         self.parse_bin(file_path)
@@ -584,6 +618,9 @@ class LecroyWaveformBinaryParser:
             raise
         waveform = LecroyWaveform()
         waveformParser = LecroyWaveformParser(bytesArray, waveform)
+        if self.keep_codes:
+            self.data = waveformParser.parseCodes()
+            return
         waveformParser.parse()
         # waveform.getWaveformDescriptor().dump()
         self.timebase, self.data = waveform.getDataValues()
@@ -0,0 +1,13 @@
+import pytest
+
+from src.backends import available_backends
+from src.benchmark import compare_backends
+
+# every backend is compared with the float64 numpy reference
+REFERENCE_BACKEND = "numpy"
+
+
+@pytest.mark.parametrize("backend_name", [name for name in available_backends() if name != REFERENCE_BACKEND])
+def test_backend_matches_reference(backend_name):
+    # same CO indices (best start positions and template matches) and values within the tolerance on a small trace
+    assert compare_backends([REFERENCE_BACKEND, backend_name], w=32, n=1 << 14)
@@ -0,0 +1,8 @@
+from src.benchmark import COMPUTE_MODULES, check_headless_imports
+
+
+def test_compute_modules_import_headless():
+    # the compute path (helper and trace_container included) imports without any plotting module
+    ok, _, plotting = check_headless_imports(COMPUTE_MODULES)
+    assert plotting == []
+    assert ok
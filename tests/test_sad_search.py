@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from src.helper import top_k_peaks
+from src.numba_kernels import template_sad
+from src.sad_search import sad_top_k
+
+
+@pytest.mark.parametrize("seed", range(60))
+def test_sad_top_k_matches_exhaustive_scan(seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(2000, 6000))
+    trace = rng.normal(size=n).astype(np.float32)
+    if seed % 3 == 0:
+        # coarse values (like integer ADC codes) give many equal SADs
+        trace = (np.round(trace*4)/4).astype(np.float32)
+    template_length = int(rng.integers(8, 64))
+    template = trace[100:100+template_length].copy()
+    k = int(rng.integers(1, 12))
+    suppression_radius = int(rng.choice([0, 5, template_length]))
+    positions = np.arange(n-template_length)
+
+    picks, sads = sad_top_k(trace, template, k, positions,
+                            suppression_radius, first_batch=64)
+    expected = top_k_peaks(-template_sad(trace, template, positions), k, suppression_radius)
+    assert np.array_equal(picks, expected[:, 1].astype(int))
+    assert np.array_equal(-sads, expected[:, 0])